@@ -1,7 +1,8 @@
-from struct import unpack, pack
+from struct import unpack, pack, Struct
 
 class Section():
   HEADER_SIZE = 64
+  HEADER_FORMAT = Struct('<IIQQQQIIQQ')
   def __init__(self):
     self.sh_name = 0
     self.sh_type = 0
@@ -18,7 +19,7 @@ class Section():
 
   def unpack_binary(self, data):
     sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, \
-    sh_link, sh_info, sh_align, sh_entsize = unpack('iiQQQQiiQQ', data)
+    sh_link, sh_info, sh_align, sh_entsize = Section.HEADER_FORMAT.unpack_from(data)
     self.sh_name = sh_name
     self.sh_type = sh_type
     self.sh_flags = sh_flags
@@ -29,15 +30,20 @@ class Section():
     self.sh_info = sh_info
     self.sh_align = sh_align
     self.sh_entsize = sh_entsize
-    self.name = ''
+    self.name = b''
     self.data = None
 
   def PackHeader(self): # pack header
-    return pack('<IIQQQQIIQQ', self.sh_name, self.sh_type, self.sh_flags, self.sh_addr, self.sh_offset, self.sh_size,
+    return Section.HEADER_FORMAT.pack(self.sh_name, self.sh_type, self.sh_flags, self.sh_addr, self.sh_offset, self.sh_size,
     self.sh_link, self.sh_info, self.sh_align, self.sh_entsize)
 
+  def PackHeaderInto(self, buffer, offset):
+    Section.HEADER_FORMAT.pack_into(buffer, offset, self.sh_name, self.sh_type, self.sh_flags, self.sh_addr, 
+    self.sh_offset, self.sh_size, self.sh_link, self.sh_info, self.sh_align, self.sh_entsize)
+
 class Program():
   PHDR_SIZE = 56
+  PHDR_FORMAT = Struct('<IIQQQQQQ')
   def __init__(self, type_, flags):
     self.type = type_ # 1 - LOAD; 6 - PHDR
     self.flags = flags # 0x4 - R; 0x2 - W; 0x1 - X; 
@@ -49,16 +55,20 @@ class Program():
     self.align = 8 # Other value?
 
   def unpack_binary(self, data):
-    # iiQQQQQQ
     self.type, self.flags, self.offset, self.vaddr, self.paddr, self.filesz, self.memsz, self.align \
-      = unpack('iiQQQQQQ', data)
+      = Program.PHDR_FORMAT.unpack_from(data)
 
   def PackHeader(self):
-    return pack('<IIQQQQQQ', self.type, self.flags, self.offset, 
+    return Program.PHDR_FORMAT.pack(self.type, self.flags, self.offset, 
+    self.vaddr, self.paddr, self.filesz, self.memsz, self.align)
+
+  def PackHeaderInto(self, buffer, offset):
+    Program.PHDR_FORMAT.pack_into(buffer, offset, self.type, self.flags, self.offset, 
     self.vaddr, self.paddr, self.filesz, self.memsz, self.align)
 
 class Header():
   HEADER_SIZE = 64
+  HEADER_FORMAT = Struct('<16sHHIQQQIHHHHHH')
   def __init__(self):
     self.ident     = None
     self.type      = 2 # EXEC
@@ -76,30 +86,40 @@ class Header():
     self.shstrndx  = 0
 
   def unpack_binary(self, data):
-    self.ident = unpack('16B', data[:16])
-    ei_mag0, ei_mag1, ei_mag2, ei_mag3, ei_class, ei_data, ei_version, ei_pad = self.ident[:8]
-    if ei_mag0 != 127 or ei_mag1 != ord('E') or ei_mag2 != ord('L') or ei_mag3 != ord('F'):
+    if len(data) < Header.HEADER_SIZE:
+      raise Exception('Not an ELF file.\n')
+    ident = bytes(data[:16])
+    ei_class, ei_data = ident[4], ident[5]
+    if ident[:4] != b'\x7fELF':
       raise Exception('Not an ELF file.\n')
     if ei_class != 2:
       raise Exception('Not a 64-bit ELF file\n')
+    if ei_data != 1:
+      raise Exception('Not a little endian ELF file\n')
 
-    self.type, self.machine, self.version = unpack('hhi', data[16:24])
-    self.entry, self.phoff, self.shoff, self.flags = unpack('qqqi', data[24:52])
-    self.ehsize, self.phentsize, self.phnum = unpack('hhh', data[52:58])
-    self.shentsize, self.shnum, self.shstrndx = unpack('hhh', data[58:64])
-    arch = self.flags & 0xFF
-    address_size = 64 if self.flags & 0x400 else 32
+    self.ident, self.type, self.machine, self.version, \
+    self.entry, self.phoff, self.shoff, self.flags, \
+    self.ehsize, self.phentsize, self.phnum, \
+    self.shentsize, self.shnum, self.shstrndx = Header.HEADER_FORMAT.unpack_from(data)
 
   def PackHeader(self):
+    buffer = bytearray(Header.HEADER_SIZE)
+    self.PackHeaderInto(buffer, 0)
+    return bytes(buffer)
+
+  def PackHeaderInto(self, buffer, offset):
     # ELF 64-bit, little endian, version01, ABI33, ABI version7, zero padding
-    self.ident = b'\x7fELF' + b'\x02' + b'\x01' + b'\x01' + b'\x33' + b'\7' + b'\0' * 7
-    return pack('<16sHHIQQQIHHHHHH', self.ident, self.type, self.machine, self.version,
-                                     self.entry, self.phoff, self.shoff, self.flags, 
-                                     self.ehsize, self.phentsize, self.phnum, 
-                                     self.shentsize, self.shnum, self.shstrndx)
+    # (Headers read from a file keep their own ident.)
+    if self.ident == None:
+      self.ident = b'\x7fELF' + b'\x02' + b'\x01' + b'\x01' + b'\x33' + b'\7' + b'\0' * 7
+    Header.HEADER_FORMAT.pack_into(buffer, offset, self.ident, self.type, self.machine, self.version,
+                                   self.entry, self.phoff, self.shoff, self.flags, 
+                                   self.ehsize, self.phentsize, self.phnum, 
+                                   self.shentsize, self.shnum, self.shstrndx)
 
 class Symbol():
   ENTRY_SIZE = 24
+  ENTRY_FORMAT = Struct('<IBBHQQ')
   def __init__(self):
     self.name = b''
     # iBBhqq 411288 = 24
@@ -111,9 +131,13 @@ class Symbol():
     self.st_size = 0
 
   def unpack_binary(self, data):
-    self.st_name, self.st_info, self.st_other, self.st_shndx, self.st_value, self.st_size = unpack(
-      'IBBHQQ', data)
+    self.st_name, self.st_info, self.st_other, self.st_shndx, self.st_value, self.st_size = \
+      Symbol.ENTRY_FORMAT.unpack_from(data)
 
   def PackEntry(self):
-    return pack('<IBBHQQ', self.st_name, 
+    return Symbol.ENTRY_FORMAT.pack(self.st_name, 
+                self.st_info, self.st_other, self.st_shndx, self.st_value, self.st_size)
+
+  def PackEntryInto(self, buffer, offset):
+    Symbol.ENTRY_FORMAT.pack_into(buffer, offset, self.st_name, 
                 self.st_info, self.st_other, self.st_shndx, self.st_value, self.st_size)
\ No newline at end of file
@@ -0,0 +1,23 @@
+# The assembler modules import each other by their flat names
+# (from turas import ..., from grammar import ...), as main.py does.
+# Make them resolvable when imported as a package. The directory goes last on
+# sys.path, so modules of the host application keep their names; a host
+# module taking one of ours is an error rather than silently used.
+import os
+import sys
+from importlib.util import find_spec
+_path = os.path.dirname(os.path.abspath(__file__))
+if _path not in sys.path:
+  sys.path.append(_path)
+
+for _file in sorted(os.listdir(_path)):
+  _name, _ext = os.path.splitext(_file)
+  if _ext != '.py' or _name in ('__init__', 'main'):
+    continue
+  _spec = find_spec(_name)
+  if _spec == None or _spec.origin == None or os.path.dirname(os.path.abspath(_spec.origin)) != _path:
+    raise ImportError(f'Module {_name} of the assembler is shadowed by {_spec.origin if _spec else None}.')
+
+from api import AssembleToBytes
+from turas import AssembleSource
+from cubin import Cubin
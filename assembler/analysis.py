@@ -0,0 +1,207 @@
+import re
+from functools import lru_cache
+from grammar import MatchInstr
+
+# Registers are 0-254 (RZ is not tracked). Predicates P0-P6 follow them.
+PRED_BASE = 256
+ALL_PREDS = tuple(range(PRED_BASE, PRED_BASE + 7))
+
+# Ops whose results come back at a variable time, through a write barrier.
+variable_writes = {'LDG', 'LDS', 'S2R'}
+# Ops that read their source registers at a variable time, through a read barrier.
+variable_reads = {'LDG', 'LDS', 'STG', 'STS'}
+# Latency of fixed latency ops without 'lat' in the grammar.
+default_latency = 6
+
+mem_width = {'.64' : 2, '.128' : 4}
+
+def Regs(name, count=1):
+  if name == None or name == 'RZ' or name[0] != 'R':
+    return ()
+  idx = int(name[1:])
+  return tuple(range(idx, idx + count))
+
+def Pred(name):
+  # '!P1' => (257,). PT => ()
+  if name == None:
+    return ()
+  name = name.lstrip('!')
+  if name == 'PT' or not name.startswith('P'):
+    return ()
+  return (PRED_BASE + int(name[1:]),)
+
+branch_label_re = re.compile(r'[a-zA-Z_]\w*;$')
+
+# Distinct (op, rest) kept by Resources. Unrolled code repeats the same
+# lines; least recently used ones are dropped beyond this.
+RESOURCES_CACHE_SIZE = 1 << 16
+
+def Resources(instr):
+  '''
+  Registers and predicates an instruction reads and writes.
+  instr: record of Parse (register names already resolved).
+  Return {
+    op, gram, captured,
+    dst, src    : register indices (predicates from PRED_BASE on),
+    groups      : register operands, as tuples of consecutive registers,
+    lat         : fixed latency of the results,
+    var_write   : results come back through a write barrier,
+    var_read    : sources are read through a read barrier,
+    mem         : 'global', 'shared' or None,
+    store       : memory is written
+  }
+  The predicate guarding the instruction is not included, see Guard.
+  Records with the same op and operands share the result: do not modify it.
+  '''
+  return OpResources(instr['op'], instr['rest'])
+
+@lru_cache(maxsize=RESOURCES_CACHE_SIZE)
+def OpResources(op, text):
+  rest = text
+  if op == 'BRA':
+    # Labels are only replaced by offsets in Assemble.
+    rest = branch_label_re.sub('0x0;', rest.strip())
+    rest = ' ' + rest
+  gram, values = MatchInstr(op, rest)
+  if gram == None:
+    raise Exception(f'Cannot recognize instruction {op+text}')
+  captured = dict(zip(gram['fields'], values))
+  get = captured.get
+
+  # Register operands, one group of consecutive registers each.
+  dst_groups = []
+  src_groups = []
+  mem_type = get('type') if op in ('LDG', 'STG', 'LDS', 'STS') else None
+  width = mem_width.get(mem_type, 1)
+  imad_wide = op == 'IMAD' and gram['code'] == 0x225
+  imad_hi   = op == 'IMAD' and gram['code'] == 0x227
+  if op in ('LDG', 'LDS'):
+    dst_groups.append(Regs(get('rd'), width))
+  elif op == 'CS2R' or imad_wide:
+    dst_groups.append(Regs(get('rd'), 2))
+  else:
+    dst_groups.append(Regs(get('rd')))
+  if op in ('LDG', 'STG'):
+    src_groups.append(Regs(get('rs0'), 2 if get('E') else 1))
+  else:
+    src_groups.append(Regs(get('rs0')))
+  src_groups.append(Regs(get('rs1'), width if op in ('STG', 'STS') else 1))
+  src_groups.append(Regs(get('rs2'), 2 if imad_wide or imad_hi else 1))
+  dst_groups = [group for group in dst_groups if group]
+  src_groups = [group for group in src_groups if group]
+  dst = [reg for group in dst_groups for reg in group]
+  src = [reg for group in src_groups for reg in group]
+
+  for pd in ('pd0', 'pd1'):
+    dst += Pred(get(pd))
+  for ps in ('ps0', 'ps1', 'cp'):
+    src += Pred(get(ps))
+  if op == 'LDG':
+    src += Pred(get('ldgp'))
+  if op == 'P2R':
+    src += ALL_PREDS
+  if op == 'R2P':
+    dst += ALL_PREDS
+
+  info = {
+    'op'        : op,
+    'gram'      : gram,
+    'captured'  : captured,
+    'dst'       : tuple(dict.fromkeys(dst)),
+    'src'       : tuple(dict.fromkeys(src)),
+    'groups'    : tuple(dst_groups + src_groups),
+    'lat'       : gram.get('lat', default_latency),
+    'var_write' : op in variable_writes,
+    'var_read'  : op in variable_reads,
+    'mem'       : {'LDG' : 'global', 'STG' : 'global', 'LDS' : 'shared', 'STS' : 'shared'}.get(op),
+    'store'     : op in ('STG', 'STS')
+  }
+  return info
+
+# Register banks (Volta/Turing): two banks, by register index. A bank
+# serves two 32-bit registers per cycle, so an instruction stalls when it
+# reads three different registers of the same bank.
+NUM_REG_BANKS = 2
+BANK_PORTS = 2
+# Operand slots, in the order of their reuse flags (GenReuse).
+reuse_slots = ('rs0', 'rs1', 'rs2')
+
+def SourceSlots(res):
+  '''
+  Return:
+    {slot : register index} of the register operands (RZ excluded).
+  '''
+  slots = {}
+  for slot in reuse_slots:
+    regs = Regs(res['captured'].get(slot))
+    if regs:
+      slots[slot] = regs[0]
+  return slots
+
+# Slot => its .reuse capture group in the grammar.
+reuse_groups = {'rs0' : 'reuse1', 'rs1' : 'reuse2', 'rs2' : 'reuse3'}
+
+def FlaggedSlots(res):
+  '''
+  Return:
+    {slot : register} of the operands flagged .reuse.
+  '''
+  captured = res['captured']
+  return {slot : reg for slot, reg in SourceSlots(res).items() if captured.get(reuse_groups[slot])}
+
+def BankConflicts(regs):
+  '''
+  regs: registers read from the register file by one instruction.
+  Return:
+    extra cycles spent on register bank conflicts.
+  '''
+  per_bank = {}
+  for reg in set(regs):
+    per_bank[reg % NUM_REG_BANKS] = per_bank.get(reg % NUM_REG_BANKS, 0) + 1
+  return sum((count - 1) // BANK_PORTS for count in per_bank.values())
+
+def Guard(instr):
+  '''
+  Return:
+    predicate register guarding instr, as a tuple (empty if none).
+  '''
+  if instr['predReg'] == None:
+    return ()
+  return (PRED_BASE + int(instr['predReg']),)
+
+def Unconditional(instr):
+  # Control flow never falls through an unguarded BRA/EXIT.
+  if instr['op'] not in ('BRA', 'EXIT') or instr['predReg'] != None:
+    return False
+  return Pred(Resources(instr)['captured'].get('cp')) == ()
+
+def BranchTarget(instr):
+  return instr['rest'].strip().rstrip(';').split(',')[-1].strip()
+
+def Blocks(program, split_at=()):
+  '''
+  Split the instructions of a program (result of Parse) into basic blocks.
+  Blocks start at labels and after BRA/EXIT (and after ops in split_at).
+  Return:
+    [{'start', 'end', 'succ' : [block index]}], instructions[start:end] each.
+  '''
+  instructions = program['instructions']
+  starts = {0} | set(program['labels'].values())
+  for i, instr in enumerate(instructions):
+    if instr['op'] in ('BRA', 'EXIT') or instr['op'] in split_at:
+      starts.add(i + 1)
+  starts = sorted(start for start in starts if start < len(instructions))
+  block_of = {start : i for i, start in enumerate(starts)}
+  blocks = []
+  for i, start in enumerate(starts):
+    end = starts[i + 1] if i + 1 < len(starts) else len(instructions)
+    blocks.append({'start' : start, 'end' : end, 'succ' : []})
+  for i, block in enumerate(blocks):
+    last = instructions[block['end'] - 1]
+    if last['op'] == 'BRA':
+      target = program['labels'].get(BranchTarget(last))
+      if target in block_of:
+        block['succ'].append(block_of[target])
+    if not Unconditional(last) and i + 1 < len(blocks):
+      block['succ'].append(i + 1)
+  return blocks
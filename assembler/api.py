@@ -0,0 +1,45 @@
+from turas import AssembleSource
+from cubin import Cubin
+
+def AssembleToBytes(source, include=None, arch=75, name='kern', cache=None, ctx=None, passes=None,
+                    profiler=None):
+  '''
+  Assemble kernel source text to a cubin, all in memory.
+  Nothing is read from or written to the filesystem.
+  include: list of include sources (python text, not paths).
+  cache: optional EncodingCache. Use one without path to stay in memory.
+  ctx: optional PreprocessContext. Default: a fresh one per call, so calls
+       can run concurrently on threads.
+  passes: optional passes run before encoding (see BuildContext).
+  profiler: optional Profiler, gets every phase including Cubin.Serialize.
+  Return:
+    (cubin, info)
+    cubin: memoryview over the cubin image, ready for cuModuleLoadData.
+    info : kernel metadata {
+      Name, RegCnt, BarCnt, SmemSize, ConstSize, ExitOffset,
+      ParamNames, ParamSizes, CodeSize
+    }
+  '''
+  if isinstance(name, str):
+    name = name.encode()
+  kernel, params = AssembleSource(source, cache=cache, arch=arch, include_src=include, ctx=ctx, passes=passes,
+                                  profiler=profiler)
+  cubin = Cubin(arch=arch)
+  cubin.AddKernel(kernel, name, params['size_list'])
+  if profiler != None:
+    with profiler.Phase('Cubin.Serialize'):
+      buffer = cubin.Serialize()
+  else:
+    buffer = cubin.Serialize()
+  info = {
+    'Name'       : name,
+    'RegCnt'     : kernel['RegCnt'],
+    'BarCnt'     : kernel['BarCnt'],
+    'SmemSize'   : kernel['SmemSize'],
+    'ConstSize'  : kernel['ConstSize'],
+    'ExitOffset' : kernel['ExitOffset'],
+    'ParamNames' : params['name_list'],
+    'ParamSizes' : params['size_list'],
+    'CodeSize'   : len(kernel['KernelData']) * 16
+  }
+  return memoryview(buffer), info
@@ -0,0 +1,79 @@
+from analysis import Resources, SourceSlots, FlaggedSlots, BankConflicts, Blocks, NUM_REG_BANKS
+
+def AnalyzeBanks(program):
+  '''
+  Register bank conflicts of every instruction of a program (result of Parse),
+  from the rs0/rs1/rs2 operands. An operand flagged .reuse on the instruction
+  before (in the same basic block) comes from the reuse cache, not a bank.
+  Return {
+    'lines'  : [{line, text, regs : {slot : reg}, banks : {slot : bank},
+                 reused : [slot], conflicts}],
+    'blocks' : [{label, line, instructions, conflicts, conflict_lines}],
+    'total'  : {instructions, conflicts, conflict_lines}
+  }
+  Blocks are the code between labels ('' before the first label).
+  '''
+  instructions = program['instructions']
+  block_starts = {start for start in (block['start'] for block in Blocks(program))}
+  label_at = {}
+  for label, idx in sorted(program['labels'].items(), key=lambda item: item[1]):
+    label_at.setdefault(idx, label)
+
+  lines = []
+  blocks = []
+  cached = {}
+  for idx, instr in enumerate(instructions):
+    if idx == 0 or idx in label_at:
+      blocks.append({'label' : label_at.get(idx, ''), 'line' : instr['file_line_num'],
+                     'instructions' : 0, 'conflicts' : 0, 'conflict_lines' : 0})
+    if idx in block_starts:
+      cached = {}
+    res = Resources(instr)
+    regs = SourceSlots(res)
+    reused = [slot for slot, reg in regs.items() if cached.get(slot) == reg]
+    conflicts = BankConflicts(reg for slot, reg in regs.items() if slot not in reused)
+    lines.append({
+      'line'      : instr['file_line_num'],
+      'text'      : f'{instr["ctrl"]}    {instr["pred"] or ""}{instr["op"]}{instr["rest"]}',
+      'regs'      : regs,
+      'banks'     : {slot : reg % NUM_REG_BANKS for slot, reg in regs.items()},
+      'reused'    : reused,
+      'conflicts' : conflicts
+    })
+    block = blocks[-1]
+    block['instructions'] += 1
+    block['conflicts'] += conflicts
+    block['conflict_lines'] += conflicts > 0
+    # Flags of this instruction feed the next one.
+    cached = FlaggedSlots(res)
+
+  return {
+    'lines'  : lines,
+    'blocks' : blocks,
+    'total'  : {
+      'instructions'   : len(lines),
+      'conflicts'      : sum(block['conflicts'] for block in blocks),
+      'conflict_lines' : sum(block['conflict_lines'] for block in blocks)
+    }
+  }
+
+def BankReportText(result, name='', all_lines=False):
+  '''
+  Text version of AnalyzeBanks: lines with conflicts (or all lines), then
+  totals per label block.
+  '''
+  out = [f'Register bank conflicts{" of " + name if name else ""}:']
+  for line in result['lines']:
+    if line['conflicts'] == 0 and not all_lines:
+      continue
+    operands = ', '.join(f'{slot}=R{reg}' + ('(reuse)' if slot in line['reused'] else f'(b{line["banks"][slot]})')
+                         for slot, reg in line['regs'].items())
+    out.append(f'  line {line["line"]:>5}: {line["conflicts"]} | {operands} | {line["text"].strip()}')
+  out.append('  Block                 Line  Instrs  Conflicts  Lines')
+  for block in result['blocks']:
+    out.append(f'  {block["label"] or "<entry>":<20} {block["line"]:>5} {block["instructions"]:>7} '
+               f'{block["conflicts"]:>10} {block["conflict_lines"]:>6}')
+  total = result['total']
+  out.append(f'  Total: {total["conflicts"]} conflict cycles on {total["conflict_lines"]} of '
+             f'{total["instructions"]} instructions.')
+  return '\n'.join(out)
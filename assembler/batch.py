@@ -0,0 +1,106 @@
+import os
+import time
+from multiprocessing import Pool
+from turas import AssembleSource, ReadIncludes
+from cubin import Cubin
+
+def ReadManifest(path, default_arch=75):
+  '''
+  Manifest: one job per line.
+    input.sass  output.cubin  [arch]  [kernel name]
+  Empty lines and # comments are skipped.
+  '''
+  jobs = []
+  with open(path, 'r') as f:
+    for line_num, line in enumerate(f):
+      line = line.split('#')[0].strip()
+      if line == '':
+        continue
+      fields = line.split()
+      if len(fields) < 2 or len(fields) > 4:
+        raise Exception(f'Bad manifest entry at line {line_num+1}: {line}\n')
+      arch = int(fields[2]) if len(fields) > 2 else default_arch
+      name = fields[3] if len(fields) > 3 else 'kern'
+      jobs.append({'input' : fields[0], 'output' : fields[1], 'arch' : arch, 'name' : name})
+  return jobs
+
+# Include sources, read once per worker by InitWorker, or the error reading them.
+worker_include = None
+worker_error = None
+
+def InitWorker(include):
+  # grammar (rules, flag tables) is built when turas is imported, once per worker.
+  # An initializer must not raise (the pool would start workers forever): jobs report it.
+  global worker_include, worker_error
+  try:
+    worker_include = ReadIncludes(include)
+  except Exception as e:
+    worker_error = f'{type(e).__name__}: {e}'.strip()
+
+def AssembleJob(job):
+  '''
+  Assemble one manifest entry. Never raises, errors are sent back.
+  '''
+  start = time.perf_counter()
+  result = dict(job)
+  result['worker'] = os.getpid()
+  result['instructions'] = 0
+  result['error'] = None
+  try:
+    if worker_error != None:
+      raise Exception(f'Cannot read include files. {worker_error}')
+    with open(job['input'], 'r') as input_file:
+      file = input_file.read()
+    kernel, params = AssembleSource(file, arch=job['arch'], include_src=worker_include)
+    cubin = Cubin(arch=job['arch'])
+    cubin.AddKernel(kernel, job['name'].encode(), params['size_list'])
+    cubin.Write(job['output'])
+    result['instructions'] = len(kernel['KernelData'])
+  except Exception as e:
+    result['error'] = f'{type(e).__name__}: {e}'.strip()
+  result['seconds'] = time.perf_counter() - start
+  return result
+
+def RunBatch(jobs, include=None, processes=None, log=print):
+  '''
+  Assemble all jobs on a process pool (one process per core by default).
+  Results are logged as soon as each file is done.
+  Return:
+    list of per-job results.
+  '''
+  processes = processes or os.cpu_count() or 1
+  processes = min(processes, max(len(jobs), 1))
+  start = time.perf_counter()
+  results = []
+  with Pool(processes, initializer=InitWorker, initargs=(include,)) as pool:
+    for result in pool.imap_unordered(AssembleJob, jobs):
+      results.append(result)
+      if result['error'] == None:
+        log(f'[{len(results)}/{len(jobs)}] {result["input"]} -> {result["output"]}: '
+            f'{result["instructions"]} instructions, {result["seconds"]:.3f}s')
+      else:
+        log(f'[{len(results)}/{len(jobs)}] {result["input"]}: FAILED. {result["error"]}')
+  wall = time.perf_counter() - start
+  log(Summary(results, wall))
+  return results
+
+def Summary(results, wall):
+  workers = {}
+  for result in results:
+    stat = workers.setdefault(result['worker'], {'files' : 0, 'failed' : 0, 'instructions' : 0, 'seconds' : 0.0})
+    stat['files'] += 1
+    stat['failed'] += result['error'] != None
+    stat['instructions'] += result['instructions']
+    stat['seconds'] += result['seconds']
+
+  lines = ['Worker      Files  Failed  Instructions  Busy(s)  Instr/s']
+  for pid, stat in sorted(workers.items()):
+    rate = stat['instructions'] / stat['seconds'] if stat['seconds'] > 0 else 0
+    lines.append(f'{pid:<10} {stat["files"]:>6} {stat["failed"]:>7} {stat["instructions"]:>13} '
+                 f'{stat["seconds"]:>8.2f} {rate:>8.0f}')
+  total = sum(result['instructions'] for result in results)
+  failed = sum(result['error'] != None for result in results)
+  rate = total / wall if wall > 0 else 0
+  lines.append(f'Total: {len(results)} files ({failed} failed), {total} instructions '
+               f'in {wall:.2f}s on {len(workers)} workers, {rate:.0f} instr/s.')
+  return '\n'.join(lines)
@@ -0,0 +1,108 @@
+import os
+import pickle
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+import grammar
+from turas import EncodeInstr
+
+def EncoderHash():
+  '''
+  Return:
+    sha1 of the encoder: grammar rules, flag tables and GenCode (grammar.py),
+    and EncodeInstr. Entries encoded by another encoder are not reused.
+  '''
+  digest = hashlib.sha1(inspect.getsource(grammar).encode())
+  digest.update(inspect.getsource(EncodeInstr).encode())
+  return digest.hexdigest()
+
+class EncodingCache():
+  '''
+  On-disk cache of encoded instructions.
+  Key:
+    (ctrl, pred, op, rest, arch) after preprocessing and label remapping.
+  Value:
+    (code, RegCnt, BarCnt) where RegCnt/BarCnt are what this single
+    instruction needs. Assemble takes the max over all instructions.
+  The file is ignored when written by another format or encoder (VERSION).
+  Least recently used entries are evicted beyond max_entries.
+  Can be shared by builds running on several threads.
+  '''
+  VERSION = (2, EncoderHash())
+  def __init__(self, path=None, max_entries=1 << 20):
+    self.path = path
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.dirty = False
+    self.lock = threading.Lock()
+    if path != None:
+      self.Load(path)
+
+  def Load(self, path):
+    if not os.path.exists(path):
+      return
+    try:
+      with open(path, 'rb') as f:
+        version, entries = pickle.load(f)
+    except Exception:
+      return # Broken cache file. Start from scratch.
+    if version != EncodingCache.VERSION:
+      return
+    with self.lock:
+      self.entries = entries
+      self.Evict()
+
+  def Save(self, path=None):
+    path = self.path if path == None else path
+    if path == None or not self.dirty:
+      return
+    # Write then rename, so concurrent builds never read half a file.
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with self.lock:
+      with open(tmp_path, 'wb') as f:
+        pickle.dump((EncodingCache.VERSION, self.entries), f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_path, path)
+      self.dirty = False
+
+  def Get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry == None:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      return entry
+
+  def Put(self, key, entry):
+    with self.lock:
+      self.entries[key] = entry
+      self.dirty = True
+      self.Evict()
+
+  def Evict(self):
+    # Called with self.lock held.
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+      self.evictions += 1
+      self.dirty = True
+
+  def Stats(self):
+    total = self.hits + self.misses
+    return {
+      'hits'      : self.hits,
+      'misses'    : self.misses,
+      'evictions' : self.evictions,
+      'entries'   : len(self.entries),
+      'hit_rate'  : self.hits / total if total else 0.0
+    }
+
+  def Report(self):
+    stats = self.Stats()
+    return (f'Encoding cache: {stats["hits"]} hits, {stats["misses"]} misses '
+            f'({stats["hit_rate"]:.1%} hit rate), {stats["evictions"]} evictions, '
+            f'{stats["entries"]} entries.')
@@ -0,0 +1,183 @@
+from grammar import ProcessAsmLine
+from analysis import Resources, PRED_BASE, Unconditional
+from turas import ConstantText
+from schedule import CtrlText, barriers
+from reuse import SetReuse
+
+# Hidden parameter getting the pointer to the deltas, appended to <PARAMS>.
+CLOCK_PARAM = '__clock'
+CLOCK_PAD   = '__clock_pad' # Keeps the pointer 8-byte aligned.
+MAX_REGISTER = 254 # R255 is RZ.
+# Stall after a group of inserted instructions: the largest latency among
+# them (MOV, CS2R, IMAD), so whatever reads their results later is safe.
+GROUP_STALL = 5
+
+def ScratchBase(program):
+  # First even register above everything the code and <REGS> use.
+  used = [reg for instr in program['instructions'] for reg in Resources(instr)['dst'] + Resources(instr)['src']
+          if reg < PRED_BASE]
+  for name, idx in program['regs'].items():
+    used.append(idx + program['alloc'].get(name, 1) - 1)
+  top = max(used, default=-1) + 1
+  return top + (top & 1)
+
+def FreeBarrier(instructions):
+  # A barrier the code does not set, else the last one (waiting longer is safe).
+  used = set()
+  for instr in instructions:
+    _, read_bar, write_bar, _, _ = instr['ctrl'].split(':')
+    used |= {int(bar) for bar in (read_bar, write_bar) if bar != '-'}
+  free = [bar for bar in barriers if bar not in used]
+  return free[-1] if free else barriers[-1]
+
+def Group(lines, pred=''):
+  '''
+  lines: [(text, wait mask, read barrier, write barrier, stall)], stall None
+         for 1 cycle (GROUP_STALL on the last line).
+  Return:
+    [instruction text] with control codes.
+  '''
+  out = []
+  for k, (text, wait, read_bar, write_bar, stall) in enumerate(lines):
+    if stall == None:
+      stall = GROUP_STALL if k + 1 == len(lines) else 1
+    out.append(f'{CtrlText("--:-:-:-:1", stall, wait, read_bar, write_bar)}    {pred}{text}')
+  return out
+
+def InstrumentClock(program, regions=None):
+  '''
+  Time labeled regions of a program (result of Parse) on the GPU.
+  A region runs from its label to the next region label or EXIT. Clock reads
+  (CS2R SR_CLOCKLO) are inserted right before each region label, on the fall
+  through path only: loops jumping back to a label stay in its region. Each
+  warp adds up the cycles spent in each region, and stores them before every
+  EXIT, on all paths into it (a label on the EXIT points at the stores), to a
+  hidden pointer parameter, appended to <PARAMS>:
+    uint32 deltas[warp][regions], warp = (ctaid.x * ntid.x + tid.x) / 32.
+  Scratch registers are taken above all registers of the code and <REGS>.
+  Inserted instructions get control codes of their own; the one before them
+  loses its .reuse flags. Run it after sched (which would move the probes).
+  regions: label names, default all labels.
+  Return:
+    report (str). program['clock'] gets {regions, param, offset, pad}.
+  '''
+  instructions = program['instructions']
+  labels = program['labels']
+  if regions == None:
+    regions = list(labels)
+  for name in regions:
+    if name not in labels:
+      raise Exception(f'Unknown clock region {name}, no such label.\n')
+  # In program order. Labels after the last instruction have no code.
+  regions = sorted((name for name in regions if labels[name] < len(instructions)), key=lambda name: labels[name])
+  if not regions:
+    return 'Clock: no regions to time.'
+  params = program['params']
+  if CLOCK_PARAM in params['name_list']:
+    raise Exception(f'Parameter name {CLOCK_PARAM} is reserved for clock instrumentation.\n')
+
+  base = ScratchBase(program)
+  last, now = base, base + 2 # Clock pairs. At EXIT: the address and the warp index.
+  acc = [base + 4 + k for k in range(len(regions))]
+  if acc[-1] > MAX_REGISTER:
+    raise Exception(f'Not enough registers for clock instrumentation: R{base} to R{acc[-1]} needed.\n')
+  bar = FreeBarrier(instructions)
+  offset = sum(params['size_list'])
+  pad = offset % 8 != 0
+  if pad:
+    params['name_list'].append(CLOCK_PAD)
+    params['size_list'].append(4)
+    offset += 4
+  params['name_list'].append(CLOCK_PARAM)
+  params['size_list'].append(8)
+
+  region_at = {} # instruction index => [region index]
+  for k, name in enumerate(regions):
+    region_at.setdefault(labels[name], []).append(k)
+
+  def Probe(k):
+    # Enter region k, leave region k-1.
+    if k == 0:
+      return Group([(f'CS2R R{last}, SR_CLOCKLO;', 0, None, None, None)])
+    return Group([(f'CS2R R{now}, SR_CLOCKLO;', 0, None, None, GROUP_STALL),
+                  (f'IADD3 R{acc[k-1]}, R{acc[k-1]}, -R{last}, R{now};', 0, None, None, None),
+                  (f'MOV R{last}, R{now};', 0, None, None, None)])
+
+  def Store(current, pred):
+    lines = []
+    if current != None:
+      lines += [(f'CS2R R{now}, SR_CLOCKLO;', 0, None, None, GROUP_STALL),
+                (f'IADD3 R{acc[current]}, R{acc[current]}, -R{last}, R{now};', 0, None, None, None)]
+    lines += [(f'S2R R{now}, SR_TID.X;', 0, None, bar, None),
+              (f'S2R R{now+1}, SR_CTAID.X;', 0, None, bar, None),
+              (f'IMAD R{now}, R{now+1}, c[0x0][0x0], R{now};', 1 << bar, None, None, GROUP_STALL),
+              (f'SHF.R.U32.HI R{now}, RZ, 0x5, R{now};', 0, None, None, GROUP_STALL),
+              (f'MOV R{last}, {ConstantText(offset)};', 0, None, None, None),
+              (f'MOV R{last+1}, {ConstantText(offset + 4)};', 0, None, None, GROUP_STALL),
+              (f'IMAD.WIDE.U32 R{last}, R{now}, {hex(4 * len(regions))}, R{last};', 0, None, None, GROUP_STALL)]
+    lines += [(f'STG.E [R{last}+{hex(4 * k)}], R{acc[k]};', 0, bar, None, 1) for k in range(len(regions))]
+    return Group(lines, pred)
+
+  new_instructions = []
+  new_labels = {}
+  index_of = {} # old index => new index
+  unreached = []
+  inserted = 0
+  current = None # Region of the code being copied, in program order.
+  def Insert(texts, file_line_num):
+    nonlocal inserted
+    for text in texts:
+      record = ProcessAsmLine(text, len(new_instructions))
+      record['file_line_num'] = file_line_num
+      new_instructions.append(record)
+    inserted += len(texts)
+
+  Insert(Group([(f'MOV R{reg}, RZ;', 0, None, None, None) for reg in acc] +
+               [(f'CS2R R{last}, SR_CLOCKLO;', 0, None, None, None)]), instructions[0]['file_line_num'])
+  def InsertBefore(texts, instr):
+    if new_instructions and '.reuse' in new_instructions[-1]['rest']:
+      new_instructions[-1] = SetReuse(new_instructions[-1], {})
+    Insert(texts, instr['file_line_num'])
+
+  for idx, instr in enumerate(instructions):
+    # Probes run on the fall-through path only: labels point after them.
+    probes = []
+    for k in region_at.get(idx, []):
+      if idx > 0 and Unconditional(instructions[idx - 1]):
+        unreached.append(regions[k])
+      probes += Probe(k)
+      current = k
+    if probes:
+      InsertBefore(probes, instr)
+    index_of[idx] = len(new_instructions)
+    # Stores run on every path into EXIT: labels point at them.
+    if instr['op'] == 'EXIT':
+      InsertBefore(Store(current, instr['pred'] or ''), instr)
+    record = dict(instr, line_num=len(new_instructions))
+    if instr['op'] == 'EXIT':
+      # Wait for the stores to read their registers: the warp may go on if EXIT is predicated.
+      wait, read_bar, write_bar, yield_, stall = instr['ctrl'].split(':')
+      wait = 0 if wait == '--' else int(wait)
+      record['ctrl'] = ':'.join(('%02d' % (wait | 1 << bar), read_bar, write_bar, yield_, stall))
+    new_instructions.append(record)
+  index_of[len(instructions)] = len(new_instructions)
+  for name, idx in labels.items():
+    new_labels[name] = index_of[idx]
+
+  program['instructions'] = new_instructions
+  program['labels'] = new_labels
+  program['clock'] = {'regions' : regions, 'param' : CLOCK_PARAM, 'offset' : offset, 'pad' : pad}
+  exits = sum(instr['op'] == 'EXIT' for instr in instructions)
+  report = (f'Clock: {len(regions)} regions ({", ".join(regions)}), {inserted} instructions added, '
+            f'R{base}-R{acc[-1]} and barrier {bar} used. Deltas stored at {exits} EXITs to parameter '
+            f'{CLOCK_PARAM} ({ConstantText(offset)}{", after a 4-byte " + CLOCK_PAD if pad else ""}): '
+            f'uint32 [warp][{len(regions)}], warp = (ctaid.x * ntid.x + tid.x) / 32.')
+  if unreached:
+    report += f'\nClock: regions not entered by falling through their label, not timed: {", ".join(unreached)}.'
+  return report
+
+def ClockPass(regions=None):
+  # InstrumentClock on the given labels, as a pass of BuildContext.
+  def InstrumentClockRegions(program):
+    return InstrumentClock(program, regions)
+  return InstrumentClockRegions
@@ -1,8 +1,23 @@
 from turas import Assemble
 from ELF import *
-from struct import unpack, pack
+from struct import unpack, pack, Struct
+import mmap
 from functools import reduce
 
+SHT_NOBITS = 8
+
+
+def PackText(codes):
+  '''
+  Return:
+    bytearray of the .text section of 128-bit codes.
+  '''
+  data = bytearray(len(codes) * 16)
+  pack_code = Struct('<QQ').pack_into
+  for i, code in enumerate(codes):
+    pack_code(data, i * 16, (code >> 64) & 0xffffffffffffffff, 
+                            (code)       & 0xffffffffffffffff)
+  return data
 
 class Cubin():
   def __init__(self, arch=70):
@@ -30,8 +45,13 @@ class Cubin():
     self.kern_syms.append(Symbol())
     self.sym_idx += 1
 
+    # Kernels to be laid out in Finalize(). [(kernel, name, params)]
+    self.kernels = []
+    self.kernel_names = set()
+
     self.arch = arch
     self.Init(arch)
+    self.num_fixed_sections = len(self.sections)
 
   def Init(self, arch):
     '''
@@ -74,21 +94,23 @@ class Cubin():
     self.p_nobits   = Program(1, 6)
     self.programs.extend([self.p_hdr, self.p_progbits, self.p_nobits])
 
-  def GenerateNvInfo(self, section, name):
+  def GenerateNvInfo(self, section):
     data = b''
     # Entry size: 12. (bbhll) (BB, 2B, 4B, 4B)
-    # EIATTR_MAX_STACK_SIZE (0x0423)
-    kernel_symtab_idx = self.sym_idx_dict[name]  # TODO: Why?
-    MAX_STACK_SIZE = 0
-    data += pack('<bbhll', 0x4, 0x23, 0x8, kernel_symtab_idx, MAX_STACK_SIZE)
-
-    # EIATTR_MIN_STACK_SIZE (0x0412)
-    MIN_STACK_SIZE = 0
-    data += pack('<bbhll', 0x4, 0x12, 0x8, kernel_symtab_idx, MAX_STACK_SIZE)
-
-    # EIATTR_FRAME_SIZE (0x0411)
-    FRAME_SIZE = 0
-    data += pack('<bbhll', 0x4, 0x11, 0x8, kernel_symtab_idx, FRAME_SIZE)
+    # Three entries per kernel.
+    for kernel, name, params in self.kernels:
+      # EIATTR_MAX_STACK_SIZE (0x0423)
+      kernel_symtab_idx = self.sym_idx_dict[name]  # TODO: Why?
+      MAX_STACK_SIZE = 0
+      data += pack('<bbhll', 0x4, 0x23, 0x8, kernel_symtab_idx, MAX_STACK_SIZE)
+
+      # EIATTR_MIN_STACK_SIZE (0x0412)
+      MIN_STACK_SIZE = 0
+      data += pack('<bbhll', 0x4, 0x12, 0x8, kernel_symtab_idx, MAX_STACK_SIZE)
+
+      # EIATTR_FRAME_SIZE (0x0411)
+      FRAME_SIZE = 0
+      data += pack('<bbhll', 0x4, 0x11, 0x8, kernel_symtab_idx, FRAME_SIZE)
     
     # Update section 
     section.data = data
@@ -155,11 +177,7 @@ class Cubin():
     section.sh_align = 4
     
   def GenerateText(self, kernel, section, name):
-    data = b''
-    for code in kernel['KernelData']:
-      data += pack('<QQ', (code >> 64) & 0xffffffffffffffff, 
-                          (code)       & 0xffffffffffffffff)
-
+    data = PackText(kernel['KernelData'])
     section.data = data
 
     # Other flags
@@ -172,31 +190,29 @@ class Cubin():
     section.sh_align = 128
     
 
+  def GenerateShared(self, kernel, section, name):
+    # Static shared memory. Only the size is in the file.
+    section.name     = b'.nv.shared.' + name
+    section.sh_type  = SHT_NOBITS
+    section.sh_flags = 3 # SHF_WRITE | SHF_ALLOC
+    section.sh_size  = kernel['SmemSize']
+    section.sh_info  = self.sec_idx_dict[b'.text.'+name]
+    section.sh_align = 16
+
   def UpdateShstrtab(self):
-    shstr = b''
     shstr_idx = 0
     for sec in self.sections:
       sec.sh_name = shstr_idx
-      shstr += sec.name
-      shstr += b'\x00'
       shstr_idx += len(sec.name) + 1
-    self.shstrtab.data = shstr
+    self.shstrtab.data = b''.join(sec.name + b'\x00' for sec in self.sections)
     self.shstrtab.sh_size = shstr_idx
 
   def UpdateStrtab(self):
-    strtab = b''
     strtab_idx = 0
-    for sym in self.kern_syms:
-      sym.st_name = strtab_idx
-      strtab += sym.name
-      strtab += b'\x00'
-      strtab_idx += len(sym.name) + 1
-    for sym in self.name_syms:
+    for sym in self.kern_syms + self.name_syms:
       sym.st_name = strtab_idx
-      strtab += sym.name
-      strtab += b'\x00'
       strtab_idx += len(sym.name) + 1
-    self.strtab.data = strtab
+    self.strtab.data = b''.join(sym.name + b'\x00' for sym in self.kern_syms + self.name_syms)
     self.strtab.sh_size = strtab_idx
 
   def UpdateOffset(self):
@@ -210,7 +226,8 @@ class Cubin():
     current_offset += Header.HEADER_SIZE
     for sec in self.sections:
       sec.sh_offset = current_offset
-      current_offset += sec.sh_size
+      if sec.sh_type != SHT_NOBITS: # No data in the file.
+        current_offset += sec.sh_size
     self.header.shoff = current_offset
     self.header.shnum = len(self.sections)
     current_offset += Section.HEADER_SIZE * len(self.sections)
@@ -220,100 +237,121 @@ class Cubin():
 
     self.header.shstrndx = self.sec_idx_dict[b'.shstrtab']
 
+  def AddSection(self, section, name):
+    self.sections.append(section)
+    self.sec_idx_dict[name] = self.sec_idx
+    self.sec_idx += 1
+
+  def AddSymbol(self, symbol, syms):
+    syms.append(symbol)
+    self.sym_idx_dict[symbol.name] = self.sym_idx
+    self.sym_idx += 1
 
-  # TODO: name of the kernel?
   def AddKernel(self, kernel, name, params):
-    # Only support *ONE* kernel per cubin file.
     '''
-    For each kernel:
+    Record a kernel. Sections and symbols are laid out once, in Finalize().
+    Any number of kernels can be added to one cubin.
+    '''
+    if name in self.kernel_names:
+      raise Exception(f'Kernel {name} already added.\n')
+    self.kernel_names.add(name)
+    self.kernels.append((kernel, name, params))
+
+  def Finalize(self):
+    '''
+    For all kernels:
       1. Create sections and update index
+         .nv.info, then .nv.info.{name}, .nv.constant0.{name}, .text.{name}
+         of every kernel, grouped by kind so that constant and text sections
+         form one contiguous PROGBITS segment.
       2. Create symbols and update index
-      3. Add .text.{name}
-      4. Add .nv.shared.{name} (optional)
-      5. Add entries in symbol table
-      6. Add 3 entry to .nv.info.
+         Local section symbols of every kernel first, then function symbols.
+      3. Generate section data
+      4. Build shstrtab/strtab/symtab
+      5. Update offsets and programs
     '''
+    if len(self.kernels) == 0:
+      raise Exception('No kernel in cubin.\n')
+    # Start from the fixed sections. Finalize() may be called again.
+    self.sections = self.sections[:self.num_fixed_sections]
+    self.sec_idx  = self.num_fixed_sections
+    self.kern_syms = self.kern_syms[:1]
+    self.name_syms = []
+    self.sym_idx = 1
+    self.sec_idx_dict = {key : idx for key, idx in self.sec_idx_dict.items() if idx < self.num_fixed_sections}
+    self.sym_idx_dict = {}
+
     #####################################
     # Add sections (record section index)
     #####################################
-    _nv_info         = Section()
-    self.sections.append(_nv_info)
-    self.sec_idx_dict[b'.nv.info'] = self.sec_idx
-    self.sec_idx += 1
-
-    _nv_info_kernel  = Section()
-    self.sections.append(_nv_info_kernel)
-    self.sec_idx_dict[b'.nv.info.'+name] = self.sec_idx
-    self.sec_idx += 1
-
-    _nv_const_kernel = Section()
-    self.sections.append(_nv_const_kernel)
-    self.sec_idx_dict[b'.nv.constant0.'+name] = self.sec_idx
-    self.sec_idx += 1
-
-    _text_kernel     = Section()
-    self.sections.append(_text_kernel)
-    self.sec_idx_dict[b'.text.'+name] = self.sec_idx
-    self.sec_idx += 1
-
-    if kernel['SmemSize'] > 0:
-      _nv_smem_kernel = Section()
-      self.sec_idx_dict[b'.nv.shared.'+name] = self.sec_idx
-      self.sec_idx += 1 
+    _nv_info = Section()
+    self.AddSection(_nv_info, b'.nv.info')
+    info_secs  = []
+    const_secs = []
+    text_secs  = []
+    for kernel, name, params in self.kernels:
+      info_secs.append(Section())
+      self.AddSection(info_secs[-1], b'.nv.info.'+name)
+    for kernel, name, params in self.kernels:
+      const_secs.append(Section())
+      self.AddSection(const_secs[-1], b'.nv.constant0.'+name)
+    for kernel, name, params in self.kernels:
+      text_secs.append(Section())
+      self.AddSection(text_secs[-1], b'.text.'+name)
+    smem_secs  = {}
+    for kernel, name, params in self.kernels:
+      if kernel['SmemSize'] > 0:
+        smem_secs[name] = Section()
+        self.AddSection(smem_secs[name], b'.nv.shared.'+name)
 
     ###################
     # Add symbol entry.
     ###################
-    text_sym_entry = Symbol()
-    text_sym_entry.name    = b'.text.' + name
-    text_sym_entry.st_info = 3 # Bind local
-    text_sym_entry.st_shndx = self.sec_idx_dict[b'.text.' + name]
-    self.kern_syms.append(text_sym_entry)
-    self.sym_idx_dict[b'.text.' + name] = self.sym_idx
-    self.sym_idx += 1
-
-    if kernel['SmemSize'] > 0:
-      smem_sym_entry = Symbol()
-      smem_sym_entry.name    = b'.nv.shared.' + name
-      smem_sym_entry.st_info = 3
-      smem_sym_entry.st_shndx = self.sec_idx_dict[b'.nv.shared.' + name]
-      self.kern_syms.append(smem_sym_entry)
-      self.sym_idx_dict[b'.nv.shared.' + name] = self.sym_idx
-      self.sym_idx += 1
-    
-    const_sym_entry = Symbol()
-    const_sym_entry.name    = b'.nv.constant0.' + name
-    const_sym_entry.st_info = 3
-    const_sym_entry.st_shndx = self.sec_idx_dict[b'.nv.constant0.' + name]
-    self.kern_syms.append(const_sym_entry)
-    self.sym_idx_dict[b'.nv.constant0.' + name] = self.sym_idx
-    self.sym_idx += 1
-
-    # Add name symbol
-    name_sym_entry = Symbol()
-    name_sym_entry.name     = name
-    name_sym_entry.st_info  = 0x12 # FUNC
-    name_sym_entry.st_other = 0x10 
-    name_sym_entry.st_size  = len(kernel['KernelData'] * 16)
-    name_sym_entry.st_shndx = self.sec_idx_dict[b'.text.' + name]
-    self.name_syms.append(name_sym_entry)
-    self.sym_idx_dict[name] = self.sym_idx
-    self.sym_idx += 1
+    for kernel, name, params in self.kernels:
+      text_sym_entry = Symbol()
+      text_sym_entry.name    = b'.text.' + name
+      text_sym_entry.st_info = 3 # Bind local
+      text_sym_entry.st_shndx = self.sec_idx_dict[b'.text.' + name]
+      self.AddSymbol(text_sym_entry, self.kern_syms)
+
+      if kernel['SmemSize'] > 0:
+        smem_sym_entry = Symbol()
+        smem_sym_entry.name    = b'.nv.shared.' + name
+        smem_sym_entry.st_info = 3
+        smem_sym_entry.st_shndx = self.sec_idx_dict[b'.nv.shared.' + name]
+        self.AddSymbol(smem_sym_entry, self.kern_syms)
+
+      const_sym_entry = Symbol()
+      const_sym_entry.name    = b'.nv.constant0.' + name
+      const_sym_entry.st_info = 3
+      const_sym_entry.st_shndx = self.sec_idx_dict[b'.nv.constant0.' + name]
+      self.AddSymbol(const_sym_entry, self.kern_syms)
+
+    for kernel, name, params in self.kernels:
+      # Add name symbol
+      name_sym_entry = Symbol()
+      name_sym_entry.name     = name
+      name_sym_entry.st_info  = 0x12 # FUNC
+      name_sym_entry.st_other = 0x10 
+      name_sym_entry.st_size  = len(kernel['KernelData']) * 16
+      name_sym_entry.st_shndx = self.sec_idx_dict[b'.text.' + name]
+      self.AddSymbol(name_sym_entry, self.name_syms)
 
     ###############################
     # Generate section data (flags)
     ###############################
     # Add .nv.info
-    self.GenerateNvInfo(_nv_info, name)
-    # Add .nv.info.name
-    self.GenerateNvInfoName(kernel, _nv_info_kernel, name, params)
-    # Add .nv.constant0.name
-    self.GenerateNvConst(kernel, _nv_const_kernel, name, params)
-    # Add .text.name
-    self.GenerateText(kernel, _text_kernel, name)
-    # Add .nv.shared.name
-    if kernel['SmemSize'] > 0:
-      pass
+    self.GenerateNvInfo(_nv_info)
+    for i, (kernel, name, params) in enumerate(self.kernels):
+      # Add .nv.info.name
+      self.GenerateNvInfoName(kernel, info_secs[i], name, params)
+      # Add .nv.constant0.name
+      self.GenerateNvConst(kernel, const_secs[i], name, params)
+      # Add .text.name
+      self.GenerateText(kernel, text_secs[i], name)
+      # Add .nv.shared.name
+      if kernel['SmemSize'] > 0:
+        self.GenerateShared(kernel, smem_secs[name], name)
 
     ########################
     # Update shstrtab/strtab
@@ -324,13 +362,15 @@ class Cubin():
     ###############
     # Update symtab
     ###############
-    for sym in self.kern_syms:
-      self.symtab.data += sym.PackEntry()
     for sym in self.name_syms:
       sym.st_size = self.sections[sym.st_shndx].sh_size
-      self.symtab.data += sym.PackEntry()
-    self.symtab.sh_size = len(self.symtab.data)
-    self.symtab.sh_info = self.sec_idx_dict[b'.strtab'] + 1
+    symtab = bytearray(Symbol.ENTRY_SIZE * (len(self.kern_syms) + len(self.name_syms)))
+    for i, sym in enumerate(self.kern_syms + self.name_syms):
+      sym.PackEntryInto(symtab, i * Symbol.ENTRY_SIZE)
+    self.symtab.data = symtab
+    self.symtab.sh_size = len(symtab)
+    # Index of the first non-local symbol.
+    self.symtab.sh_info = len(self.kern_syms)
 
 
     #######################
@@ -338,28 +378,194 @@ class Cubin():
     #######################
     self.UpdateOffset()
     # Update program offset
+    # Constant and text sections are contiguous.
     self.p_hdr.offset = self.header.phoff
-    self.p_progbits.offset = self.sections[self.sec_idx_dict[b'.nv.constant0.'+name]].sh_offset
-    self.p_progbits.filesz = self.sections[self.sec_idx_dict[b'.nv.constant0.'+name]].sh_size + \
-      self.sections[self.sec_idx_dict[b'.text.'+name]].sh_size
+    self.p_progbits.offset = const_secs[0].sh_offset
+    self.p_progbits.filesz = sum(sec.sh_size for sec in const_secs + text_secs)
     self.p_progbits.memsz  = self.p_progbits.filesz
+    # Shared memory sections form the NOBITS segment.
+    if smem_secs:
+      first = min(smem_secs.values(), key=lambda sec: sec.sh_offset)
+      self.p_nobits.offset = first.sh_offset
+      self.p_nobits.filesz = 0
+      self.p_nobits.memsz  = sum(sec.sh_size for sec in smem_secs.values())
 
 
-  def Write(self, path):
+  def Serialize(self):
     '''
-    Write data to file.
+    Lay out all kernels and pack the whole file into one buffer.
     Order: 
        1. Header.
        2. shstrtab, strtab, symtab, .nv.info.
        3. info_secs, const_secs, text_secs, smem_secs
        4. shdrs.
        5. phdrs.
+    Return:
+      bytearray of the cubin.
+    '''
+    self.Finalize()
+    size = self.header.phoff + Program.PHDR_SIZE * len(self.programs)
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    self.header.PackHeaderInto(buffer, 0)
+    for sec in self.sections:
+      view[sec.sh_offset:sec.sh_offset + len(sec.data)] = sec.data
+    for i, sec in enumerate(self.sections):
+      sec.PackHeaderInto(buffer, self.header.shoff + i * Section.HEADER_SIZE)
+    for i, pro in enumerate(self.programs):
+      pro.PackHeaderInto(buffer, self.header.phoff + i * Program.PHDR_SIZE)
+    view.release()
+    return buffer
+
+  def Write(self, path):
+    '''
+    Write data to file, in one go.
     '''
+    buffer = self.Serialize()
     with open(path, 'wb') as file:
-      file.write(self.header.PackHeader())
-      for sec in self.sections:
-        file.write(sec.data)
-      for sec in self.sections:
-        file.write(sec.PackHeader())
-      for pro in self.programs:
-        file.write(pro.PackHeader())
\ No newline at end of file
+      file.write(buffer)
+
+
+class CubinReader():
+  '''
+  Read-only view of a cubin file.
+  The file is memory mapped; only the header and the section table are parsed
+  up front. Section contents are memoryviews into the map, sliced on access,
+  so nothing is copied unless the caller copies it.
+  Usage:
+    with CubinReader(path) as cubin:
+      text = cubin.Text('kern')
+  Views handed out are invalid once the reader is closed.
+  writable: map the file for writing. Views can then be assigned to, in place.
+  '''
+  SHT_NOBITS = SHT_NOBITS
+
+  def __init__(self, path, writable=False):
+    self.path = path
+    self.file = open(path, 'r+b' if writable else 'rb')
+    try:
+      self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+    except ValueError: # Empty file.
+      self.file.close()
+      raise Exception(f'Not an ELF file: {path}\n')
+    self.buffer = memoryview(self.map)
+    self.header = Header()
+    self.header.unpack_binary(self.buffer)
+    self.arch = self.header.flags & 0xff
+
+    self.sections = []
+    for i in range(self.header.shnum):
+      offset = self.header.shoff + i * self.header.shentsize
+      section = Section()
+      section.unpack_binary(self.buffer[offset:offset + Section.HEADER_SIZE])
+      self.sections.append(section)
+    self.programs = []
+    for i in range(self.header.phnum):
+      offset = self.header.phoff + i * self.header.phentsize
+      program = Program(0, 0)
+      program.unpack_binary(self.buffer[offset:offset + Program.PHDR_SIZE])
+      self.programs.append(program)
+    shstrtab = self.sections[self.header.shstrndx]
+    self.sec_idx_dict = {}
+    for i, section in enumerate(self.sections):
+      section.name = self.String(shstrtab, section.sh_name)
+      self.sec_idx_dict[section.name] = i
+    self.symbols = None
+
+  def String(self, strtab, offset):
+    # Null terminated string at offset of a string table section.
+    start = strtab.sh_offset + offset
+    end = self.map.find(b'\0', start, strtab.sh_offset + strtab.sh_size)
+    return self.map[start:end if end >= 0 else strtab.sh_offset + strtab.sh_size]
+
+  def close(self):
+    if self.map.closed:
+      return
+    self.buffer.release()
+    try:
+      self.map.close()
+    except BufferError:
+      pass # Views are still held by the caller. The map goes with them.
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def Section(self, name):
+    '''
+    Return:
+      Section (header only) named name (str or bytes), or None.
+    '''
+    if isinstance(name, str):
+      name = name.encode()
+    idx = self.sec_idx_dict.get(name)
+    return None if idx == None else self.sections[idx]
+
+  def Data(self, section):
+    '''
+    Return:
+      memoryview of the contents of section (a Section or its name), or None.
+      NOBITS sections (.nv.shared.*) have no contents in the file.
+    '''
+    if not isinstance(section, Section):
+      section = self.Section(section)
+      if section == None:
+        return None
+    if section.sh_type == CubinReader.SHT_NOBITS:
+      return self.buffer[0:0]
+    return self.buffer[section.sh_offset:section.sh_offset + section.sh_size]
+
+  def Kernels(self):
+    '''
+    Return:
+      names (str) of all kernels, in section order.
+    '''
+    return [section.name[len(b'.text.'):].decode() for section in self.sections
+            if section.name.startswith(b'.text.')]
+
+  def Text(self, name):
+    return self.Data(b'.text.' + name.encode())
+
+  def NvInfo(self, name):
+    return self.Data(b'.nv.info.' + name.encode())
+
+  def Constant(self, name):
+    return self.Data(b'.nv.constant0.' + name.encode())
+
+  def Symbols(self):
+    '''
+    Parse .symtab on first use.
+    Return:
+      list of Symbol, with names.
+    '''
+    if self.symbols != None:
+      return self.symbols
+    symtab = self.Section(b'.symtab')
+    self.symbols = []
+    if symtab == None:
+      return self.symbols
+    strtab = self.sections[symtab.sh_link]
+    data = self.Data(symtab)
+    for offset in range(0, len(data), Symbol.ENTRY_SIZE):
+      symbol = Symbol()
+      symbol.unpack_binary(data[offset:offset + Symbol.ENTRY_SIZE])
+      symbol.name = self.String(strtab, symbol.st_name)
+      self.symbols.append(symbol)
+    return self.symbols
+
+  def DiffSections(self, other):
+    '''
+    Compare with another reader, section by section (by name).
+    Contents are compared through the maps, without reading them into memory.
+    Return:
+      sorted names (bytes) of sections that differ or exist in only one of them.
+    '''
+    diff = set(self.sec_idx_dict) ^ set(other.sec_idx_dict)
+    for name in self.sec_idx_dict.keys() & other.sec_idx_dict.keys():
+      mine, theirs = self.Section(name), other.Section(name)
+      if (mine.sh_type, mine.sh_size) != (theirs.sh_type, theirs.sh_size) or self.Data(mine) != other.Data(theirs):
+        diff.add(name)
+    return sorted(diff)
@@ -0,0 +1,413 @@
+import re
+import time
+import random
+from string import Formatter
+from decimal import Decimal
+from multiprocessing import Pool
+from struct import pack, unpack, iter_unpack
+from grammar import grammar, flags, operands, icr_dict, ProcessAsmLine
+from turas import EncodeInstr
+from cubin import CubinReader
+
+MASK128 = (1 << 128) - 1
+
+# Syntax of each grammar alternative, in the same order as grammar[op].
+# Slots are filled from the decoded bits, see RenderSlot.
+templates = {
+  'MOV'  : ['MOV {rd}, {icrs1};'],
+  'LDG'  : ['LDG{E}{U}{type}{cache}{strong}{scope} {ldgp}{rd}, {addr24};'],
+  'STG'  : ['STG{E}{U}{type}{cache}{scope}{strong} {addr24}, {rs1};'],
+  'LDS'  : ['LDS{E}{U}{type}{cache} {rd}, {addr24};'],
+  'STS'  : ['STS{E}{U}{type}{cache} {addr24}, {rs1};'],
+  'IADD3': ['IADD3{x} {rd}, {pd0i}{pd1i}{rs0}, {icrs1}, {rs2}{ps0i}{ps1i};',
+            'IADD3{x} {rd}, {pd0i}{pd1i}{rs0}, {rs2}, {ic2}{ps0i}{ps1i};'],
+  'IMUL' : ['IMUL;'],
+  'IMAD' : ['IMAD{type} {rd}, {pd0i}{rs0}, {icrs1}, {rs2}{ps0i};',
+            'IMAD{type} {rd}, {pd0i}{rs0}, {rs2}, {ic2}{ps0i};',
+            'IMAD.WIDE{type} {rd}, {pd0i}{rs0}, {icrs1}, {rs2}{ps0i};',
+            'IMAD.WIDE{type} {rd}, {pd0i}{rs0}, {rs2}, {ic2}{ps0i};',
+            'IMAD.HI{type} {rd}, {pd0i}{rs0}, {icrs1}, {rs2};'],
+  'ISETP': ['ISETP{cmp}{type}{boolOp} {pd0}, {pd1}, {rs0}, {icrs1}, {ps0};'],
+  'LOP3' : ['LOP3.LUT {pd0i}{rd}, {rs0}, {icrs1}, {rs2}, {isw8}{ps0opt};'],
+  'SHF'  : ['SHF{lr}{type}{hi} {rd}, {rs0}, {icrs1}, {rs2};'],
+  'FFMA' : ['FFMA {rd}, {rs0}, {fcrs1}, {rs2};',
+            'FFMA {rd}, {rs0}, {rs2}, {fc2};'],
+  'FADD' : ['FADD {rd}, {rs0}, {fcrs1add};'],
+  'FMUL' : ['FMUL {rd}, {rs0}, {fcrs1};'],
+  'BRA'  : ['BRA {cpc}{is1};'],
+  'EXIT' : ['EXIT{cps};'],
+  'CS2R' : ['CS2R {rd}, {sr};'],
+  'S2R'  : ['S2R {rd}, {sr};'],
+  'NOP'  : ['NOP;'],
+  'BAR'  : ['BAR{bar} {ibar};'],
+  'P2R'  : ['P2R {rd}, PR, {is1};'],
+  'R2P'  : ['R2P PR, {rs0}, {is1};']
+}
+
+for op in grammar:
+  if len(templates.get(op, [])) != len(grammar[op]):
+    raise Exception(f'Templates of {op} do not match its grammar.\n')
+
+# Composite operands: (immediate/float, constant, register) alternatives, as in grammar.
+composites = {
+  'icrs1'    : ('is1', 'cs1', 'rs1'),
+  'fcrs1'    : ('fs1', 'cs1', 'rs1'),
+  'fcrs1add' : ('fs1add', 'cs1add', 'rs1'),
+  'ic2'      : ('is2', 'cs2', None),
+  'fc2'      : ('fs2', 'cs2', None)
+}
+
+def OperandKind(key):
+  if key[0] == 'r':
+    return 'R'
+  if key[0] == 'c' and key != 'cp':
+    return 'C'
+  if key[0] == 'f':
+    return 'F'
+  if key[0] == 'i':
+    return 'I'
+  return 'P'
+
+# Bit position (and mask) of every operand, probed from the operands table.
+field_pos = {}
+for key, encode in operands.items():
+  if key in ('nocp', 'noldgp'):
+    continue
+  kind = OperandKind(key)
+  if kind == 'R':
+    field_pos[key] = (kind, encode('R1').bit_length() - 1, 0xff)
+  elif kind == 'P':
+    field_pos[key] = (kind, encode('P1').bit_length() - 1, 0xf)
+  elif kind == 'I':
+    shift = encode('1').bit_length() - 1
+    field_pos[key] = (kind, shift, encode(hex((1 << 64) - 1)) >> shift)
+  elif kind == 'C':
+    field_pos[key] = (kind, encode('1').bit_length() - 1, 0xffff)
+  else:
+    field_pos[key] = (kind, encode('2.0').bit_length() - 31, 0xffffffff)
+
+def FlagMask(values):
+  # Contiguous bits covering every value of a flag group.
+  nonzero = [value for value in values if value != 0]
+  if not nonzero:
+    return 0
+  low = min((value & -value).bit_length() - 1 for value in nonzero)
+  high = max(value.bit_length() for value in nonzero)
+  return ((1 << high) - 1) & ~((1 << low) - 1)
+
+# Flag groups rendered by their own slots.
+slot_flags = {'nopd0', 'nopd1', 'nops0', 'nops1', 'rs0neg', 'rs1neg', 'is1neg', 'pr'}
+# Flags of all instructions. GenCode ignores those an instruction has no table for.
+flag_names = {name for group in flags.values() for name in group}
+
+# Opcode-indexed decode table.
+# 12-bit code (with icr bits) => [(op, gram, icr key or None, template, slot names)]
+decode_table = {}
+for op, grams in grammar.items():
+  for gram, template in zip(grams, templates[op]):
+    slots = [name for _, name, _, _ in Formatter().parse(template) if name]
+    keys = [key for key in icr_dict if key in gram['fields']]
+    if 'rs1' in gram['fields'] or not keys:
+      keys.append(None)
+    flag_masks = {name : FlagMask(group.values()) for name, group in flags[op].items()
+                  if name in gram['fields'] and name not in slot_flags}
+    for key in keys:
+      opcode = gram['code'] if key == None else (gram['code'] & ~0x200) | (icr_dict[key] << 8)
+      decode_table.setdefault(opcode, []).append((op, gram, key, template, slots, flag_masks))
+
+def FloatText(bits):
+  # Shortest decimal (no exponent, the grammar does not take one) that packs back to bits.
+  value = unpack('<f', pack('<I', bits))[0]
+  for digits in range(1, 10):
+    text = f'{value:.{digits}g}'
+    if unpack('<I', pack('<f', float(text)))[0] == bits:
+      break
+  text = format(Decimal(text), 'f')
+  return text
+
+def DecodeOperand(code, key):
+  kind, shift, mask = field_pos[key]
+  value = (code >> shift) & mask
+  if kind == 'R':
+    return 'RZ' if value == 0xff else f'R{value}'
+  if kind == 'P':
+    return ('!' if value & 0x8 else '') + ('PT' if value & 0x7 == 7 else f'P{value & 0x7}')
+  if kind == 'I':
+    return hex(value)
+  if kind == 'C':
+    return 'c[0x0][' + hex(value) + ']'
+  return FloatText(value)
+
+def DecodeDstPred(code, key):
+  # Destination predicates are 3 bits wide.
+  value = (code >> field_pos[key][1]) & 0x7
+  return 'PT' if value == 7 else f'P{value}'
+
+def DecodeCtrl(code):
+  ctrl = (code >> 41) & 0x7fffff
+  stall = ctrl & 0xf
+  yield_ = (ctrl >> 4) & 0x1
+  wrtdb = (ctrl >> 5) & 0x7
+  readb = (ctrl >> 8) & 0x7
+  watdb = (ctrl >> 11) & 0x3f
+  return '%s:%s:%s:%s:%x' % ('--' if watdb == 0 else '%02d' % watdb,
+                             '-' if readb == 7 else readb,
+                             '-' if wrtdb == 7 else wrtdb,
+                             'Y' if yield_ == 0 else '-', stall)
+
+def DecodePred(code):
+  pred = (code >> 76) & 0xf
+  if pred == 7:
+    return ''
+  return '@' + ('!' if pred & 0x8 else '') + f'P{pred & 0x7} '
+
+def RenderSlot(name, code, op, icr, flag_text, target):
+  flag = flags[op]
+  if name in flag_text:
+    return flag_text[name]
+  if name in flag_names:
+    return ''
+  if name in composites:
+    imm, const, reg = composites[name]
+    if icr == None:
+      return RenderSlot(reg, code, op, icr, flag_text, target)
+    return DecodeOperand(code, const if icr_dict[icr] == icr_dict[const] else imm)
+  if name in ('rd', 'rs0', 'rs1', 'rs2'):
+    text = DecodeOperand(code, name)
+    neg = name + 'neg'
+    if neg in flag and code & flag[neg]['-'] == flag[neg]['-']:
+      text = '-' + text
+    reuse = {'rs0' : 58, 'rs1' : 59, 'rs2' : 60}.get(name)
+    if reuse and code >> reuse & 1:
+      text += '.reuse'
+    return text
+  if name == 'addr24':
+    offset = (code >> field_pos['is0w24'][1]) & field_pos['is0w24'][2]
+    base = DecodeOperand(code, 'rs0')
+    return f'[{base}]' if offset == 0 else f'[{base}+{hex(offset)}]'
+  if name in ('pd0', 'pd1'):
+    return DecodeDstPred(code, name)
+  if name == 'ps0':
+    return DecodeOperand(code, name)
+  if name == 'pd0i':
+    pd0 = DecodeDstPred(code, 'pd0')
+    pd1 = RenderSlot('pd1i', code, op, icr, flag_text, target)
+    # An explicit pd1 needs an explicit pd0 before it.
+    return '' if pd0 == 'PT' and pd1 == '' else pd0 + ', '
+  if name == 'pd1i':
+    if 'nopd1' not in flag:
+      return ''
+    pd1 = DecodeDstPred(code, 'pd1')
+    return '' if pd1 == 'PT' else pd1 + ', '
+  if name == 'ps0i':
+    ps0 = (code >> 23) & 0xf
+    ps1 = RenderSlot('ps1i', code, op, icr, flag_text, target)
+    return '' if ps0 == 0xf and ps1 == '' else ', ' + DecodeOperand(code, 'ps0')
+  if name == 'ps1i':
+    # ps1 is not encoded beyond its default.
+    if 'nops1' not in flag:
+      return ''
+    return '' if (code >> 13) & 0xf == 0xf else ', P0'
+  if name == 'ps0opt':
+    return '' if (code >> 23) & 0xf == 0 else ', ' + DecodeOperand(code, 'ps0')
+  if name == 'ldgp':
+    ldgp = DecodeOperand(code, 'ldgp')
+    return '' if ldgp == 'PT' else ldgp + ', '
+  if name in ('cpc', 'cps'):
+    cp = DecodeOperand(code, 'cp')
+    if cp == 'PT':
+      return ''
+    return cp + ',' if name == 'cpc' else ' ' + cp
+  if name == 'is1' and 'is1neg' in flag:
+    # BRA: signed offset.
+    value = (code >> 96) & 0xffffffff
+    if code & flag['is1neg']['-'] == flag['is1neg']['-']:
+      return target if target else '-' + hex((1 << 32) - value if value else 0)
+    return target if target else hex(value)
+  return DecodeOperand(code, name)
+
+def Disassemble(code, target=None):
+  '''
+  Decode one 128-bit instruction.
+  target: label to print for a BRA instead of its offset.
+  Return:
+    'ctrl    @pred OP operands;', or None if the code is not in the grammar.
+  '''
+  code &= MASK128
+  entries = decode_table.get((code >> 64) & 0xfff)
+  if entries == None:
+    return None
+  for op, gram, icr, template, slots, flag_masks in entries:
+    flag_text = {}
+    bits = code
+    for name, mask in flag_masks.items():
+      group = flags[op][name]
+      value = code & mask
+      if 'DEFAULT' in group and group['DEFAULT'] == value:
+        text = ''
+      else:
+        text = next((text for text, v in group.items() if v == value and text != 'DEFAULT'), None)
+        if text == None:
+          text = '' if value == 0 else '?'
+      flag_text[name] = text
+      bits &= ~mask # Flags may share bits with operands (LDG cache, ldgp).
+    values = {name : RenderSlot(name, bits, op, icr, flag_text, target) for name in slots}
+    return DecodeCtrl(code) + '    ' + DecodePred(code) + template.format(**values)
+  return None
+
+def BranchOffset(code):
+  value = (code >> 96) & 0xffffffff
+  return value - (1 << 32) if value & 0x80000000 else value
+
+def DisassembleText(data):
+  '''
+  Disassemble a .text section (bytes). Branch targets get labels.
+  Return:
+    list of lines.
+  '''
+  codes = [high << 64 | low for high, low in iter_unpack('<QQ', data[:len(data) - len(data) % 16])]
+  targets = {}
+  for i, code in enumerate(codes):
+    if (code >> 64) & 0xfff == grammar['BRA'][0]['code']:
+      target = i + 1 + BranchOffset(code) // 16
+      targets.setdefault(target, f'L_{target*16:04x}')
+  lines = []
+  for i, code in enumerate(codes):
+    if i in targets:
+      lines.append(targets[i] + ':')
+    target = None
+    if (code >> 64) & 0xfff == grammar['BRA'][0]['code']:
+      target = targets[i + 1 + BranchOffset(code) // 16]
+    line = Disassemble(code, target)
+    if line == None:
+      line = f'# {i*16:04x}: unknown 0x{code:032x}'
+    lines.append(line)
+  return lines
+
+def DisassembleCubin(path):
+  lines = []
+  with CubinReader(path) as cubin:
+    for name in cubin.Kernels():
+      text = cubin.Text(name)
+      lines.append(f'# Kernel {name}: {len(text)//16} instructions')
+      lines += DisassembleText(text)
+      lines.append('')
+      text.release()
+  return lines
+
+###################
+# Round trip check
+###################
+def RandomOperand(rng, key):
+  kind, shift, mask = field_pos[key]
+  if kind == 'R':
+    return 'RZ' if rng.random() < 0.05 else f'R{rng.randrange(255)}'
+  if kind == 'P':
+    return rng.choice(('', '!')) + rng.choice(('P0', 'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'PT'))
+  if kind == 'I':
+    return hex(rng.randrange(min(mask + 1, 15) if key == 'ibar' else mask + 1))
+  if kind == 'C':
+    return 'c[0x0][' + hex(rng.randrange(0x4000) * 4) + ']'
+  while True:
+    bits = rng.getrandbits(32)
+    if (bits >> 23) & 0xff != 0xff: # No inf/nan in the grammar.
+      return FloatText(bits)
+
+def RandomSlot(rng, name, op):
+  flag = flags[op]
+  if name in flag:
+    return rng.choice([text for text in flag[name] if text != 'DEFAULT'] + [''])
+  if name in flag_names:
+    return ''
+  if name in composites:
+    choices = [key for key in composites[name] if key != None]
+    if composites[name][2] != None:
+      choices.append(composites[name][2])
+    return RandomSlot(rng, rng.choice(choices), op)
+  if name in ('rd', 'rs0', 'rs1', 'rs2'):
+    text = RandomOperand(rng, name)
+    if name + 'neg' in flag and rng.random() < 0.3:
+      text = '-' + text
+    if name != 'rd' and rng.random() < 0.3:
+      text += '.reuse'
+    return text
+  if name == 'addr24':
+    return f'[{RandomOperand(rng, "rs0")}+{RandomOperand(rng, "is0w24")}]'
+  if name in ('pd0', 'pd1'):
+    return rng.choice(('P0', 'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'PT'))
+  if name in ('pd0i', 'pd1i', 'ldgp'):
+    return rng.choice(('', RandomSlot(rng, 'pd0', op) + ', '))
+  if name in ('ps0i', 'ps1i', 'ps0opt'):
+    return rng.choice(('', ', ' + RandomOperand(rng, 'ps0')))
+  if name == 'cpc':
+    return rng.choice(('', RandomOperand(rng, 'cp') + ','))
+  if name == 'cps':
+    return rng.choice(('', ' ' + RandomOperand(rng, 'cp')))
+  if name == 'is1' and 'is1neg' in flag:
+    return rng.choice(('', '-')) + hex(rng.randrange(1 << 20) * 16)
+  if name == 'sr':
+    return rng.choice([text for text in flag['sr'] if text != 'DEFAULT'])
+  return RandomOperand(rng, name)
+
+def RandomInstr(rng):
+  op = rng.choice(list(templates))
+  template = rng.choice(templates[op])
+  values = {name : RandomSlot(rng, name, op) for _, name, _, _ in Formatter().parse(template) if name}
+  ctrl = '%s:%s:%s:%s:%x' % (rng.choice(('--', '%02d' % rng.randrange(1, 64))),
+                             rng.choice('-123456'), rng.choice('-123456'),
+                             rng.choice('-Y'), rng.randrange(16))
+  pred = rng.choice(('', '', '@P%d ' % rng.randrange(7), '@!P%d ' % rng.randrange(7)))
+  return f'{ctrl}    {pred}' + template.format(**values)
+
+def RoundTripChunk(job):
+  count, seed, max_failures = job
+  rng = random.Random(seed)
+  stats = {'checked' : 0, 'skipped' : 0, 'failed' : 0, 'failures' : []}
+  for _ in range(count):
+    line = RandomInstr(rng)
+    try:
+      code = EncodeInstr(ProcessAsmLine(line, 0))[0] & MASK128
+    except Exception:
+      stats['skipped'] += 1
+      continue
+    stats['checked'] += 1
+    text = Disassemble(code)
+    try:
+      ok = text != None and EncodeInstr(ProcessAsmLine(text, 0))[0] & MASK128 == code
+    except Exception:
+      ok = False
+    if not ok:
+      stats['failed'] += 1
+      if len(stats['failures']) < max_failures:
+        stats['failures'].append((line, code, text))
+  return stats
+
+def RoundTrip(count, seed=None, processes=1, max_failures=10):
+  '''
+  Encode random instructions, decode them and encode the result again.
+  Instructions the encoder itself rejects are skipped (and counted).
+  The work is split over processes, each with its own seed.
+  Return {
+    checked, skipped, failed, seed, seconds,
+    failures : [(line, code, disassembled line)]
+  }
+  '''
+  start = time.perf_counter()
+  seed = random.randrange(1 << 32) if seed == None else seed
+  processes = max(1, min(processes, count))
+  jobs = [(count // processes + (i < count % processes), seed * processes + i, max_failures)
+          for i in range(processes)]
+  if processes == 1:
+    results = [RoundTripChunk(jobs[0])]
+  else:
+    with Pool(processes) as pool:
+      results = pool.map(RoundTripChunk, jobs)
+  stats = {'checked' : 0, 'skipped' : 0, 'failed' : 0, 'failures' : []}
+  for result in results:
+    for key in ('checked', 'skipped', 'failed'):
+      stats[key] += result[key]
+    stats['failures'] += result['failures']
+  stats['failures'] = stats['failures'][:max_failures]
+  stats['seed'] = seed
+  stats['seconds'] = time.perf_counter() - start
+  return stats
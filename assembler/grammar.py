@@ -115,7 +115,7 @@ operands = {
 addr24 = fr'\[(?:(?P<rs0>{reg})|(?P<nors0>))(?:\s*\+?\s*{is0w24})?\]'
 addr   = fr'\[(?:(?P<rs0>{reg})|(?P<nors0>))(?:\s*\+?\s*{is0})?\]'
 memType = fr'(?P<E>\.E)?(?P<U>\.U)?(?P<type>\.U8|\.S8|\.U16|\.S16|\.32|\.64|\.128)?'
-memCache = fr'(?:\.(?P<cache>EF|LU))?'
+memCache = fr'(?P<cache>\.EF|\.LU)?'
 memScope = fr'(?P<scope>\.CTA|\.GPU|\.SYS)?'
 memStrong = fr'(?P<strong>\.CONSTANT|\.WEEK|\.STRONG)?'
 
@@ -143,27 +143,27 @@ grammar = {
 
   # Integer instructions
   'IADD3': [{'code' : 0x210, 'rule' : rf'IADD3{X} {rd}, {pd0i}{pd1i}{rs0}, {icrs1}, {rs2}{ps0i}{ps1i};', 'lat' : 4},
-            {'code' : 0x210, 'rule' : rf'IADD3{X} {rd}, {pd0i}{pd1i}{rs0}, {rs2}, {ic2}{ps0i}{ps1i};'}],
+            {'code' : 0x210, 'rule' : rf'IADD3{X} {rd}, {pd0i}{pd1i}{rs0}, {rs2}, {ic2}{ps0i}{ps1i};', 'lat' : 4}],
   'IMUL' : [{'code' : 0x000, 'rule' : r'IMUL;'}],
   # Do not capture them () as flags. But treat them as different instructions.
   'IMAD'  : [{'code' : 0x224, 'rule' : rf'IMAD{imadType} {rd}, {pd0i}{rs0}, {icrs1}, {rs2}{ps0i};', 'lat' : 5},
              {'code' : 0x224, 'rule' : rf'IMAD{imadType} {rd}, {pd0i}{rs0}, {rs2}, {ic2}{ps0i};', 'lat' : 5}, 
-             {'code' : 0x225, 'rule' : rf'IMAD.WIDE{imadType} {rd}, {pd0i}{rs0}, {icrs1}, {rs2}{ps0i};'}, 
-             {'code' : 0x225, 'rule' : rf'IMAD.WIDE{imadType} {rd}, {pd0i}{rs0}, {rs2}, {ic2}{ps0i};'}, 
+             {'code' : 0x225, 'rule' : rf'IMAD.WIDE{imadType} {rd}, {pd0i}{rs0}, {icrs1}, {rs2}{ps0i};', 'lat' : 5}, 
+             {'code' : 0x225, 'rule' : rf'IMAD.WIDE{imadType} {rd}, {pd0i}{rs0}, {rs2}, {ic2}{ps0i};', 'lat' : 5}, 
              # IMAD.HI is special. rs2 represent register after it. Must be even register.
-             {'code' : 0x227, 'rule' : rf'IMAD.HI{imadType} {rd}, {pd0i}{rs0}, {icrs1}, {rs2};'}], 
+             {'code' : 0x227, 'rule' : rf'IMAD.HI{imadType} {rd}, {pd0i}{rs0}, {icrs1}, {rs2};', 'lat' : 5}], 
   'ISETP' : [{'code' : 0x20c, 'rule' : rf'ISETP{icmp}{cmpType}{boolOp} {pd0}, {pd1}, {rs0}, {icrs1}, {ps0};', 'lat' : 4}],
   'LOP3'  : [{'code' : 0x212, 'rule' : rf'LOP3\.LUT {pd0i}{rd}, {rs0}, {icrs1}, {rs2}, {isw8}(?:, {ps0})?;', 'lat' : 5}],
   'SHF'   : [{'code' : 0x219, 'rule' : rf'SHF{shf} {rd}, {rs0}, {icrs1}, {rs2};', 'lat' : 5}], # Somethings 4. st. 5.
 
   # Float instructions
   # TODO: FFMA, FADD, FMUL
-  'FFMA' : [{'code' : 0x223, 'rule' : rf'FFMA {rd}, {rs0}, {fcrs1}, {rs2};'}, 
-            {'code' : 0x223, 'rule' : rf'FFMA {rd}, {rs0}, {rs2}, {fc2};'}],
+  'FFMA' : [{'code' : 0x223, 'rule' : rf'FFMA {rd}, {rs0}, {fcrs1}, {rs2};', 'lat' : 4}, 
+            {'code' : 0x223, 'rule' : rf'FFMA {rd}, {rs0}, {rs2}, {fc2};', 'lat' : 4}],
   # FADD has its own rule. 
   # TODO: Add flags for them. Especially for FMUL.
-  'FADD' : [{'code' : 0x221, 'rule' : rf'FADD {rd}, {rs0}, {fcrs1add};'}],
-  'FMUL' : [{'code' : 0x220, 'rule' : rf'FMUL {rd}, {rs0}, {fcrs1};'}],
+  'FADD' : [{'code' : 0x221, 'rule' : rf'FADD {rd}, {rs0}, {fcrs1add};', 'lat' : 4}],
+  'FMUL' : [{'code' : 0x220, 'rule' : rf'FMUL {rd}, {rs0}, {fcrs1};', 'lat' : 4}],
   # Control instructions
   'BRA'  : [{'code' : 0x947, 'rule' : rf'BRA {cp}{is1};', 'lat' : 7}], # Lat?
   'EXIT' : [{'code' : 0x94d, 'rule' : rf'EXIT\s*{cp};'}], 
@@ -328,6 +328,73 @@ for line in flag_str.split('\n'):
 
 
 
+# Compile every rule once.
+# Each alternative gets its compiled pattern and the names of its capture
+# groups in group order, so a match can be handed around as a plain tuple
+# of values aligned with gram['fields'].
+for op, grams in grammar.items():
+  for gram in grams:
+    gram['re'] = re.compile(gram['rule'])
+    if gram['re'].groups != len(gram['re'].groupindex):
+      raise Exception(f'Unnamed capture group in rule of {op}.\n')
+    gram['fields'] = tuple(sorted(gram['re'].groupindex, key=gram['re'].groupindex.get))
+
+def OperandShape(rest):
+  '''
+  Cheap signature of an operand list. One letter per operand:
+    r - register, p - predicate, i - integer, f - float,
+    c - constant bank, m - memory address.
+  Only used as a dispatch key, a wrong guess just costs a retry.
+  '''
+  shape = ''
+  for operand in rest.split(','):
+    operand = operand.strip(' ;-')
+    if operand == '':
+      continue
+    first = operand[0]
+    if first == '[':
+      shape += 'm'
+    elif first.isdigit():
+      shape += 'f' if '.' in operand and operand[:2] not in ('0x', '0X') else 'i'
+    elif operand[:2] == 'c[':
+      shape += 'c'
+    elif first == 'P' or first == '!':
+      shape += 'p'
+    else:
+      shape += 'r'
+  return shape
+
+# (op, shape) => alternatives of op, the one that matched last time first.
+dispatch = {}
+
+def MatchInstr(op, rest, attempts=None):
+  '''
+  Match op + rest against the grammar of op.
+  attempts: optional {op : count}, counts the alternatives tried.
+  Return:
+    (gram, values): values is the tuple of captured groups, aligned with gram['fields'].
+    (None, None) if no alternative matches.
+  '''
+  key = (op, OperandShape(rest))
+  grams = dispatch.get(key)
+  if grams == None:
+    if op not in grammar:
+      raise Exception(f'Unknown instruction {op}.\n')
+    grams = grammar[op]
+  instr = op + rest
+  for i, gram in enumerate(grams):
+    result = gram['re'].match(instr)
+    if result == None:
+      continue
+    if attempts != None:
+      attempts[op] = attempts.get(op, 0) + i + 1
+    if i != 0 or key not in dispatch:
+      dispatch[key] = [gram] + [g for g in grams if g is not gram]
+    return gram, result.groups()
+  if attempts != None:
+    attempts[op] = attempts.get(op, 0) + len(grams)
+  return None, None
+
 ctrl_re = r'(?P<ctrl>[0-9a-fA-F\-]{2}:[1-6\-]:[1-6\-]:[\-yY]:[0-9a-fA-F])'
 pred_re = r'(?P<pred>@(?P<predNot>!)?P(?P<predReg>\d)\s+)'
 inst_re = fr'{pred_re}?(?P<op>\w+)(?P<rest>[^;]*;)'
@@ -355,8 +422,9 @@ def GenReuse(captured_dict):
     reuse_code |= 0x1 << 60
   return reuse_code
 
+asm_line_re = re.compile(fr'^{ctrl_re}(?P<space>\s+){inst_re}')
 def ProcessAsmLine(line, line_num):
-  result = re.match(fr'^{ctrl_re}(?P<space>\s+){inst_re}', line)
+  result = asm_line_re.match(line)
   if result != None:
     result = result.groupdict()
     return {
@@ -0,0 +1,84 @@
+from grammar import ProcessAsmLine
+from analysis import Unconditional, BranchTarget
+from reuse import SetReuse
+
+INSTR_SIZE = 16
+# .text sections are 128-byte aligned (Cubin), so is the start of every kernel.
+TEXT_ALIGN = 128
+PAD_CTRL = '--:-:-:-:1'
+
+def LoopHeaders(program):
+  '''
+  Return:
+    {label : [index of BRA]} of the labels reached by backward branches.
+  '''
+  labels = program['labels']
+  headers = {}
+  for idx, instr in enumerate(program['instructions']):
+    if instr['op'] != 'BRA':
+      continue
+    label = BranchTarget(instr)
+    if label in labels and labels[label] <= idx:
+      headers.setdefault(label, []).append(idx)
+  return headers
+
+def AlignLoops(program, boundary=TEXT_ALIGN):
+  '''
+  Pad with NOPs so that every loop header (label of a backward BRA) of a
+  program (result of Parse) starts on a boundary of the given bytes (16 to
+  128, a power of 2). The NOPs go right before the label: only the fall
+  through path runs them, not the loop. Labels and line numbers are
+  renumbered, so BRA and EXIT offsets are computed from the new layout. The
+  instruction before the NOPs loses its .reuse flags.
+  Return:
+    report (str). program['align'] gets [{label, offset, pad, executed}],
+    offset in bytes after padding.
+  '''
+  if boundary < INSTR_SIZE or boundary > TEXT_ALIGN or boundary & (boundary - 1) != 0:
+    raise Exception(f'Loop alignment must be a power of 2 from {INSTR_SIZE} to {TEXT_ALIGN} bytes, not {boundary}.\n')
+  instructions = program['instructions']
+  labels = program['labels']
+  per_line = boundary // INSTR_SIZE
+  header_at = {} # instruction index => loop header labels
+  for label in LoopHeaders(program):
+    header_at.setdefault(labels[label], []).append(label)
+
+  new_instructions = []
+  index_of = {}
+  loops = []
+  for idx, instr in enumerate(instructions):
+    if idx in header_at:
+      pad = -len(new_instructions) % per_line
+      # NOPs after an unguarded BRA/EXIT are never run.
+      executed = pad > 0 and idx > 0 and not Unconditional(instructions[idx - 1])
+      if pad and new_instructions and '.reuse' in new_instructions[-1]['rest']:
+        new_instructions[-1] = SetReuse(new_instructions[-1], {})
+      for _ in range(pad):
+        record = ProcessAsmLine(f'{PAD_CTRL}    NOP;', len(new_instructions))
+        record['file_line_num'] = instr['file_line_num']
+        new_instructions.append(record)
+      for label in header_at[idx]:
+        loops.append({'label' : label, 'offset' : len(new_instructions) * INSTR_SIZE, 'pad' : pad,
+                      'executed' : executed})
+    index_of[idx] = len(new_instructions)
+    new_instructions.append(dict(instr, line_num=len(new_instructions)))
+  index_of[len(instructions)] = len(new_instructions)
+
+  program['instructions'] = new_instructions
+  program['labels'] = {name : index_of[idx] for name, idx in labels.items()}
+  program['align'] = loops
+  added = len(new_instructions) - len(instructions)
+  executed = sum(loop['pad'] for loop in loops if loop['executed'])
+  out = [f'Align: {len(loops)} loop headers at {boundary}-byte boundaries, {added} NOPs '
+         f'({added * INSTR_SIZE} bytes) added, {executed} of them on fall-through paths.']
+  for loop in loops:
+    if loop['pad']:
+      out.append(f'  {loop["label"]:<20} at 0x{loop["offset"]:04x}, {loop["pad"]} NOPs'
+                 f'{"" if loop["executed"] else " (not executed)"}')
+  return '\n'.join(out)
+
+def AlignPass(boundary=TEXT_ALIGN):
+  # AlignLoops at the given boundary, as a pass of BuildContext.
+  def AlignLoopsTo(program):
+    return AlignLoops(program, boundary)
+  return AlignLoopsTo
@@ -1,35 +1,181 @@
 import argparse
+import json
+import os
+import sys
 from turas import *
 from cubin import Cubin
+from cache import EncodingCache
+from preprocess import PreprocessContext
+from batch import ReadManifest, RunBatch
+from disasm import DisassembleCubin, RoundTrip
+from patch import PatchKernel
+from schedule import AssignControlCodes, ScheduleBlocks
+from reuse import SetReuseFlags
+from banks import AnalyzeBanks, BankReportText
+from smem import AnalyzeShared, SharedReportText
+from occupancy import KernelOccupancy, OccupancyReportText
+from profiler import Profiler
+from clock import InstrumentClock, ClockPass
+from layout import AlignLoops, AlignPass, TEXT_ALIGN
+from peephole import Peephole
+
+# Optional passes over the parsed instructions, run in the order given to -pass.
+passes = {
+  'ctrl'  : AssignControlCodes,
+  'sched' : ScheduleBlocks,
+  'reuse' : SetReuseFlags,
+  'peep'  : Peephole,
+  'clock' : InstrumentClock,
+  'align' : AlignLoops
+}
+
+def PassList(args):
+  # -clock-regions picks the labels timed by the clock pass, -align-loops the boundary of align.
+  funcs = []
+  for name in args.passes:
+    if name == 'clock' and args.clock_regions:
+      funcs.append(ClockPass(args.clock_regions))
+    elif name == 'align':
+      funcs.append(AlignPass(args.align_loops))
+    else:
+      funcs.append(passes[name])
+  return funcs
 
 def main():
   parser = argparse.ArgumentParser()
-  parser.add_argument('-i', '--input', help='input asm file', dest='input_asm', required=True, metavar='FILE')
-  parser.add_argument('-o', '--output', help='output cubin file', dest='output_cubin', required=True, metavar='FILE')
+  parser.add_argument('-i', '--input', help='input asm files, one kernel each', dest='input_asm', nargs='+', metavar='FILE')
+  parser.add_argument('-o', '--output', help='output cubin file', dest='output_cubin', metavar='FILE')
   parser.add_argument('-inc', '--include', help='include files', nargs='+')
   parser.add_argument('-arch', dest='arch', default=75, type=int)
+  parser.add_argument('-name', help='kernel names (default: kern for a single input, else file names)', dest='names', nargs='+')
+  parser.add_argument('-cache', help='encoding cache file, reused across builds', dest='cache', metavar='FILE')
+  parser.add_argument('-cache-size', help='max number of cached instructions', dest='cache_size', default=1 << 20, type=int)
+  parser.add_argument('-code-cache', help='compiled include/CODE/{} cache file, reused across builds', dest='code_cache', metavar='FILE')
+  parser.add_argument('-batch', help='manifest of files to assemble in parallel', dest='batch', metavar='FILE')
+  parser.add_argument('-j', '--jobs', help='number of worker processes (default: number of cores)', dest='jobs', type=int)
+  parser.add_argument('-disasm', help='disassemble a cubin (to -o, or stdout)', dest='disasm', metavar='FILE')
+  parser.add_argument('-roundtrip', help='encode/decode/encode N random instructions', dest='roundtrip', type=int, metavar='N')
+  parser.add_argument('-patch', help='replace kernel -name of an existing cubin with -i (written to -o, or in place)', dest='patch', metavar='FILE')
+  parser.add_argument('-pass', help=f'passes to run before encoding, in order: {", ".join(passes)}', dest='passes', nargs='+', default=[], choices=list(passes), metavar='PASS')
+  parser.add_argument('-clock-regions', help='labels timed by -pass clock (default: all labels)', dest='clock_regions', nargs='+', metavar='LABEL')
+  parser.add_argument('-align-loops', help=f'boundary of loop headers for -pass align, in bytes (default {TEXT_ALIGN})', dest='align_loops', default=TEXT_ALIGN, type=int, metavar='BYTES')
+  parser.add_argument('-banks', help='print register bank conflicts per line and label block', dest='banks', action='store_true')
+  parser.add_argument('-banks-json', help='write register bank conflicts of all kernels as JSON', dest='banks_json', metavar='FILE')
+  parser.add_argument('-smem-banks', help='print shared memory wavefronts of each LDS/STS', dest='smem_banks', action='store_true')
+  parser.add_argument('-smem-banks-json', help='write shared memory wavefronts of all kernels as JSON', dest='smem_banks_json', metavar='FILE')
+  parser.add_argument('-occupancy', help='print the occupancy of each kernel for blocks of N threads', dest='occupancy', type=int, metavar='N')
+  parser.add_argument('-occupancy-json', help='write the occupancy of all kernels (for -occupancy N) as JSON', dest='occupancy_json', metavar='FILE')
+  parser.add_argument('-profile', '--profile', help='time each build phase, count encodes per opcode, write JSON', dest='profile', metavar='FILE')
+  parser.add_argument('-seed', help='random seed of -roundtrip', dest='seed', type=int)
   args = parser.parse_args()
 
+  if args.clock_regions and 'clock' not in args.passes:
+    parser.error('-clock-regions needs -pass clock.')
 
+  if args.disasm != None:
+    text = '\n'.join(DisassembleCubin(args.disasm)) + '\n'
+    if args.output_cubin == None:
+      sys.stdout.write(text)
+    else:
+      with open(args.output_cubin, 'w') as f:
+        f.write(text)
+    sys.exit(0)
+  if args.roundtrip != None:
+    stats = RoundTrip(args.roundtrip, args.seed, args.jobs or os.cpu_count() or 1)
+    for line, code, text in stats['failures']:
+      print(f'FAILED: {line.strip()}\n  0x{code:032x}\n  {text}')
+    rate = stats['checked'] / stats['seconds'] * 60 if stats['seconds'] > 0 else 0
+    print(f'Round trip (seed {stats["seed"]}): {stats["checked"]} checked, {stats["failed"]} failed, '
+          f'{stats["skipped"]} rejected by the encoder, {stats["seconds"]:.2f}s ({rate:.0f}/min).')
+    sys.exit(1 if stats['failed'] else 0)
+  if args.patch != None:
+    if args.input_asm == None or len(args.input_asm) != 1:
+      parser.error('-patch takes exactly one -i file.')
+    name = args.names[0] if args.names != None else 'kern'
+    with open(args.input_asm[0], 'r') as input_file:
+      file = input_file.read()
+    build = BuildContext(args.arch, args.include, passes=PassList(args))
+    kernel, params = build.Assemble(file)
+    for report in build.reports:
+      print(report)
+    report = PatchKernel(args.patch, kernel, name, params['size_list'], args.output_cubin)
+    print(f'Patched {name}: {report["OldSize"]} -> {report["NewSize"]} bytes'
+          f'{" in place" if report["InPlace"] else ", sections relocated"}.')
+    sys.exit(0)
+  if args.batch != None:
+    unsupported = [option for option, value in (('-cache', args.cache), ('-code-cache', args.code_cache),
+                                                ('-pass', args.passes), ('-profile', args.profile)) if value]
+    if unsupported:
+      parser.error(f'{", ".join(unsupported)} cannot be used with -batch.')
+    results = RunBatch(ReadManifest(args.batch, args.arch), args.include, args.jobs)
+    sys.exit(1 if any(result['error'] != None for result in results) else 0)
+  if args.input_asm == None or args.output_cubin == None:
+    parser.error('-i and -o are required without -batch, -disasm or -roundtrip.')
 
-  # Read in asm file
-  with open(args.input_asm, 'r') as input_file:
-    file = input_file.read()
-    # Preprocess. May move to another function.
-    # Include: 
-    # Skip commands, empty line ...
-    file = ExpandCode(file, args.include)
-    file = ExpandInline(file, args.include)
-    file, regs   = SetRegisterMap(file)
-    file, params = SetParameterMap(file)
-    # TODO: replace registers; replace params.
-    file   = ReplaceRegParamMap(file, regs, params)
-    kernel = Assemble(file)
+  if args.names == None:
+    if len(args.input_asm) == 1:
+      args.names = ['kern']
+    else:
+      args.names = [os.path.splitext(os.path.basename(path))[0] for path in args.input_asm]
+  if len(args.names) != len(args.input_asm):
+    parser.error('Number of kernel names != number of input files.')
+  if args.occupancy_json and args.occupancy == None:
+    parser.error('-occupancy-json needs the block size, -occupancy N.')
 
-  # Write out cubin file
+  profiler = Profiler() if args.profile else None
+  cache = EncodingCache(args.cache, args.cache_size) if args.cache else None
+  # Kernels get namespaces of their own, compiled code objects are shared.
+  codes = PreprocessContext(args.code_cache)
   cubin = Cubin(arch=args.arch)
-  cubin.AddKernel(kernel, b'kern', params['size_list']) 
-  cubin.Write(args.output_cubin)
+  bank_results = {}
+  occupancy_results = {}
+  smem_results = {}
+  for input_asm, name in zip(args.input_asm, args.names):
+    # Read in asm file
+    with open(input_asm, 'r') as input_file:
+      file = input_file.read()
+    build = BuildContext(args.arch, args.include, cache=cache, preprocess=codes.Fresh(),
+                         passes=PassList(args), profiler=profiler)
+    kernel, params = build.Assemble(file)
+    for report in build.reports:
+      print(f'{name}: {report}')
+    if args.banks or args.banks_json:
+      bank_results[name] = AnalyzeBanks(build.program)
+      if args.banks:
+        print(BankReportText(bank_results[name], name))
+    if args.smem_banks or args.smem_banks_json:
+      smem_results[name] = AnalyzeShared(build.program)
+      if args.smem_banks:
+        print(SharedReportText(smem_results[name], name))
+    if args.occupancy != None:
+      occupancy_results[name] = KernelOccupancy(kernel, args.arch, args.occupancy)
+      print(OccupancyReportText(occupancy_results[name], name))
+    cubin.AddKernel(kernel, name.encode(), params['size_list'])
+
+  if args.banks_json:
+    with open(args.banks_json, 'w') as f:
+      json.dump(bank_results, f, indent=1)
+  if args.smem_banks_json:
+    with open(args.smem_banks_json, 'w') as f:
+      json.dump(smem_results, f, indent=1)
+  if args.occupancy_json:
+    with open(args.occupancy_json, 'w') as f:
+      json.dump(occupancy_results, f, indent=1)
+  codes.Save()
+  if cache != None:
+    cache.Save()
+    print(cache.Report())
+
+  # Write out cubin file
+  if profiler != None:
+    with profiler.Phase('Cubin.Write'):
+      cubin.Write(args.output_cubin)
+    profiler.Stop()
+    print(profiler.ReportText())
+    with open(args.profile, 'w') as f:
+      json.dump(profiler.Report(), f, indent=1)
+  else:
+    cubin.Write(args.output_cubin)
 
 
 if __name__ == '__main__':
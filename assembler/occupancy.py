@@ -0,0 +1,161 @@
+# Per SM limits of the CUDA occupancy calculator.
+# Shared memory per SM is the largest carveout of the L1/shared split.
+arch_limits = {
+  70 : {
+    'warps'           : 64,
+    'blocks'          : 32,
+    'threads'         : 1024,  # per block
+    'registers'       : 65536,
+    'reg_unit'        : 256,   # registers are allocated per warp, in units of
+    'warp_unit'       : 4,     # and per 4 warps (one per SM sub partition)
+    'max_regs'        : 255,   # per thread
+    'shared'          : 96 * 1024,
+    'shared_unit'     : 256,
+    'shared_static'   : 48 * 1024, # per block, .nv.shared
+    'barriers'        : 16     # per block
+  },
+  75 : {
+    'warps'           : 32,
+    'blocks'          : 16,
+    'threads'         : 1024,
+    'registers'       : 65536,
+    'reg_unit'        : 256,
+    'warp_unit'       : 4,
+    'max_regs'        : 255,
+    'shared'          : 64 * 1024,
+    'shared_unit'     : 256,
+    'shared_static'   : 48 * 1024,
+    'barriers'        : 16
+  }
+}
+
+WARP_SIZE = 32
+
+def RoundUp(value, unit):
+  return -(-value // unit) * unit
+
+def BlockLimits(limits, block, regs, smem, barriers):
+  '''
+  Return:
+    {resource : blocks per SM it allows}, for warps, blocks, registers,
+    shared memory and barriers.
+  '''
+  warps = -(-block // WARP_SIZE)
+  if block > limits['threads'] or block <= 0:
+    by_warps = 0
+  else:
+    by_warps = limits['warps'] // warps
+  regs_per_warp = RoundUp(regs * WARP_SIZE, limits['reg_unit'])
+  if regs > limits['max_regs']:
+    by_regs = 0
+  elif regs_per_warp == 0:
+    by_regs = limits['blocks']
+  else:
+    warps_by_regs = limits['registers'] // regs_per_warp // limits['warp_unit'] * limits['warp_unit']
+    by_regs = warps_by_regs // warps
+  if smem > limits['shared_static']:
+    by_smem = 0
+  elif smem == 0:
+    by_smem = limits['blocks']
+  else:
+    by_smem = limits['shared'] // RoundUp(smem, limits['shared_unit'])
+  return {
+    'warps'     : by_warps,
+    'blocks'    : limits['blocks'],
+    'registers' : by_regs,
+    'shared'    : by_smem,
+    'barriers'  : limits['blocks'] if barriers <= limits['barriers'] else 0
+  }
+
+def Occupancy(arch, block, regs, smem=0, barriers=0):
+  '''
+  Theoretical occupancy of a kernel.
+  arch: 70 or 75. block: threads per block. regs: registers per thread
+  (RegCnt of Assemble). smem: static shared memory (SmemSize). barriers: BarCnt.
+  Return {
+    arch, block, regs, smem, barriers,
+    limits    : {resource : blocks per SM},
+    blocks    : blocks per SM, warps, max_warps, occupancy (0-1),
+    limiter   : resource allowing the fewest blocks,
+    cliffs    : {'registers'/'shared' : {
+                   keep : largest value that keeps the same blocks per SM,
+                   next : largest value giving more blocks per SM (None if
+                          this resource alone cannot)}}
+  }
+  '''
+  if arch not in arch_limits:
+    raise Exception(f'No occupancy limits for sm_{arch}, only for ' +
+                    ', '.join(f'sm_{arch}' for arch in arch_limits) + '.\n')
+  limits = arch_limits[arch]
+  per_resource = BlockLimits(limits, block, regs, smem, barriers)
+  blocks = min(per_resource.values())
+  # The first one wins a tie, in the order of BlockLimits.
+  limiter = min(per_resource, key=lambda resource: per_resource[resource])
+  warps = blocks * -(-block // WARP_SIZE)
+
+  def Blocks(regs, smem):
+    return min(BlockLimits(limits, block, regs, smem, barriers).values())
+  reg_values  = range(1, limits['max_regs'] + 1)
+  smem_values = [0] + list(range(limits['shared_unit'], limits['shared_static'] + 1, limits['shared_unit']))
+  def Cliff(values, blocks_at):
+    keep = max((value for value in values if blocks_at(value) == blocks), default=None)
+    more = [value for value in values if blocks_at(value) > blocks]
+    return {'keep' : keep, 'next' : max(more) if more else None}
+  cliffs = {
+    'registers' : Cliff(reg_values, lambda value: Blocks(value, smem)),
+    'shared'    : Cliff(smem_values, lambda value: Blocks(regs, value))
+  }
+  return {
+    'arch'      : arch,
+    'block'     : block,
+    'regs'      : regs,
+    'smem'      : smem,
+    'barriers'  : barriers,
+    'limits'    : per_resource,
+    'blocks'    : blocks,
+    'warps'     : warps,
+    'max_warps' : limits['warps'],
+    'occupancy' : warps / limits['warps'],
+    'limiter'   : limiter,
+    'cliffs'    : cliffs
+  }
+
+def KernelOccupancy(kernel, arch, block):
+  # Occupancy of a result of Assemble.
+  return Occupancy(arch, block, kernel['RegCnt'], kernel['SmemSize'], kernel['BarCnt'])
+
+resource_names = {
+  'warps'     : 'warps',
+  'blocks'    : 'blocks',
+  'registers' : 'registers',
+  'shared'    : 'shared memory',
+  'barriers'  : 'barriers'
+}
+
+def OccupancyReportText(result, name=''):
+  '''
+  Text version of Occupancy: blocks per SM allowed by each resource, and how
+  far registers and shared memory can move before the occupancy changes.
+  '''
+  out = [f'Occupancy{" of " + name if name else ""} on sm_{result["arch"]}, {result["block"]} threads per block: '
+         f'{result["blocks"]} blocks, {result["warps"]} of {result["max_warps"]} warps per SM '
+         f'({result["occupancy"]:.0%}), limited by {resource_names[result["limiter"]]}.']
+  limits = result['limits']
+  used = {
+    'warps'     : f'{-(-result["block"] // WARP_SIZE)} per block',
+    'blocks'    : '',
+    'registers' : f'{result["regs"]} per thread',
+    'shared'    : f'{result["smem"]} bytes',
+    'barriers'  : f'{result["barriers"]} of {arch_limits[result["arch"]]["barriers"]}'
+  }
+  for resource in limits:
+    line = f'  {resource:<10} {used[resource]:>16} {limits[resource]:>4} blocks'
+    cliff = result['cliffs'].get(resource)
+    if cliff != None:
+      unit = ' bytes' if resource == 'shared' else ''
+      if cliff['keep'] != None:
+        line += f', same up to {cliff["keep"]}{unit}'
+      if cliff['next'] != None:
+        line += f', more blocks at {cliff["next"]}{unit} or less'
+    out.append(line)
+  return '\n'.join(out)
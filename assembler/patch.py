@@ -0,0 +1,163 @@
+import os
+from struct import pack, unpack_from, pack_into
+from ELF import Section, Program, Header, Symbol
+from cubin import CubinReader, PackText
+
+# .nv.info attribute formats and the attributes touched here.
+EIFMT_SVAL = 0x04
+EIATTR_CBANK_PARAM_SIZE = 0x19
+EIATTR_EXIT_INSTR_OFFSETS = 0x1c
+EIATTR_REGCOUNT = 0x2f
+
+def NvInfoAttrs(data):
+  '''
+  Walk the entries of a .nv.info section.
+  Return:
+    [(offset, attr, value offset, value size)]. Non-SVAL entries carry a
+    2 byte value right after the attribute byte.
+  '''
+  attrs = []
+  offset = 0
+  while offset + 4 <= len(data):
+    fmt, attr, size = unpack_from('<BBH', data, offset)
+    if fmt == EIFMT_SVAL:
+      attrs.append((offset, attr, offset + 4, size))
+      offset += 4 + size
+    else:
+      attrs.append((offset, attr, offset + 2, 2))
+      offset += 4
+  return attrs
+
+def PatchNvInfoName(data, exit_offsets):
+  '''
+  Return:
+    .nv.info.<name> with its EXIT offsets replaced (appended if missing).
+  '''
+  exits = pack('<BBH', EIFMT_SVAL, EIATTR_EXIT_INSTR_OFFSETS, len(exit_offsets) * 4) + \
+          b''.join(pack('<I', offset) for offset in exit_offsets)
+  for offset, attr, value_offset, size in NvInfoAttrs(data):
+    if attr == EIATTR_EXIT_INSTR_OFFSETS:
+      return bytes(data[:offset]) + exits + bytes(data[value_offset + size:])
+  return bytes(data) + exits
+
+def Resize(buffer, header, sections, programs, idx, data):
+  '''
+  Replace the contents of sections[idx] with data (of a different size) in buffer (a bytearray).
+  Everything after the section moves by the same amount, rounded so that every
+  section after it keeps its alignment. Section/program headers are updated in
+  the objects, not in buffer.
+  '''
+  section = sections[idx]
+  old_end = section.sh_offset + section.sh_size
+  align = max([8] + [sec.sh_align for sec in sections if sec.sh_offset >= old_end and sec is not section])
+  delta = len(data) - section.sh_size
+  delta = -(-delta // align) * align if delta > 0 else -(-delta // align * align)
+  padding = section.sh_size + delta - len(data)
+  buffer[section.sh_offset:old_end] = bytes(data) + b'\0' * padding
+  for sec in sections:
+    if sec.sh_offset >= old_end and sec is not section:
+      sec.sh_offset += delta
+  for program in programs:
+    if program.offset >= old_end:
+      program.offset += delta
+    elif program.offset <= section.sh_offset < program.offset + program.filesz:
+      program.filesz += delta
+      program.memsz  += delta
+  if header.shoff >= old_end:
+    header.shoff += delta
+  if header.phoff >= old_end:
+    header.phoff += delta
+  section.sh_size = len(data)
+
+def PatchKernel(path, kernel, name, params=None, output=None):
+  '''
+  Replace the code of kernel name in an existing (e.g. nvcc) cubin.
+  kernel: result of Assemble. params: parameter sizes, checked against the cubin.
+  output: patched copy, default: patch path itself.
+  Updated:
+    .text.<name> (in place through the map when the size is unchanged),
+    its sh_info register count and sh_flags barrier count,
+    EXIT offsets in .nv.info.<name>, EIATTR_REGCOUNT in .nv.info,
+    the size of the kernel symbol.
+  Other instruction offset lists nvcc may emit are left as they are. Kernels
+  with relocations (.rel.text.<name>, .rela.text.<name>) are refused: their
+  offsets would point into the old code.
+  Nothing is written unless the whole patch succeeds.
+  Return:
+    {InPlace, OldSize, NewSize}
+  '''
+  output = path if output == None else output
+  # A copy is patched in memory, then written: the input is left as it is.
+  writable = output == path
+  text = PackText(kernel['KernelData'])
+  with CubinReader(path, writable=writable) as cubin:
+    text_sec = cubin.Section('.text.' + name)
+    info_sec = cubin.Section('.nv.info.' + name)
+    if text_sec == None:
+      raise Exception(f'Kernel {name} not found in {path}.\n')
+    for rel in ('.rel.text.', '.rela.text.'):
+      if cubin.Section(rel + name) != None:
+        raise Exception(f'Kernel {name} has relocations ({rel}{name}) in {path}, cannot patch its code.\n')
+    text_idx = cubin.sections.index(text_sec)
+    symbols = cubin.Symbols()
+    sym_idx = next((i for i, sym in enumerate(symbols)
+                    if sym.name == name.encode() and sym.st_shndx == text_idx), None)
+    if sym_idx == None:
+      raise Exception(f'Symbol of kernel {name} not found in {path}.\n')
+
+    info = None
+    if info_sec != None:
+      info_data = cubin.Data(info_sec)
+      for offset, attr, value_offset, size in NvInfoAttrs(info_data):
+        if attr == EIATTR_CBANK_PARAM_SIZE and params != None:
+          param_size = unpack_from('<H', info_data, value_offset)[0]
+          if param_size != sum(params):
+            raise Exception(f'Parameters of {name} take {sum(params)} bytes, {param_size} in {path}.\n')
+      info = PatchNvInfoName(info_data, kernel['ExitOffset'])
+      info_data.release()
+
+    report = {'OldSize' : text_sec.sh_size, 'NewSize' : len(text)}
+    report['InPlace'] = len(text) == text_sec.sh_size and (info == None or len(info) == info_sec.sh_size)
+    if report['InPlace']:
+      buffer = cubin.map if writable else bytearray(cubin.map)
+      buffer[text_sec.sh_offset:text_sec.sh_offset + len(text)] = text
+      if info != None:
+        buffer[info_sec.sh_offset:info_sec.sh_offset + len(info)] = info
+    else:
+      buffer = bytearray(cubin.map)
+      # Back to front, so offsets of sections not yet resized stay valid.
+      changes = [(text_sec, text)] + ([(info_sec, info)] if info != None else [])
+      for section, data in sorted(changes, key=lambda change: -change[0].sh_offset):
+        Resize(buffer, cubin.header, cubin.sections, cubin.programs, cubin.sections.index(section), data)
+
+    text_sec.sh_info  = (text_sec.sh_info & 0xffffff) | (kernel['RegCnt'] << 24)
+    text_sec.sh_flags = (text_sec.sh_flags & ~(0x7f << 20)) | (kernel['BarCnt'] << 20)
+
+    # Register count of the kernel in .nv.info, if present.
+    global_info = cubin.Section('.nv.info')
+    if global_info != None:
+      info_data = buffer[global_info.sh_offset:global_info.sh_offset + global_info.sh_size]
+      for offset, attr, value_offset, size in NvInfoAttrs(info_data):
+        if attr == EIATTR_REGCOUNT and size == 8 and unpack_from('<I', info_data, value_offset)[0] == sym_idx:
+          pack_into('<I', buffer, global_info.sh_offset + value_offset + 4, kernel['RegCnt'])
+      if isinstance(info_data, memoryview):
+        info_data.release()
+
+    symtab = cubin.Section('.symtab')
+    symbols[sym_idx].st_size = len(text)
+    symbols[sym_idx].PackEntryInto(buffer, symtab.sh_offset + sym_idx * Symbol.ENTRY_SIZE)
+    for i, section in enumerate(cubin.sections):
+      section.PackHeaderInto(buffer, cubin.header.shoff + i * Section.HEADER_SIZE)
+    if buffer is not cubin.map:
+      for i, program in enumerate(cubin.programs):
+        program.PackHeaderInto(buffer, cubin.header.phoff + i * Program.PHDR_SIZE)
+      cubin.header.PackHeaderInto(buffer, 0)
+    else:
+      cubin.map.flush()
+
+  if buffer is not cubin.map:
+    tmp_path = f'{output}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(buffer)
+    os.replace(tmp_path, output)
+  return report
@@ -0,0 +1,292 @@
+from grammar import ProcessAsmLine, grammar
+from analysis import Resources, Guard, Blocks, Regs, default_latency
+from schedule import CtrlText, MAX_STALL, BARRIER_SETUP
+from reuse import SetReuse
+
+# Longest fixed latency: results of the code before a block may still be in
+# flight this long after it is entered.
+MAX_LATENCY = max(rule.get('lat', default_latency) for rules in grammar.values() for rule in rules)
+MASK32 = 0xffffffff
+
+def Ctrl(instr):
+  # (wait mask, read barrier, write barrier, stall) of a record.
+  wait, read_bar, write_bar, _, stall = instr['ctrl'].split(':')
+  return (0 if wait == '--' else int(wait), None if read_bar == '-' else int(read_bar),
+          None if write_bar == '-' else int(write_bar), int(stall, 16))
+
+def SetCtrl(instr, stall=None, wait=None):
+  old_wait, read_bar, write_bar, old_stall = Ctrl(instr)
+  return dict(instr, ctrl=CtrlText(instr['ctrl'], old_stall if stall == None else stall,
+                                   old_wait if wait == None else wait, read_bar, write_bar))
+
+def SelfMove(instr, res):
+  captured = res['captured']
+  return instr['op'] == 'MOV' and captured.get('rs1') != None and not captured.get('rs1neg') and \
+         Regs(captured['rs1']) == Regs(captured['rd']) != ()
+
+def DeadMoves(block):
+  '''
+  block: records of one basic block.
+  Return:
+    indices of the MOVs whose result is written again, by an instruction
+    that runs whenever the MOV does, before anything reads it.
+  '''
+  dead = set()
+  next_use   = {} # register => (index, reads it) of the next instruction using it
+  next_write = {} # register => index of the next instruction writing it
+  for k in reversed(range(len(block))):
+    instr = block[k]
+    res = Resources(instr)
+    if instr['op'] == 'MOV' and len(res['dst']) == 1 and res['dst'][0] in next_use:
+      j, reads = next_use[res['dst'][0]]
+      guard = Guard(instr)
+      # A write under another guard, or after the guard changes, may not happen together.
+      if not reads and block[j]['pred'] in (None, instr['pred']) and \
+         (not guard or next_write.get(guard[0], j) >= j):
+        dead.add(k)
+    for reg in res['dst']:
+      next_use[reg] = (k, False)
+      next_write[reg] = k
+    for reg in res['src'] + Guard(instr):
+      next_use[reg] = (k, True)
+  return dead
+
+def AddTerms(res):
+  '''
+  IADD3 without carries, negations or constants as (registers, immediate).
+  Return None for other instructions.
+  '''
+  captured = res['captured']
+  if res['op'] != 'IADD3' or captured.get('x') or captured.get('pd0') or captured.get('pd1') or \
+     captured.get('ps0') or captured.get('ps1'):
+    return None
+  if any(captured.get(field) for field in ('rs0neg', 'rs1neg', 'rs2neg', 'cs1', 'cs2')):
+    return None
+  regs = [captured[slot] for slot in ('rs0', 'rs1', 'rs2') if captured.get(slot) not in (None, 'RZ')]
+  imm = sum(int(captured[slot], 0) for slot in ('is1', 'is2') if captured.get(slot) != None)
+  return regs, imm & MASK32
+
+def FoldAdds(first, second, at_start=False):
+  '''
+  at_start: first opens its block. Nothing can delay it, so second may not
+            bring registers of its own (they could still be in flight).
+  Return:
+    one IADD3 record doing first then second (back to back, same
+    destination, second reading it), or None.
+  '''
+  if first['op'] != 'IADD3' or second['op'] != 'IADD3' or first['pred'] != second['pred'] or \
+     Ctrl(first)[1:3] != (None, None) or Ctrl(second)[1:3] != (None, None):
+    return None
+  res1, res2 = Resources(first), Resources(second)
+  terms1, terms2 = AddTerms(res1), AddTerms(res2)
+  if terms1 == None or terms2 == None:
+    return None
+  dst = res1['captured']['rd']
+  if dst == 'RZ' or res2['captured']['rd'] != dst or terms2[0].count(dst) != 1:
+    return None
+  if at_start and any(reg != dst for reg in terms2[0]):
+    return None
+  regs = terms1[0] + [reg for reg in terms2[0] if reg != dst]
+  imm = (terms1[1] + terms2[1]) & MASK32
+  if len(regs) + (imm != 0) > 3:
+    return None
+  regs += ['RZ'] * (3 - len(regs))
+  if imm != 0:
+    operands = [regs[0], hex(imm), regs[1]]
+  else:
+    operands = regs
+  wait = Ctrl(first)[0] | Ctrl(second)[0]
+  text = f'{first["ctrl"]} {first["pred"] or ""}IADD3 {dst}, {", ".join(operands)};'
+  record = ProcessAsmLine(text, first['line_num'])
+  record['file_line_num'] = first['file_line_num']
+  return SetCtrl(record, wait=wait)
+
+def Facts(instr):
+  # What Retime checks of a record, computed once.
+  res = Resources(instr)
+  wait, read_bar, write_bar, stall = Ctrl(instr)
+  return {
+    'res'     : res,
+    'wait'    : wait,
+    'bars'    : [bar for bar in (read_bar, write_bar) if bar != None],
+    'stall'   : stall,
+    'src'     : set(res['src'] + Guard(instr)),
+    'dst'     : set(res['dst'])
+  }
+
+def Requirement(q, j):
+  '''
+  Cycles instruction j must issue after q (Facts of kept records), 0 if none.
+  '''
+  need = 0
+  if not q['res']['var_write'] and not q['dst'].isdisjoint(j['src'] | j['dst']):
+    need = q['res']['lat']
+  if any(j['wait'] & (1 << bar) for bar in q['bars']):
+    need = max(need, BARRIER_SETUP)
+  if need == 0 and not q['src'].isdisjoint(j['dst']):
+    need = 1
+  return need
+
+def EntryRequirement(j, written):
+  '''
+  Cycles instruction j (Facts) must stay away from the start of its block,
+  for results of the code before it that may still be in flight.
+  written: registers written by the block before j.
+  '''
+  if not j['src'] <= written:
+    return MAX_LATENCY
+  if not j['dst'] <= written and not j['res']['var_write']:
+    return MAX_LATENCY - j['res']['lat'] + 1 # Fixed latency writes complete in order.
+  return 0
+
+def Retime(kept, times, end_time, entered=True):
+  '''
+  Smallest stalls (never below the old ones) that keep every dependency
+  between the kept instructions of a block, and the block exit, as far
+  apart as it was, up to its latency.
+  kept: [record], times: [(consumer time, producer time)] in the old block,
+  end_time: cycles from the block start to its exit before the changes,
+  entered: code may run before the block (False for the kernel entry).
+  Return:
+    [stall] per record, or None if a stall would be too long.
+  '''
+  facts = [Facts(instr) for instr in kept]
+  issue = [0]
+  stalls = []
+  written = set(facts[0]['dst'])
+  for m in range(1, len(kept) + 1):
+    at = issue[-1] + facts[m - 1]['stall']
+    if m < len(kept):
+      consumer, _ = times[m]
+      if entered:
+        at = max(at, min(consumer, EntryRequirement(facts[m], written)))
+      written |= facts[m]['dst']
+      # Nothing needs more than MAX_LATENCY cycles.
+      for q in reversed(range(m)):
+        if issue[q] + MAX_LATENCY <= at:
+          break
+        need = Requirement(facts[q], facts[m])
+        if need:
+          at = max(at, issue[q] + min(need, consumer - times[q][1]))
+    else:
+      # Whatever is in flight at the exit stays in flight as long.
+      for q in reversed(range(m)):
+        if issue[q] + MAX_LATENCY <= at:
+          break
+        res_q = facts[q]['res']
+        need = 0 if res_q['var_write'] or not res_q['dst'] else res_q['lat']
+        if facts[q]['bars']:
+          need = max(need, BARRIER_SETUP)
+        at = max(at, issue[q] + min(need, end_time - times[q][1]))
+    stall = at - issue[-1]
+    if stall > MAX_STALL:
+      return None
+    stalls.append(stall)
+    issue.append(at)
+  return stalls
+
+def PeepholeBlock(block, counts, entered=True):
+  '''
+  entered: see Retime.
+  Return:
+    (records, stall cycles removed) of one basic block. counts is updated.
+  '''
+  times = []
+  clock = 0
+  for instr in block:
+    times.append(clock)
+    clock += Ctrl(instr)[3]
+  end_time = clock
+
+  # Instructions with no effect. The first one of the block stays: removing
+  # it would move the rest closer to the code before the block.
+  remove = {}
+  dead = DeadMoves(block)
+  for k, instr in enumerate(block):
+    if k == 0:
+      continue
+    wait, read_bar, write_bar, _ = Ctrl(instr)
+    if read_bar != None or write_bar != None or (wait and k + 1 == len(block)):
+      continue
+    if instr['op'] == 'NOP':
+      remove[k] = 'nops'
+    elif SelfMove(instr, Resources(instr)):
+      remove[k] = 'self_moves'
+    elif k in dead:
+      remove[k] = 'dead_moves'
+
+  kept = []  # records
+  spans = [] # (consumer time, producer time) in the old block
+  folded = 0
+  wait = 0
+  cut = False # Something was removed right after the last kept record.
+  for k, instr in enumerate(block):
+    if k in remove:
+      wait |= Ctrl(instr)[0]
+      cut = True
+      continue
+    if wait:
+      instr = SetCtrl(instr, wait=Ctrl(instr)[0] | wait)
+      wait = 0
+    fold = FoldAdds(kept[-1], instr, len(kept) == 1) if kept else None
+    if fold != None:
+      kept[-1] = fold
+      spans[-1] = (times[k], spans[-1][1])
+      folded += 1
+      cut = True
+      continue
+    if cut:
+      kept[-1] = SetReuse(kept[-1], {}) # Its .reuse flags were for the removed one.
+      cut = False
+    kept.append(instr)
+    spans.append((times[k], times[k]))
+  if cut:
+    kept[-1] = SetReuse(kept[-1], {})
+
+  if len(kept) == len(block):
+    return block, 0
+  stalls = Retime(kept, spans, end_time, entered)
+  if stalls == None:
+    return block, 0
+  for kind in remove.values():
+    counts[kind] += 1
+  counts['folded_adds'] += folded
+  kept = [SetCtrl(instr, stall=stall) for instr, stall in zip(kept, stalls)]
+  return kept, end_time - sum(stalls)
+
+def Peephole(program):
+  '''
+  Remove redundant instructions of a program (result of Parse), per basic
+  block: MOV of a register to itself, MOVs written again before being read,
+  NOPs (not the first of a block), and back to back IADD3s to the same
+  destination, folded into one. Guards must match, instructions setting
+  barriers stay, and the wait masks of removed ones move to the next one.
+  Stalls of the remaining instructions are only raised where a dependency
+  (fixed latency, barrier setup, block exit) needs it. The instruction
+  before a removed one loses its .reuse flags.
+  Run it before align and clock, which add NOPs and probes on purpose.
+  Return:
+    report (str).
+  '''
+  instructions = program['instructions']
+  labels = program['labels']
+  counts = {'self_moves' : 0, 'dead_moves' : 0, 'nops' : 0, 'folded_adds' : 0}
+  new_instructions = []
+  index_of = {}
+  cycles = 0
+  for block in Blocks(program):
+    entered = block['start'] != 0 or 0 in labels.values()
+    records, saved = PeepholeBlock(instructions[block['start']:block['end']], counts, entered)
+    cycles += saved
+    # Labels only point at block starts, which are always kept.
+    index_of[block['start']] = len(new_instructions)
+    for record in records:
+      new_instructions.append(dict(record, line_num=len(new_instructions)))
+  index_of[len(instructions)] = len(new_instructions)
+
+  program['instructions'] = new_instructions
+  program['labels'] = {name : index_of[idx] for name, idx in labels.items()}
+  removed = len(instructions) - len(new_instructions)
+  return (f'Peephole: {removed}/{len(instructions)} instructions removed ({counts["self_moves"]} self MOVs, '
+          f'{counts["dead_moves"]} dead MOVs, {counts["nops"]} NOPs, {counts["folded_adds"]} IADD3s folded), '
+          f'{cycles} stall cycles removed.')
@@ -0,0 +1,125 @@
+import os
+import re
+import marshal
+import hashlib
+from importlib.util import MAGIC_NUMBER
+
+# Integer literals of an inline expression, e.g. {2*8} and {3*8} share the shape {__lit0*__lit1}.
+# Digits next to a '.' or a name char are left alone (1.5, R1, 1e5, 1_000), so are
+# signed exponents (1e-5, 2.E+3).
+int_literal_re = re.compile(r'(?<![\w.])(?<![\d.][eE][+-])(0[xX][0-9a-fA-F]+|\d+)(?![\w.])')
+
+def ExprShape(expr):
+  '''
+  Return:
+    (shape, literals): expr with integer literals replaced by parameters __lit0, __lit1, ...
+    and the literal values. Expressions that contain strings or assignments are
+    kept as they are, with no literals.
+  '''
+  if '"' in expr or "'" in expr or ':=' in expr:
+    return expr, ()
+  literals = []
+  def ReplaceLiteral(matchobj):
+    literals.append(int(matchobj.group(1), 0))
+    return f'__lit{len(literals)-1}'
+  try:
+    shape = int_literal_re.sub(ReplaceLiteral, expr)
+  except ValueError: # e.g. 007
+    return expr, ()
+  return shape, tuple(literals)
+
+# sha1 of (mode, source) => code object. Code objects are immutable, so all
+# contexts of a process share them by default.
+shared_codes = {}
+
+class PreprocessContext():
+  '''
+  Namespace shared by include files, <CODE> blocks and {} expressions.
+  Every source is compiled once to a code object, cached by content hash.
+  The code objects can be saved and loaded across runs, and shared with
+  contexts of their own namespace (see Fresh).
+  '''
+  def __init__(self, path=None, namespace=None, codes=None):
+    self.path = path
+    self.namespace = {} if namespace == None else namespace
+    self.codes = shared_codes if codes == None else codes
+    self.funcs = {} # expression shape => function of its literals
+    self.included = set() # sha1 of include files already executed
+    self.saved = len(self.codes) # Code objects only get added.
+    if path != None:
+      self.Load(path)
+
+  def Load(self, path):
+    if not os.path.exists(path):
+      return
+    try:
+      with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC_NUMBER))
+        if magic != MAGIC_NUMBER:
+          return # Written by another python version.
+        self.codes.update(marshal.load(f))
+    except Exception:
+      return # Broken cache file. Start from scratch.
+    self.saved = len(self.codes)
+
+  def Fresh(self):
+    '''
+    Return:
+      a context with an empty namespace, sharing the code objects of this one
+      (Save of this one writes what it compiles).
+    '''
+    return PreprocessContext(codes=self.codes)
+
+  def Save(self, path=None):
+    path = self.path if path == None else path
+    if path == None or len(self.codes) == self.saved:
+      return
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+      f.write(MAGIC_NUMBER)
+      marshal.dump(self.codes, f)
+    os.replace(tmp_path, path)
+    self.saved = len(self.codes)
+
+  def Compile(self, source, mode, filename):
+    key = hashlib.sha1(f'{mode}\0{source}'.encode()).hexdigest()
+    code = self.codes.get(key)
+    if code == None:
+      code = compile(source, filename, mode)
+      self.codes[key] = code
+    return code
+
+  def Include(self, sources):
+    '''
+    Execute include sources. Each distinct include runs once per context.
+    '''
+    for source in sources:
+      key = hashlib.sha1(source.encode()).hexdigest()
+      if key in self.included:
+        continue
+      self.included.add(key)
+      exec(self.Compile(source, 'exec', '<include>'), self.namespace)
+
+  def Exec(self, source):
+    '''
+    Execute a <CODE> block. Return its out_.
+    '''
+    exec(self.Compile(source, 'exec', '<CODE>'), self.namespace)
+    return self.namespace['out_']
+
+  def Eval(self, expr):
+    '''
+    Evaluate a {} expression.
+    '''
+    shape, literals = ExprShape(expr)
+    func = self.funcs.get(shape)
+    if func == None:
+      if literals:
+        params = ', '.join(f'__lit{i}' for i in range(len(literals)))
+        # A lambda, not a bare eval: its literals stay visible in comprehensions.
+        func = eval(self.Compile(f'lambda {params}: ({shape}\n)', 'eval', '<inline>'), self.namespace)
+      else:
+        code = self.Compile(expr, 'eval', '<inline>')
+        func = lambda : eval(code, self.namespace)
+      self.funcs[shape] = func
+    return func(*literals)
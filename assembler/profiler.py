@@ -0,0 +1,103 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Profiler():
+  '''
+  Wall time and allocation peak of the phases of one or more builds, and
+  counters of the encoder hot path (encodes, cache hits and grammar
+  alternatives tried, per opcode).
+  Phases measured with Phase() get their allocation peak (while memory is
+  traced), nested phases included; time spent inside a phase, e.g. matching, is added with Add().
+  memory: trace allocations with tracemalloc (slows the build down).
+  Usage:
+    profiler = Profiler()
+    with profiler.Phase('Parse'):
+      ...
+    json.dump(profiler.Report(), f)
+  '''
+  def __init__(self, memory=True):
+    self.memory = memory
+    self.phases = {} # name => {calls, seconds, peak_bytes}
+    self.counters = {'encodes' : {}, 'cache_hits' : {}, 'match_attempts' : {}}
+    self.started_tracing = False
+    self.peaks = [] # Highest traced bytes seen so far by each open phase, outermost first.
+    if memory and not tracemalloc.is_tracing():
+      tracemalloc.start()
+      self.started_tracing = True
+
+  def Stop(self):
+    if self.started_tracing:
+      tracemalloc.stop()
+      self.started_tracing = False
+
+  def Entry(self, name):
+    entry = self.phases.get(name)
+    if entry == None:
+      entry = self.phases[name] = {'calls' : 0, 'seconds' : 0.0, 'peak_bytes' : None}
+    return entry
+
+  @contextmanager
+  def Phase(self, name):
+    entry = self.Entry(name) # Listed in the order phases start.
+    tracing = self.memory and tracemalloc.is_tracing()
+    if tracing:
+      # reset_peak() loses the peak of the enclosing phases: keep it on the stack.
+      if self.peaks:
+        self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+      tracemalloc.reset_peak()
+      start_bytes = tracemalloc.get_traced_memory()[0]
+      self.peaks.append(start_bytes)
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      entry['calls'] += 1
+      entry['seconds'] += time.perf_counter() - start
+      if tracing:
+        peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self.peaks:
+          self.peaks[-1] = max(self.peaks[-1], peak)
+        entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak - start_bytes)
+
+  def Add(self, name, seconds):
+    # Time of a part of a phase, e.g. 'Assemble/match'. No allocation peak.
+    entry = self.Entry(name)
+    entry['calls'] += 1
+    entry['seconds'] += seconds
+
+  def Counter(self, kind):
+    # {op : count} of a counter, to be updated in place.
+    return self.counters[kind]
+
+  def Count(self, kind, op, count=1):
+    counter = self.counters[kind]
+    counter[op] = counter.get(op, 0) + count
+
+  def Report(self):
+    '''
+    Return {
+      'phases'   : {name : {calls, seconds, peak_bytes}}, in the order first seen,
+      'counters' : {'encodes'/'cache_hits'/'match_attempts' : {op : count}},
+      'memory'   : allocations were traced
+    }
+    '''
+    return {
+      'phases'   : {name : dict(entry) for name, entry in self.phases.items()},
+      'counters' : {kind : dict(sorted(counter.items())) for kind, counter in self.counters.items()},
+      'memory'   : self.memory
+    }
+
+  def ReportText(self):
+    out = ['Profile:', '  Phase                          Calls    Seconds     Peak KiB']
+    for name, entry in self.phases.items():
+      peak = f'{entry["peak_bytes"] / 1024:12.1f}' if entry['peak_bytes'] != None else f'{"-":>12}'
+      out.append(f'  {name:<28} {entry["calls"]:>7} {entry["seconds"]:>10.4f} {peak}')
+    encodes  = self.counters['encodes']
+    hits     = self.counters['cache_hits']
+    attempts = self.counters['match_attempts']
+    if encodes or hits:
+      out.append('  Op          Encodes  Cache hits  Match attempts')
+      for op in sorted(set(encodes) | set(hits), key=lambda op: -(encodes.get(op, 0) + hits.get(op, 0))):
+        out.append(f'  {op:<10} {encodes.get(op, 0):>8} {hits.get(op, 0):>11} {attempts.get(op, 0):>15}')
+    return '\n'.join(out)
@@ -0,0 +1,258 @@
+import re
+from analysis import Resources, Blocks, Guard, SourceSlots, BankConflicts, PRED_BASE
+
+# Names declared in <REGS> without indices get virtual registers from here on
+# (see ParseRegLine), until AllocateRegisters maps them to physical ones.
+VIRTUAL_BASE = 1024
+# R0-R254, RZ is R255.
+NUM_REGISTERS = 255
+# Widths of the names: 32, 64 and 128 bits.
+vector_widths = (1, 2, 4)
+
+virtual_re = re.compile(r'\bR(\d+)\b')
+
+def VariableInfo(program, var_of, bases):
+  '''
+  Uses and definitions of the allocated names, per instruction.
+  Every register operand must be a whole, aligned part of one name:
+  LDG.64 v[2] on v[4] is fine, IMAD.WIDE on a 32-bit name is not.
+  Return:
+    [(uses, defs, kills)], sets of names. A definition kills the name when
+    it writes all of it and is not predicated.
+  '''
+  info = []
+  for instr in program['instructions']:
+    res = Resources(instr)
+    for group in res['groups']:
+      names = {var_of.get(reg) for reg in group}
+      if names == {None}:
+        continue
+      name = var_of.get(group[0])
+      part = group[0] - bases[name][0] if name != None else 0
+      if len(names) != 1 or part % len(group) != 0 or part + len(group) > bases[name][1]:
+        if name != None and bases[name][1] >= len(group):
+          raise Exception(f'{name}[{part}] is not aligned for a {32 * len(group)} bit operand, '
+                          f'at line {instr["file_line_num"]}.\n')
+        name = name or var_of[group[-1]]
+        raise Exception(f'{name} is used as a {32 * len(group)} bit operand, at line {instr["file_line_num"]}. '
+                        f'Declare it as {name}[{len(group)}].\n')
+    uses = {var_of[reg] for reg in res['src'] if reg in var_of}
+    defs = {var_of[reg] for reg in res['dst'] if reg in var_of}
+    kills = set()
+    if not Guard(instr):
+      written = set(res['dst'])
+      kills = {name for name in defs
+               if all(reg in written for reg in range(bases[name][0], bases[name][0] + bases[name][1]))}
+    info.append((uses, defs, kills))
+  return info
+
+def WaitMask(instr):
+  wait = instr['ctrl'].split(':')[0]
+  return 0 if wait == '--' else int(wait)
+
+def PendingInterference(program, info, blocks, edges):
+  '''
+  Variable latency ops read their sources (LDG/LDS/STG/STS) and write their
+  results (LDG/LDS/S2R) after they issue, until an instruction waits on their
+  read/write barrier. Until then, names defined on any path from them must not
+  share their registers. Without a barrier, that is all the code they reach.
+  Adds those pairs to edges.
+  '''
+  instructions = program['instructions']
+  block_of = {}
+  for i, block in enumerate(blocks):
+    for idx in range(block['start'], block['end']):
+      block_of[idx] = i
+  for idx, instr in enumerate(instructions):
+    res = Resources(instr)
+    if not res['var_read'] and not res['var_write']:
+      continue
+    _, read_bar, write_bar, _, _ = instr['ctrl'].split(':')
+    uses, defs, kills = info[idx]
+    pending = []
+    if res['var_read'] and uses:
+      pending.append((uses, None if read_bar == '-' else int(read_bar)))
+    if res['var_write'] and defs:
+      pending.append((defs, None if write_bar == '-' else int(write_bar)))
+    for names, bar in pending:
+      block = blocks[block_of[idx]]
+      ranges = [(idx + 1, block['end'], block)]
+      visited = set()
+      while ranges:
+        start, end, block = ranges.pop()
+        for j in range(start, end):
+          if bar != None and WaitMask(instructions[j]) & (1 << bar):
+            break
+          for name in info[j][1]:
+            for other in names - {name}:
+              edges.setdefault(name, set()).add(other)
+              edges.setdefault(other, set()).add(name)
+        else:
+          for succ in block['succ']:
+            if succ not in visited:
+              visited.add(succ)
+              ranges.append((blocks[succ]['start'], blocks[succ]['end'], blocks[succ]))
+
+def Interference(program, info):
+  '''
+  Live ranges over the control flow graph, iterated to a fixed point, plus
+  the registers still read or written by variable latency ops (see
+  PendingInterference).
+  Return:
+    {name : set of names live at one of its definitions (or the other way round)}
+  '''
+  blocks = Blocks(program)
+  gen  = []
+  kill = []
+  for block in blocks:
+    block_gen = set()
+    block_kill = set()
+    for idx in range(block['end'] - 1, block['start'] - 1, -1):
+      uses, defs, kills = info[idx]
+      block_gen = (block_gen - kills) | uses
+      block_kill |= kills
+    gen.append(block_gen)
+    kill.append(block_kill)
+
+  live_in = [set() for block in blocks]
+  changed = True
+  while changed:
+    changed = False
+    for i in range(len(blocks) - 1, -1, -1):
+      live_out = set().union(*(live_in[succ] for succ in blocks[i]['succ']))
+      new_in = gen[i] | (live_out - kill[i])
+      if new_in != live_in[i]:
+        live_in[i] = new_in
+        changed = True
+
+  edges = {}
+  PendingInterference(program, info, blocks, edges)
+  for i, block in enumerate(blocks):
+    live = set().union(*(live_in[succ] for succ in block['succ']))
+    for idx in range(block['end'] - 1, block['start'] - 1, -1):
+      uses, defs, kills = info[idx]
+      for name in defs:
+        edges.setdefault(name, set()).update(live - {name})
+        for other in live - {name}:
+          edges.setdefault(other, set()).add(name)
+      live = (live - kills) | uses
+  return edges
+
+def Color(order, bases, edges, fixed, operands):
+  '''
+  Give each name, in order, the lowest aligned registers free of its
+  interfering names and of fixed registers. Registers below the current peak
+  are all candidates, the one with the fewest bank conflicts wins.
+  operands: {name : [source registers of an instruction reading it]}
+  Return:
+    ({name : register}, peak register count, bank conflicts)
+  '''
+  assigned = {}
+  physical = {} # virtual register => physical register, of the names assigned so far
+  peak = max(fixed) + 1 if fixed else 0
+  def Physical(reg):
+    return reg if reg < VIRTUAL_BASE else physical.get(reg)
+  def Conflicts(name, start):
+    cost = 0
+    base, width = bases[name]
+    for regs in operands.get(name, ()):
+      read = []
+      for reg in regs:
+        if base <= reg < base + width:
+          read.append(start + reg - base)
+        elif Physical(reg) != None:
+          read.append(Physical(reg))
+      cost += BankConflicts(read)
+    return cost
+
+  for name in order:
+    width = bases[name][1]
+    busy = set(fixed)
+    for other in edges.get(name, ()):
+      if other in assigned:
+        busy.update(range(assigned[other], assigned[other] + bases[other][1]))
+    free = [start for start in range(0, NUM_REGISTERS - width + 1, width)
+            if busy.isdisjoint(range(start, start + width))]
+    if not free:
+      raise Exception(f'Out of registers, cannot allocate {name}.\n')
+    candidates = [start for start in free if start + width <= peak] or free[:1]
+    assigned[name] = min(candidates, key=lambda start: (Conflicts(name, start), start))
+    peak = max(peak, assigned[name] + width)
+    for part in range(width):
+      physical[bases[name][0] + part] = assigned[name] + part
+
+  conflicts = 0
+  counted = set()
+  for name, instrs in operands.items():
+    for regs in instrs:
+      if id(regs) not in counted:
+        counted.add(id(regs))
+        conflicts += BankConflicts(Physical(reg) for reg in regs)
+  return assigned, peak, conflicts
+
+def AllocateRegisters(program):
+  '''
+  Give physical registers to the names of program (result of Parse) declared
+  without indices in <REGS>. Until then they are virtual registers from
+  VIRTUAL_BASE on, program['alloc'] has their widths.
+  Names interfere when one is live where the other is defined, or is still
+  read or written by a variable latency op there (up to the instruction
+  waiting on its barrier, as the control codes say). Registers named
+  with indices or written as R<n> anywhere are left alone. Names of 64/128 bits
+  start at a multiple of 2/4. A few orders are tried, the smallest register
+  count wins, then the fewest register bank conflicts.
+  Return:
+    report (str): names allocated, register count and bank conflicts.
+  '''
+  widths = program['alloc']
+  bases = {name : (program['regs'][name], width) for name, width in widths.items()}
+  var_of = {}
+  for name, (base, width) in bases.items():
+    for reg in range(base, base + width):
+      var_of[reg] = name
+
+  info = VariableInfo(program, var_of, bases)
+  edges = Interference(program, info)
+
+  fixed = set()
+  first = {}
+  operands = {}
+  for idx, instr in enumerate(program['instructions']):
+    res = Resources(instr)
+    fixed.update(reg for reg in res['src'] + res['dst'] if reg < PRED_BASE)
+    uses, defs, kills = info[idx]
+    for name in sorted(defs | uses):
+      first.setdefault(name, idx)
+    regs = tuple(SourceSlots(res).values())
+    # Bank conflicts need at least three registers read.
+    if len(set(regs)) > 2:
+      for name in uses:
+        operands.setdefault(name, []).append(regs)
+
+  names = sorted(widths, key=lambda name: first.get(name, len(first)))
+  orders = [
+    names,
+    sorted(names, key=lambda name: -widths[name]),
+    sorted(names, key=lambda name: (-widths[name], -len(edges.get(name, ()))))
+  ]
+  assigned, peak, conflicts = min((Color(order, bases, edges, fixed, operands) for order in orders),
+                                  key=lambda result: (result[1], result[2]))
+
+  physical = {}
+  for name, (base, width) in bases.items():
+    for part in range(width):
+      physical[base + part] = assigned[name] + part
+    program['regs'][name] = assigned[name]
+  def Replace(match):
+    reg = int(match.group(1))
+    return 'R' + str(physical[reg]) if reg >= VIRTUAL_BASE else match.group(0)
+  resolved = {}
+  instructions = []
+  for instr in program['instructions']:
+    rest = instr['rest']
+    if rest not in resolved:
+      resolved[rest] = virtual_re.sub(Replace, rest)
+    instructions.append(dict(instr, rest=resolved[rest]) if resolved[rest] != rest else instr)
+  program['instructions'] = instructions
+  return (f'Registers: {len(widths)} names allocated, {peak} registers used, '
+          f'{conflicts} register bank conflicts.')
@@ -0,0 +1,78 @@
+from analysis import Resources, Blocks, SourceSlots, BankConflicts
+
+# Ops that read their operands through the reuse cache.
+reuse_ops = {'FFMA', 'FADD', 'FMUL', 'IMAD', 'IADD3', 'LOP3', 'SHF', 'ISETP'}
+# The cache only survives back to back issue: no stall, yield or wait in between.
+MAX_REUSE_STALL = 1
+
+def ReuseSlots(res):
+  '''
+  Return:
+    {slot : register} this instruction can take from the reuse cache.
+  '''
+  if res['op'] not in reuse_ops:
+    return {}
+  slots = SourceSlots(res)
+  if res['op'] == 'IMAD' and res['gram']['code'] != 0x224:
+    slots.pop('rs2', None) # 64-bit operand of IMAD.WIDE/IMAD.HI
+  return slots
+
+def CanReuse(instr, next_instr):
+  # Hardware rules between an instruction and the next one issued.
+  _, _, _, yield_, stall = instr['ctrl'].split(':')
+  next_wait = next_instr['ctrl'].split(':')[0]
+  if int(stall, 16) > MAX_REUSE_STALL or yield_ in ('y', 'Y'):
+    return False
+  return next_wait == '--'
+
+def SetReuse(instr, slots):
+  '''
+  Return:
+    instr with .reuse set on exactly the operands in slots.
+  '''
+  rest = instr['rest'].replace('.reuse', '')
+  if slots:
+    op = instr['op']
+    result = Resources(dict(instr, rest=rest))['gram']['re'].match(op + rest)
+    for slot in sorted(slots, key=lambda slot: -result.end(slot)):
+      end = result.end(slot) - len(op)
+      rest = rest[:end] + '.reuse' + rest[end:]
+  return dict(instr, rest=rest)
+
+def SetReuseFlags(program):
+  '''
+  Recompute the operand reuse flags of all instructions of a program (result of Parse).
+  An operand is flagged when the next instruction, issued right after it in
+  the same basic block, reads the same register in the same slot, and the
+  instruction does not write that register itself. Flags written in the source
+  are dropped first. Control codes are read, so run this after ctrl/sched.
+  Return:
+    report (str): flags set and register bank conflicts avoided.
+  '''
+  instructions = program['instructions']
+  new_instructions = list(instructions)
+  flags = 0
+  conflicts_before = conflicts_after = 0
+  for block in Blocks(program):
+    cached = {} # slot => register, from the flags of the previous instruction
+    for idx in range(block['start'], block['end']):
+      instr = instructions[idx]
+      res = Resources(instr)
+      slots = ReuseSlots(res)
+      regs = SourceSlots(res)
+      conflicts_before += BankConflicts(regs.values())
+      conflicts_after  += BankConflicts(reg for slot, reg in regs.items() if cached.get(slot) != reg)
+
+      reuse = {}
+      if idx + 1 < block['end'] and slots and CanReuse(instr, instructions[idx + 1]):
+        next_slots = ReuseSlots(Resources(instructions[idx + 1]))
+        reuse = {slot : reg for slot, reg in slots.items()
+                 if next_slots.get(slot) == reg and reg not in res['dst']}
+      if reuse or '.reuse' in instr['rest']:
+        new_instructions[idx] = SetReuse(instr, reuse)
+      flags += len(reuse)
+      cached = reuse
+  changed = sum(old['rest'] != new['rest'] for old, new in zip(instructions, new_instructions))
+  program['instructions'] = new_instructions
+  return (f'Reuse: {flags} flags set on {changed} changed instructions, register bank conflicts '
+          f'{conflicts_before} -> {conflicts_after} ({conflicts_before - conflicts_after} avoided).')
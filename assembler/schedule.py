@@ -0,0 +1,428 @@
+import heapq
+from analysis import Resources, Guard, Blocks
+
+# Dependency barriers usable from control codes. ReadCtrl stores the digit as
+# is and 7 means none; 1-6 are accepted by ctrl_re, the hardware has 6.
+barriers = (1, 2, 3, 4, 5)
+MAX_STALL = 15
+# A barrier is set one cycle after issue. Waiting on it needs 2 cycles.
+BARRIER_SETUP = 2
+
+class CtrlState():
+  '''
+  What is still in flight at the issue slot of the next instruction.
+    ready  : reg => cycles until its fixed latency result is written
+    write  : reg => barriers of variable latency writes to it
+    read   : reg => barriers of variable latency reads of it
+    setup  : barrier => cycles until it can be waited on
+    age    : barrier => when it was last set (to pick one to share)
+    owners : barrier => (instruction index, 'r'/'w') of the ops pending on it
+  '''
+  def __init__(self):
+    self.ready = {}
+    self.write = {}
+    self.read  = {}
+    self.setup = {}
+    self.age   = {}
+    self.owners = {}
+
+  def Copy(self):
+    state = CtrlState()
+    state.ready = dict(self.ready)
+    state.write = {reg : set(bars) for reg, bars in self.write.items()}
+    state.read  = {reg : set(bars) for reg, bars in self.read.items()}
+    state.setup = dict(self.setup)
+    state.age   = dict(self.age)
+    state.owners = {bar : set(owners) for bar, owners in self.owners.items()}
+    return state
+
+  def Merge(self, other):
+    '''
+    Union with the state of another path into the same label.
+    Return:
+      True if self changed.
+    '''
+    changed = False
+    for mine, theirs in ((self.ready, other.ready), (self.setup, other.setup), (self.age, other.age)):
+      for key, value in theirs.items():
+        if mine.get(key, -1) < value:
+          mine[key] = value
+          changed = True
+    for mine, theirs in ((self.write, other.write), (self.read, other.read), (self.owners, other.owners)):
+      for reg, bars in theirs.items():
+        if not bars <= mine.get(reg, set()):
+          mine[reg] = mine.get(reg, set()) | bars
+          changed = True
+    return changed
+
+  def Equal(self, other):
+    return (self.ready, self.write, self.read, self.setup, self.age, self.owners) == \
+           (other.ready, other.write, other.read, other.setup, other.age, other.owners)
+
+  def Advance(self, cycles):
+    for table in (self.ready, self.setup):
+      for key in list(table):
+        table[key] -= cycles
+        if table[key] <= 0:
+          del table[key]
+
+  def Wait(self, bars):
+    for table in (self.write, self.read):
+      for reg in list(table):
+        table[reg] -= bars
+        if not table[reg]:
+          del table[reg]
+    for bar in bars:
+      self.setup.pop(bar, None)
+      self.owners.pop(bar, None)
+
+  def Allocate(self, owner, hints, clock, exclude=()):
+    '''
+    Pick a barrier for owner: the one it had before if only its own earlier
+    instances (e.g. last loop iteration) are pending there, else a free one,
+    else share the one set longest ago.
+    '''
+    hint = hints.get(owner)
+    if hint != None and hint not in exclude and self.owners.get(hint, set()) <= {owner}:
+      bar = hint
+    else:
+      free = [bar for bar in barriers if bar not in exclude and not self.owners.get(bar)]
+      if free:
+        bar = free[0]
+      else:
+        bar = min((bar for bar in barriers if bar not in exclude), key=lambda bar: self.age.get(bar, -1))
+    hints[owner] = bar
+    self.owners.setdefault(bar, set()).add(owner)
+    self.age[bar] = clock
+    self.setup[bar] = BARRIER_SETUP
+    return bar
+
+def WrittenLater(instructions, blocks):
+  '''
+  Return:
+    [set of registers some instruction after it (on any path) may write],
+    per instruction.
+  '''
+  block_writes = []
+  for block in blocks:
+    writes = set()
+    for instr in instructions[block['start']:block['end']]:
+      writes.update(Resources(instr)['dst'])
+    block_writes.append(writes)
+  exit_writes = [set() for _ in blocks]
+  changed = True
+  while changed:
+    changed = False
+    for i in reversed(range(len(blocks))):
+      writes = set()
+      for succ in blocks[i]['succ']:
+        writes |= block_writes[succ] | exit_writes[succ]
+      if writes != exit_writes[i]:
+        exit_writes[i] = writes
+        changed = True
+  later = [None] * len(instructions)
+  for i, block in enumerate(blocks):
+    writes = set(exit_writes[i])
+    for idx in reversed(range(block['start'], block['end'])):
+      later[idx] = set(writes)
+      writes.update(Resources(instructions[idx])['dst'])
+  return later
+
+def ScheduleCtrlBlock(instructions, start, state, hints, clock, written_later):
+  '''
+  Walk one basic block, instructions[start:], from state (modified).
+  hints: (instruction index, 'r'/'w') => barrier it got last time.
+  written_later: see WrittenLater. A read barrier is only set if a source
+                 register may be overwritten afterwards.
+  Return:
+    (ctrls, entry_delay, clock)
+    ctrls      : [(delay before it, wait mask, read barrier, write barrier)] per instruction
+    entry_delay: cycles the first instruction has to wait, to be added
+                 to the stall of the instruction(s) before the block.
+  '''
+  ctrls = []
+  for idx, instr in enumerate(instructions, start):
+    res = Resources(instr)
+    src = res['src'] + Guard(instr)
+    delay = 0
+    waits = set()
+    for reg in src:
+      delay = max(delay, state.ready.get(reg, 0))
+      waits |= state.write.get(reg, set())
+    for reg in res['dst']:
+      # In order completion of fixed latency writes to the same register.
+      delay = max(delay, state.ready.get(reg, 0) - res['lat'] + 1)
+      waits |= state.write.get(reg, set()) | state.read.get(reg, set())
+    for bar in waits:
+      delay = max(delay, state.setup.get(bar, 0))
+    state.Advance(delay)
+    state.Wait(waits)
+    clock += delay
+
+    read_bar = write_bar = None
+    if res['var_read'] and not written_later[idx].isdisjoint(res['src']):
+      read_bar = state.Allocate((idx, 'r'), hints, clock)
+      for reg in res['src']:
+        state.read.setdefault(reg, set()).add(read_bar)
+    if res['var_write'] and res['dst']:
+      write_bar = state.Allocate((idx, 'w'), hints, clock, (read_bar,))
+      for reg in res['dst']:
+        state.ready.pop(reg, None)
+        state.write[reg] = {write_bar}
+    else:
+      for reg in res['dst']:
+        state.ready[reg] = res['lat']
+    ctrls.append((delay, sum(1 << bar for bar in waits), read_bar, write_bar))
+    state.Advance(1)
+    clock += 1
+  return ctrls, ctrls[0][0] if ctrls else 0, clock
+
+def CtrlText(old_ctrl, stall, wait, read_bar, write_bar):
+  # The yield hint of the source is kept.
+  yield_ = old_ctrl.split(':')[3]
+  return '%s:%s:%s:%s:%x' % ('--' if wait == 0 else '%02d' % wait,
+                             '-' if read_bar == None else read_bar,
+                             '-' if write_bar == None else write_bar,
+                             yield_, stall)
+
+def AssignControlCodes(program):
+  '''
+  Replace the control codes of all instructions of a program (result of Parse):
+    stall : minimal number of cycles before the next instruction may issue,
+            from the 'lat' of fixed latency ops in the grammar,
+    read/write barriers for variable latency ops (LDG, LDS, S2R, stores),
+    wait masks on the instructions that depend on them.
+  The yield flag is left as written. Registers still in flight at a branch
+  are carried to its target; the state at each label is the union over all
+  paths into it, iterated until it stops growing.
+  Return:
+    report (str).
+  '''
+  instructions = program['instructions']
+  if not instructions:
+    return 'Control codes: no instructions.'
+  blocks = Blocks(program)
+  preds = [[] for _ in blocks]
+  for i, block in enumerate(blocks):
+    for succ in block['succ']:
+      preds[succ].append(i)
+
+  # Entry state of a label: union of the exit states of the paths into it.
+  # Barrier choices depend on the entry state, so this may cycle. If it
+  # does, entry states only grow from then on, which ends.
+  entry_states = [CtrlState() for _ in blocks]
+  exit_states  = [None] * len(blocks)
+  hints = {}
+  written_later = WrittenLater(instructions, blocks)
+  for iteration in range(64):
+    changed = False
+    results = []
+    for i, block in enumerate(blocks):
+      entry = CtrlState() if iteration < 16 else entry_states[i]
+      for pred in preds[i]:
+        if exit_states[pred] != None:
+          entry.Merge(exit_states[pred])
+      changed |= not entry.Equal(entry_states[i])
+      entry_states[i] = entry
+      state = entry.Copy()
+      results.append(ScheduleCtrlBlock(instructions[block['start']:block['end']], block['start'], state, hints,
+                                        block['start'] * MAX_STALL, written_later))
+      exit_states[i] = state
+    if not changed:
+      break
+  else:
+    raise Exception('Control codes did not converge.\n')
+
+  # Stall of each instruction: delay of the next one in its block, or the
+  # largest entry delay of the blocks it leads to.
+  new_instructions = list(instructions)
+  cycles = 0
+  bars_used = set()
+  for i, (block, (ctrls, entry_delay, clock)) in enumerate(zip(blocks, results)):
+    for k, (delay, wait, read_bar, write_bar) in enumerate(ctrls):
+      if k + 1 < len(ctrls):
+        stall = 1 + ctrls[k + 1][0]
+      else:
+        stall = 1 + max([results[succ][1] for succ in block['succ']] + [0])
+      if stall > MAX_STALL:
+        raise Exception(f'Stall of {stall} cycles needed at line {instructions[block["start"]+k]["file_line_num"]}.\n')
+      idx = block['start'] + k
+      instr = instructions[idx]
+      new_instructions[idx] = dict(instr, ctrl=CtrlText(instr['ctrl'], stall, wait, read_bar, write_bar))
+      cycles += stall
+      bars_used |= {bar for bar in (read_bar, write_bar) if bar != None}
+  changed = sum(old['ctrl'] != new['ctrl'] for old, new in zip(instructions, new_instructions))
+  program['instructions'] = new_instructions
+  return (f'Control codes: {changed}/{len(instructions)} changed, {len(blocks)} blocks, '
+          f'{cycles} stall cycles in total, barriers {sorted(bars_used)} used.')
+
+
+#####################
+# List scheduling
+#####################
+# Estimated latency of variable latency ops, only to order instructions.
+# Correctness comes from the barriers AssignControlCodes sets afterwards.
+estimated_latency = {'LDG' : 200, 'LDS' : 24, 'S2R' : 24}
+# Instructions nothing moves across.
+fences = {'BAR', 'NOP', 'BRA', 'EXIT'}
+
+def Latency(res):
+  return estimated_latency.get(res['op'], res['lat'])
+
+def MemAccess(res):
+  # (space, store, base register, lo, hi) of a memory instruction.
+  captured = res['captured']
+  base = captured.get('rs0')
+  offset = int(captured.get('is0w24') or '0', 0)
+  size = 4 * {'.64' : 2, '.128' : 4}.get(captured.get('type'), 1)
+  return res['mem'], res['store'], None if base == 'RZ' else base, offset, offset + size
+
+def BuildDag(instructions):
+  '''
+  Dependency graph of a basic block.
+  Edges: register RAW (latency of the producer), WAR and WAW (ordering),
+  memory ops of the same space unless both are loads or their addresses
+  provably do not overlap (same base register value, disjoint offsets),
+  and fences (BAR, NOP, BRA, EXIT) against everything.
+  Return:
+    (succs, preds): [{j : latency}] and [{i : latency}] per instruction.
+  '''
+  n = len(instructions)
+  succs = [{} for _ in range(n)]
+  preds = [{} for _ in range(n)]
+  def Edge(i, j, lat):
+    if succs[i].get(j, -1) < lat:
+      succs[i][j] = lat
+      preds[j][i] = lat
+
+  last_write = {} # reg => index
+  readers = {} # reg => [index] since last write
+  version = {} # reg => number of writes so far
+  loads, stores = [], [] # (index, access, base version) since last fence
+  last_fence = None
+  since_fence = []
+  for j, instr in enumerate(instructions):
+    res = Resources(instr)
+    if res['op'] in fences:
+      for i in since_fence:
+        Edge(i, j, 1)
+      if last_fence != None:
+        Edge(last_fence, j, 1)
+      last_fence = j
+      since_fence = []
+      loads, stores = [], []
+    else:
+      if last_fence != None:
+        Edge(last_fence, j, 1)
+      since_fence.append(j)
+    for reg in res['src'] + Guard(instr):
+      if reg in last_write:
+        i = last_write[reg]
+        Edge(i, j, Latency(Resources(instructions[i])))
+      readers.setdefault(reg, []).append(j)
+    for reg in res['dst']:
+      if reg in last_write:
+        i = last_write[reg]
+        Edge(i, j, max(1, Latency(Resources(instructions[i])) - Latency(res) + 1))
+      for i in readers.get(reg, ()):
+        if i != j:
+          Edge(i, j, 1)
+      readers[reg] = []
+    if res['mem'] != None:
+      access = MemAccess(res)
+      base_version = version.get(access[2])
+      for i, other, other_version in (stores if not res['store'] else stores + loads):
+        if other[0] != access[0]:
+          continue
+        if other[2] == access[2] and other_version == base_version and \
+           (other[4] <= access[3] or access[4] <= other[3]):
+          continue
+        Edge(i, j, 1)
+      (stores if res['store'] else loads).append((j, access, base_version))
+    for reg in res['dst']:
+      last_write[reg] = j
+      version[f'R{reg}'] = version.get(f'R{reg}', 0) + 1
+  return succs, preds
+
+def EstimateCycles(order, preds, latencies):
+  '''
+  Single issue, in order: cycles until the last result of the block is ready.
+  '''
+  issue = {}
+  clock = -1
+  done = 0
+  for j in order:
+    clock = max([clock + 1] + [issue[i] + lat for i, lat in preds[j].items()])
+    issue[j] = clock
+    done = max(done, clock + latencies[j])
+  return done
+
+def ListSchedule(instructions):
+  '''
+  Order one basic block: each cycle, issue the ready instruction with the
+  longest latency-weighted path to the end of the block (first in source
+  order on ties).
+  Return:
+    (order, cycles before, cycles after)
+  '''
+  n = len(instructions)
+  succs, preds = BuildDag(instructions)
+  latencies = [Latency(Resources(instr)) for instr in instructions]
+  height = [0] * n
+  for i in reversed(range(n)):
+    height[i] = max([latencies[i]] + [lat + height[j] for j, lat in succs[i].items()])
+
+  remaining = [len(preds[j]) for j in range(n)]
+  earliest = [0] * n
+  waiting = [] # (earliest cycle, -height, index): all preds issued
+  ready = [] # (-height, index)
+  for j in range(n):
+    if remaining[j] == 0:
+      heapq.heappush(ready, (-height[j], j))
+  order = []
+  clock = 0
+  while len(order) < n:
+    while waiting and waiting[0][0] <= clock:
+      _, neg_height, j = heapq.heappop(waiting)
+      heapq.heappush(ready, (neg_height, j))
+    if not ready:
+      clock = waiting[0][0]
+      continue
+    _, i = heapq.heappop(ready)
+    order.append(i)
+    for j, lat in succs[i].items():
+      earliest[j] = max(earliest[j], clock + lat)
+      remaining[j] -= 1
+      if remaining[j] == 0:
+        heapq.heappush(waiting, (earliest[j], -height[j], j))
+    clock += 1
+  before = EstimateCycles(range(n), preds, latencies)
+  after = EstimateCycles(order, preds, latencies)
+  if after > before: # The heuristic lost. Keep the source order.
+    return list(range(n)), before, before
+  return order, before, after
+
+def ScheduleBlocks(program):
+  '''
+  Reorder the instructions of every basic block (split at labels, BRA and
+  EXIT) by list scheduling, then recompute the control codes, which the
+  source wrote for the old order (AssignControlCodes).
+  Return:
+    report (str).
+  '''
+  instructions = program['instructions']
+  new_instructions = []
+  before = after = moved = 0
+  for block in Blocks(program):
+    block_instrs = instructions[block['start']:block['end']]
+    order, block_before, block_after = ListSchedule(block_instrs)
+    before += block_before
+    after += block_after
+    for k, i in enumerate(order):
+      moved += k != i
+      new_instructions.append(dict(block_instrs[i], line_num=block['start'] + k))
+  program['instructions'] = new_instructions
+  ctrl_report = AssignControlCodes(program)
+  speedup = before / after if after else 1.0
+  return (f'Schedule: {moved}/{len(instructions)} instructions moved, estimated '
+          f'{before} -> {after} cycles ({speedup:.2f}x).\n{ctrl_report}')
@@ -0,0 +1,357 @@
+from analysis import Resources, Blocks, Guard, Regs
+
+# Shared memory: 32 banks of 4 bytes. A wavefront serves one 4-byte word per bank.
+NUM_SMEM_BANKS = 32
+WARP_SIZE = 32
+access_bytes = {'.U8' : 1, '.S8' : 1, '.U16' : 2, '.S16' : 2, '.32' : 4, '.64' : 8, '.128' : 16}
+
+# Value of a register in the lanes of a warp: (lanes, base, align)
+#   lane i holds base + lanes[i]. base None: unknown, but the same in all
+#   lanes and a multiple of align (a power of 2).
+# None: unknown, or not a function of the lane we can follow.
+# SR_TID.X is 32 * warp + lane (blockDim.x taken as a multiple of 32), so
+# SR_TID.Y/Z and SR_CTAID are the same in all lanes.
+ZERO_LANES = (0,) * WARP_SIZE
+LANE_IDS   = tuple(range(WARP_SIZE))
+UNALIGNED  = 1
+
+def Const(value):
+  return (ZERO_LANES, value, 0)
+
+def Uniform(align=UNALIGNED):
+  return (ZERO_LANES, None, align)
+
+def LowBit(value):
+  # Largest power of 2 dividing value. 0 is a multiple of everything.
+  return value & -value if value else 1 << 32
+
+def Align(value):
+  lanes, base, align = value
+  return LowBit(base) if base != None else align
+
+def KnownInt(value):
+  if value == None or value[1] == None or any(value[0]):
+    return None
+  return value[1]
+
+def IsUniform(value):
+  return value != None and not any(value[0])
+
+def Add(x, y):
+  if x == None or y == None:
+    return None
+  lanes = tuple(a + b for a, b in zip(x[0], y[0]))
+  if x[1] != None and y[1] != None:
+    return (lanes, x[1] + y[1], 0)
+  return (lanes, None, min(Align(x), Align(y)))
+
+def Neg(x):
+  if x == None:
+    return None
+  return (tuple(-a for a in x[0]), -x[1] if x[1] != None else None, x[2])
+
+def Mul(x, y):
+  if x == None or y == None:
+    return None
+  if KnownInt(x) != None:
+    x, y = y, x
+  factor = KnownInt(y)
+  if factor == None:
+    return Uniform() if IsUniform(x) and IsUniform(y) else None
+  if x[1] != None:
+    return (tuple(a * factor for a in x[0]), x[1] * factor, 0)
+  return (tuple(a * factor for a in x[0]), None, x[2] * LowBit(factor))
+
+def Exact(x, function):
+  # function applied to every lane of a value with a known base.
+  return (tuple(function(x[1] + a) for a in x[0]), 0, 0)
+
+def Shr(x, shift):
+  if x == None:
+    return None
+  if x[1] != None:
+    return Exact(x, lambda a: a >> shift)
+  if x[2] >= 1 << shift:
+    # (U + a) >> s == (U >> s) + (a >> s) when U is a multiple of 1 << s.
+    return (tuple(a >> shift for a in x[0]), None, x[2] >> shift)
+  return Uniform() if IsUniform(x) else None
+
+def Logic(x, mask, op):
+  '''
+  x & mask, x | mask or x ^ mask (op: 'and', 'or', 'xor'), mask a known value.
+  With an unknown base U (multiple of A) and lanes in [0, A), the bits of U
+  and of the lanes do not overlap.
+  '''
+  functions = {'and' : lambda a: a & mask, 'or' : lambda a: a | mask, 'xor' : lambda a: a ^ mask}
+  if x == None:
+    return None
+  if x[1] != None:
+    return Exact(x, functions[op])
+  lanes, base, align = x
+  if any(a < 0 or a >= align for a in lanes):
+    return Uniform() if IsUniform(x) else None
+  new_lanes = tuple(functions[op](a) for a in lanes)
+  if op == 'and':
+    return (new_lanes, 0, 0) if mask < align else (new_lanes, None, align)
+  if mask < align:
+    return (new_lanes, None, align)
+  return Uniform() if IsUniform(x) else None
+
+def Meet(x, y):
+  # Value at a join: what both sides agree on.
+  if x == y:
+    return x
+  if x == None or y == None or x[0] != y[0]:
+    return None
+  align = min(Align(x), Align(y))
+  if x[1] != None and y[1] != None:
+    align = min(align, LowBit(x[1] - y[1]))
+  return (x[0], None, align)
+
+def MeetState(x, y):
+  state = {}
+  for reg, value in x.items():
+    value = Meet(value, y.get(reg))
+    if value != None:
+      state[reg] = value
+  return state
+
+# LOP3.LUT truth tables of a op b, with c = RZ (bits of a=0xf0, b=0xcc, c=0xaa, c clear).
+lop3_ops = {0x40 : 'and', 0x54 : 'or', 0x14 : 'xor'}
+
+def Operand(state, captured, slot):
+  '''
+  Value of an operand: register (rs0/rs1/rs2, negated with its neg flag),
+  integer immediate or constant bank word (same in all lanes).
+  '''
+  get = captured.get
+  if slot in ('rs0', 'rs1', 'rs2'):
+    name = get(slot)
+    if name == None:
+      return None
+    if name == 'RZ':
+      value = Const(0)
+    else:
+      regs = Regs(name)
+      value = state.get(regs[0]) if regs else None
+    return Neg(value) if get(slot + 'neg') else value
+  if slot in ('cs1', 'cs2', 'cs1add'):
+    return Uniform() if get(slot) != None else None
+  if get(slot) == None:
+    return None
+  return Const(int(get(slot), 0))
+
+def FirstOperand(state, captured, slots):
+  for slot in slots:
+    if captured.get(slot) != None:
+      return Operand(state, captured, slot)
+  return None
+
+def Evaluate(instr, res, state):
+  '''
+  Return:
+    value written to the (first) destination register, None if unknown.
+  '''
+  op = res['op']
+  captured = res['captured']
+  get = captured.get
+  if op == 'S2R':
+    sr = get('sr')
+    if sr == 'SR_TID.X':
+      return (LANE_IDS, None, WARP_SIZE)
+    if sr == 'SR_LANEID':
+      return (LANE_IDS, 0, 0)
+    if sr.startswith('SR_TID') or sr.startswith('SR_CTAID'):
+      return Uniform()
+    return None
+  if op == 'MOV':
+    return FirstOperand(state, captured, ('is1', 'cs1', 'rs1'))
+  if op == 'IADD3':
+    if get('x'):
+      return None
+    value = Const(0)
+    for term in ('rs0', ('is1', 'cs1', 'rs1'), 'rs2', ('is2', 'cs2')):
+      slots = term if isinstance(term, tuple) else (term,)
+      if any(get(slot) != None for slot in slots):
+        value = Add(value, FirstOperand(state, captured, slots))
+    return value
+  if op == 'IMAD':
+    if res['gram']['code'] == 0x227: # IMAD.HI
+      return None
+    a = Operand(state, captured, 'rs0')
+    if get('is2') != None or get('cs2') != None:
+      b = Operand(state, captured, 'rs2')
+      c = FirstOperand(state, captured, ('is2', 'cs2'))
+    else:
+      b = FirstOperand(state, captured, ('is1', 'cs1', 'rs1'))
+      c = Operand(state, captured, 'rs2')
+    # IMAD.WIDE: the low word, as long as nothing carries out of it.
+    return Add(Mul(a, b), c)
+  if op == 'SHF':
+    shift = KnownInt(FirstOperand(state, captured, ('is1', 'cs1', 'rs1')))
+    if shift == None or not 0 <= shift < 32:
+      return None
+    low, high = get('rs0'), get('rs2')
+    if get('lr') == '.L' and not get('hi') and high == 'RZ':
+      return Mul(Operand(state, captured, 'rs0'), Const(1 << shift))
+    if get('lr') == '.R' and get('hi') and low == 'RZ':
+      return Shr(Operand(state, captured, 'rs2'), shift)
+    if get('lr') == '.R' and not get('hi') and high == 'RZ' and get('type') in (None, '.U32', '.S32'):
+      return Shr(Operand(state, captured, 'rs0'), shift)
+    return None
+  if op == 'LOP3':
+    lut = int(get('isw8'), 0)
+    if get('rs2') != 'RZ' or lop3_ops.get(lut & 0x55) == None or get('pd0'):
+      return None
+    a = Operand(state, captured, 'rs0')
+    b = FirstOperand(state, captured, ('is1', 'cs1', 'rs1'))
+    if KnownInt(a) != None:
+      a, b = b, a
+    mask = KnownInt(b)
+    if mask == None:
+      return Uniform() if IsUniform(a) and IsUniform(b) else None
+    return Logic(a, mask, lop3_ops[lut & 0x55])
+  return None
+
+def Step(instr, state):
+  '''
+  Apply one instruction to state ({register : value}), in place.
+  A predicated write keeps what both the old and new values agree on.
+  '''
+  res = Resources(instr)
+  if not res['dst']:
+    return
+  value = Evaluate(instr, res, state)
+  rd = Regs(res['captured'].get('rd'))[:1]
+  guarded = Guard(instr) != ()
+  for reg in res['dst']:
+    new = value if (reg,) == rd else None
+    if guarded:
+      new = Meet(state.get(reg), new)
+    if new == None:
+      state.pop(reg, None)
+    else:
+      state[reg] = new
+
+def Wavefronts(address, size):
+  '''
+  address: value of the byte address in the lanes of a warp.
+  Accesses of 8 and 16 bytes are split into 2 and 4 phases of 16 and 8 lanes.
+  In each phase, lanes reading the same word share it; a bank serving n
+  different words takes n wavefronts.
+  Return:
+    (wavefronts, ideal wavefronts)
+  '''
+  words = max(1, size // 4)
+  phase_lanes = WARP_SIZE // words
+  lanes, base, align = address
+  base = base or 0 # Unknown bases are the same in all lanes: the count does not change.
+  total = 0
+  for phase in range(words):
+    banks = {}
+    for lane in range(phase * phase_lanes, (phase + 1) * phase_lanes):
+      word = (base + lanes[lane]) // 4
+      for part in range(words):
+        banks.setdefault((word + part) % NUM_SMEM_BANKS, set()).add(word + part)
+    total += max(len(bank) for bank in banks.values())
+  return total, words
+
+def AddressText(address):
+  if address == None:
+    return 'unknown'
+  lanes, base, align = address
+  stride = lanes[1] - lanes[0]
+  if all(lanes[i] - lanes[0] == stride * i for i in range(WARP_SIZE)):
+    text = f'{stride}*lane' if stride else 'same'
+    if lanes[0]:
+      text += f'{lanes[0]:+#x}'
+  else:
+    text = 'lanes ' + ','.join(f'{lane:#x}' for lane in lanes[:4]) + ',...'
+  if base == None:
+    text += f' + U ({align if align < 1 << 32 else "any"} aligned)'
+  elif base:
+    text += f' + {base:#x}'
+  return text
+
+def AnalyzeShared(program):
+  '''
+  Shared memory bank conflicts of every LDS/STS of a program (result of Parse).
+  Register values are followed as functions of the lane (S2R SR_TID.X/SR_LANEID,
+  MOV, IADD3, IMAD, SHF, LOP3 AND/OR/XOR) over the control flow graph.
+  Return {
+    'lines' : [{line, text, op, size, address (text), wavefronts, ideal}],
+              wavefronts/ideal None when the address is unknown,
+    'total' : {accesses, unknown, conflicted, wavefronts, ideal}
+  }
+  '''
+  instructions = program['instructions']
+  blocks = Blocks(program)
+  entry = [None] * len(blocks)
+  entry[0] = {} if blocks else None
+  work = [0] if blocks else []
+  while work:
+    i = work.pop()
+    state = dict(entry[i])
+    for instr in instructions[blocks[i]['start']:blocks[i]['end']]:
+      Step(instr, state)
+    for succ in blocks[i]['succ']:
+      new = state if entry[succ] == None else MeetState(entry[succ], state)
+      if new != entry[succ]:
+        entry[succ] = new
+        if succ not in work:
+          work.append(succ)
+
+  lines = []
+  for i, block in enumerate(blocks):
+    if entry[i] == None: # Not reachable.
+      continue
+    state = dict(entry[i])
+    for instr in instructions[block['start']:block['end']]:
+      res = Resources(instr)
+      if res['op'] in ('LDS', 'STS'):
+        captured = res['captured']
+        size = access_bytes.get(captured.get('type'), 4)
+        base = Const(0) if captured.get('rs0') == None else Operand(state, captured, 'rs0')
+        offset = int(captured.get('is0w24') or '0', 0)
+        address = Add(base, Const(offset))
+        wavefronts, ideal = Wavefronts(address, size) if address != None else (None, None)
+        lines.append({
+          'line'       : instr['file_line_num'],
+          'text'       : f'{instr["ctrl"]}    {instr["pred"] or ""}{instr["op"]}{instr["rest"]}',
+          'op'         : res['op'],
+          'size'       : size,
+          'address'    : AddressText(base) + (f' + {offset:#x}' if offset and base != None else ''),
+          'wavefronts' : wavefronts,
+          'ideal'      : ideal
+        })
+      Step(instr, state)
+  lines.sort(key=lambda line: line['line'])
+  known = [line for line in lines if line['wavefronts'] != None]
+  return {
+    'lines' : lines,
+    'total' : {
+      'accesses'   : len(lines),
+      'unknown'    : len(lines) - len(known),
+      'conflicted' : sum(line['wavefronts'] > line['ideal'] for line in known),
+      'wavefronts' : sum(line['wavefronts'] for line in known),
+      'ideal'      : sum(line['ideal'] for line in known)
+    }
+  }
+
+def SharedReportText(result, name=''):
+  '''
+  Text version of AnalyzeShared: every LDS/STS with its wavefronts per warp.
+  '''
+  out = [f'Shared memory bank conflicts{" of " + name if name else ""}:']
+  for line in result['lines']:
+    if line['wavefronts'] == None:
+      count = 'unknown address'
+    else:
+      count = f'{line["wavefronts"]} wavefronts (ideal {line["ideal"]})'
+      if line['wavefronts'] > line['ideal']:
+        count += f', {line["wavefronts"] / line["ideal"]:.1f}x'
+    out.append(f'  line {line["line"]:>5}: {count} | {line["address"]} | {line["text"].strip()}')
+  total = result['total']
+  out.append(f'  Total: {total["accesses"]} accesses, {total["conflicted"]} with bank conflicts, '
+             f'{total["wavefronts"]} wavefronts (ideal {total["ideal"]}), {total["unknown"]} unknown.')
+  return '\n'.join(out)
@@ -1,17 +1,69 @@
-from grammar import ProcessAsmLine, grammar, GenCode, ctrl_re, pred_re
+from grammar import ProcessAsmLine, MatchInstr, grammar, GenCode, ctrl_re, pred_re
+from preprocess import PreprocessContext
+from regalloc import AllocateRegisters, VIRTUAL_BASE, vector_widths
 from itertools import accumulate
 import re
+import io
+import time
+from contextlib import nullcontext
 
-def StripSpace(file):
-  # Replace all commands, space, tab with ''
-  file = re.sub(r'\n\n', r'\n', file)
-  file = re.sub(r'#.*', '', file)
-  # Tailing space.
-  file = re.sub(r'(?<=;).*', '', file)
-  return file
+def EncodeInstr(instr, profiler=None):
+  '''
+  Encode one instruction (result of ProcessAsmLine).
+  profiler: optional Profiler, gets the time spent matching and in GenCode.
+  Return:
+    (code, RegCnt, BarCnt) needed by this instruction alone.
+  '''
+  # Op, instr(rest part), 
+  op = instr['op']
+  rest = instr['rest']
+  # If match the rule of that instruction.
+  if profiler != None:
+    profiler.Count('encodes', op)
+    start = time.perf_counter()
+    c_gram, values = MatchInstr(op, rest, profiler.Counter('match_attempts'))
+    profiler.Add('Assemble/match', time.perf_counter() - start)
+  else:
+    c_gram, values = MatchInstr(op, rest) # Current grammar. Better name?
+  if c_gram == None:
+    raise Exception(f'Cannot recognize instruction {op+rest}')
+  captured = dict(zip(c_gram['fields'], values))
+
+  # Update register count
+  num_registers = 0
+  for reg in ['rd', 'rs0', 'rs1', 'rs2']:
+    if reg not in captured:
+      continue
+    reg_data = captured[reg]
+    if reg_data == None or reg_data == 'RZ':
+      continue
+    else:
+      reg_idx = int(reg_data[1:])
+      if reg_idx + 1 > num_registers:
+        num_registers = reg_idx + 1
 
-def Assemble(file, include=None):
+  # Update barrier count.
+  num_barriers = 0
+  if op == 'BAR':
+    barrier_idx = int(captured['ibar'], 0)
+    if barrier_idx >= 0xf:
+      # TODO: Add line number here.
+      raise Exception(f'Barrier index must be smaller than 15. {barrier_idx} found.')
+    num_barriers = barrier_idx + 1
+
+  if profiler != None:
+    start = time.perf_counter()
+    code = GenCode(op, c_gram, captured, instr)
+    profiler.Add('Assemble/GenCode', time.perf_counter() - start)
+  else:
+    code = GenCode(op, c_gram, captured, instr)
+  return code, num_registers, num_barriers
+
+def Assemble(file, include=None, cache=None, arch=75, profiler=None):
   '''
+  file: preprocessed source text, or the result of Parse.
+  cache: EncodingCache, lines already encoded in earlier builds are reused.
+  profiler: optional Profiler, counts encodes and cache hits per opcode.
   return {
       RegCnt       => $regCnt,
       BarCnt       => $barCnt,
@@ -22,46 +74,28 @@ def Assemble(file, include=None):
   }
   '''
   # After preprocess.
-  # for each line in the file.
-  # 1. ProcessAsmLine
+  # 1. Parse (Tokenize)
   #    Parse line to get: {ctrl}, {pred}, {op}, reset
-  # 2. Apply register mapping.
-  # 3. Parse op(flags) & operands?
+  #    Apply register mapping.
+  # 2. Parse op(flags) & operands?
   #    Need to write capture rules for instructions(oprands, flags)
-  # 4. Generate binary code.
+  # 3. Generate binary code.
   #    Op | Flags | Operands
-  file = StripSpace(file)
+  program = Parse(file) if isinstance(file, str) else file
   num_registers = 8
   num_barriers  = 0
-  smem_size     = 0
+  smem_size     = SharedSize(program['shared'])
   const_size    = 0
   exit_offsets   = []
-  labels = {} # Name => line_num
+  labels = program['labels'] # Name => line_num
   branches = [] # Keep track of branch instructions (BRA)
-  line_num = 0
 
-  instructions = []
-  for file_line_num, line in enumerate(file.split('\n')): # TODO: 
-    if line == '':
-      continue
-    line_result = ProcessAsmLine(line, line_num)
-    if(line_result):
-      # Push instruction data to list
-      instructions.append(line_result)
-      if line_result['op'] == 'BRA':
-        branches.append(line_result)
-      if line_result['op'] == 'EXIT':
-        exit_offsets.append(line_num * 16)
-      line_num += 1
-      continue # Ugly control flow
-    label_result = re.match(r'(^[a-zA-Z]\w*):', line)
-    # TODO: Move this to preprocess.
-    if label_result:
-      # Match a label
-      labels[label_result.group(1)] = line_num
-    else:
-      print(line)
-      raise Exception(f'Cannot recogonize {line} at line{file_line_num}.\n')
+  instructions = list(program['instructions'])
+  for instr in instructions:
+    if instr['op'] == 'BRA':
+      branches.append(instr)
+    if instr['op'] == 'EXIT':
+      exit_offsets.append(instr['line_num'] * 16)
 
   # Append the tail BRA.
   instructions.append(ProcessAsmLine('--:-:-:Y:0  BRA -0x10;', len(instructions)+1))
@@ -72,56 +106,32 @@ def Assemble(file, include=None):
     instructions.append(ProcessAsmLine('--:-:-:Y:0  NOP;', len(instructions)+1))
 
   # Remap labels
+  # Records are shared with program. Keep them intact, replace the BRAs.
   for bra_instr in branches:
     label = re.sub(r'^\s*', '', bra_instr['rest'])
     label = label.split(';')[0]
+    if label not in labels:
+      raise Exception(f'Unknown label {label} at line {bra_instr["file_line_num"]}.\n')
     relative_offset = (labels[label] - bra_instr['line_num'] - 1) * 0x10 
-    bra_instr['rest'] = ' ' + hex(relative_offset) + ';'
+    instructions[bra_instr['line_num']] = dict(bra_instr, rest=' ' + hex(relative_offset) + ';')
 
   # Parse instructions.
   # Generate binary code. And insert to the instructions list.
   codes = []
   for instr in instructions:
-    # Op, instr(rest part), 
-    op = instr['op']
-    rest = instr['rest']
-    grams = grammar[op]
-    # If match the rule of that instruction.
-    for gram in grams:
-      result = re.match(gram['rule'], op + rest)
-      if result == None:
-        continue
-      else:
-        c_gram = gram # Current grammar. Better name?
-        break
-    if result == None:
-      print(repr(gram))
-      raise Exception(f'Cannot recognize instruction {op+rest}')
-
-    # Update register count
-    for reg in ['rd', 'rs0', 'rs1', 'rs2']:
-      if reg not in result.groupdict():
-        continue
-      reg_data = result.groupdict()[reg]
-      if reg_data == None or reg_data == 'RZ':
-        continue
-      else:
-        reg_idx = int(reg_data[1:])
-        if reg_idx + 1 > num_registers:
-          num_registers = reg_idx + 1
-    
-    # Update barrier count.
-    if op == 'BAR':
-      barrier_idx = int(result.groupdict()['ibar'], 0)
-      if barrier_idx >= 0xf:
-        # TODO: Add line number here.
-        raise Exception(f'Barrier index must be smaller than 15. {barrier_idx} found.')
-      if barrier_idx + 1 > num_barriers:
-        num_barriers = barrier_idx + 1
-
-
-    code = GenCode(op, c_gram, result.groupdict(), instr)
-
+    if cache != None:
+      key = (instr['ctrl'], instr['pred'], instr['op'], instr['rest'], arch)
+      entry = cache.Get(key)
+      if entry == None:
+        entry = EncodeInstr(instr, profiler)
+        cache.Put(key, entry)
+      elif profiler != None:
+        profiler.Count('cache_hits', instr['op'])
+    else:
+      entry = EncodeInstr(instr, profiler)
+    code, reg_cnt, bar_cnt = entry
+    num_registers = max(num_registers, reg_cnt)
+    num_barriers  = max(num_barriers, bar_cnt)
     codes.append(code)
 
   # TODO: For some reasons, we need larger register count.
@@ -142,6 +152,281 @@ def Assemble(file, include=None):
     'KernelData' : codes
   }
     
+class BuildContext():
+  '''
+  State of one build: the preprocess namespace (includes, <CODE>, {}, out_),
+  include sources, arch and encoding cache.
+  Builds with their own contexts can run concurrently on threads. What they
+  share is read-only (compiled grammar, flag tables, compiled code objects)
+  or thread-safe (EncodingCache).
+  passes: functions run in order on the result of Parse, before Assemble.
+          Each may replace program['instructions'] and returns a report (or None).
+  profiler: optional Profiler, gets every phase of the build.
+  '''
+  def __init__(self, arch=75, include=None, include_src=None, cache=None, preprocess=None, passes=None,
+               profiler=None):
+    self.arch = arch
+    self.include_src = ReadIncludes(include, include_src)
+    self.cache = cache
+    # Fresh namespace per build. Code objects are still compiled once per process.
+    self.preprocess = PreprocessContext() if preprocess == None else preprocess
+    self.passes = [] if passes == None else passes
+    self.reports = []
+    self.profiler = profiler
+    self.program = None
+    self.kernel  = None
+
+  def Phase(self, name):
+    return self.profiler.Phase(name) if self.profiler != None else nullcontext()
+
+  def Preprocess(self, file):
+    with self.Phase('ExpandCode'):
+      file = ExpandCode(file, include_src=self.include_src, ctx=self.preprocess)
+    with self.Phase('ExpandInline'):
+      file = ExpandInline(file, include_src=self.include_src, ctx=self.preprocess)
+    return file
+
+  def Assemble(self, file):
+    '''
+    Return:
+      (kernel, params): result of Assemble and the parameters of Parse.
+    '''
+    self.program = Parse(self.Preprocess(file), self.profiler)
+    if self.program['regalloc'] != None:
+      self.reports.append(self.program['regalloc'])
+    for pass_ in self.passes:
+      with self.Phase(f'pass {pass_.__name__}'):
+        report = pass_(self.program)
+      if report != None:
+        self.reports.append(report)
+    with self.Phase('Assemble'):
+      self.kernel  = Assemble(self.program, cache=self.cache, arch=self.arch, profiler=self.profiler)
+    return self.kernel, self.program['params']
+
+def AssembleSource(file, include=None, cache=None, arch=75, include_src=None, ctx=None, passes=None,
+                   profiler=None):
+  '''
+  Preprocess and assemble the source of one kernel, in a BuildContext of its own.
+  include/include_src: include file paths/include sources (see ReadIncludes).
+  ctx: PreprocessContext for includes, <CODE> and {}. Default: a fresh one.
+  passes, profiler: see BuildContext.
+  Return:
+    (kernel, params): result of Assemble and the parameters of Parse.
+  '''
+  return BuildContext(arch, include, include_src, cache, ctx, passes, profiler).Assemble(file)
+
+label_re = re.compile(r'(^[a-zA-Z]\w*):')
+def Tokenize(lines, reg_map, param_dict, reg_alloc=None, shared_dict=None):
+  '''
+  Single pass over the lines of a source, after ExpandCode/ExpandInline.
+  <REGS>, <PARAMS> and <SHARED> blocks fill reg_map, param_dict and
+  shared_dict as they are read (and reg_alloc, see ParseRegLine).
+  Comments and empty lines are skipped.
+  Yield:
+    ('label', name, file_line_num)
+    ('instr', record, file_line_num): record is the result of ProcessAsmLine,
+                                      plus file_line_num.
+  '''
+  block = None # Inside <REGS>, <PARAMS> or <SHARED>
+  line_num = 0 # Instruction index
+  for file_line_num, line in enumerate(lines, 1):
+    line = line.split('#', 1)[0].strip()
+    if block == None and (line.startswith('<REGS>') or line.startswith('<PARAMS>') or line.startswith('<SHARED>')):
+      block = line[1:line.index('>')]
+      line = line[len(block)+2:]
+    if block != None:
+      end_tag = f'</{block}>'
+      end = line.find(end_tag)
+      if end >= 0:
+        line = line[:end]
+      if block == 'REGS':
+        ParseRegLine(line, reg_map, file_line_num, reg_alloc)
+      elif block == 'SHARED':
+        if shared_dict == None:
+          raise Exception(f'<SHARED> is only supported by Parse, at line {file_line_num}.\n')
+        ParseSharedLine(line, shared_dict, file_line_num)
+      else:
+        ParseParamLine(line, param_dict, file_line_num)
+      if end >= 0:
+        block = None
+      continue
+    if line == '':
+      continue
+
+    record = ProcessAsmLine(line, line_num)
+    if record:
+      record['file_line_num'] = file_line_num
+      line_num += 1
+      yield 'instr', record, file_line_num
+      continue
+    label_result = label_re.match(line)
+    if label_result:
+      # Match a label
+      yield 'label', label_result.group(1), file_line_num
+    else:
+      raise Exception(f'Cannot recogonize {line} at line {file_line_num}.\n')
+  if block != None:
+    raise Exception(f'Missing </{block}>.\n')
+
+def Parse(file, profiler=None):
+  '''
+  Tokenize a preprocessed source (text or iterable of lines) and resolve
+  register and parameter names in the operands. Register names declared
+  without indices get their registers from AllocateRegisters.
+  profiler: optional Profiler, gets Tokenize, ReplaceRegParam and AllocateRegisters.
+  Return {
+    'instructions' : [record],
+    'labels'       : {name : instruction index},
+    'regs'         : {name : register index},
+    'alloc'        : {name : width in registers}, of the allocated names,
+    'regalloc'     : report of AllocateRegisters, None without such names,
+    'params'       : {'name_list' : [...], 'size_list' : [...]},
+    'shared'       : {'name_list' : [...], 'size_list' : [...], 'offset_list' : [...]}
+  }
+  Shared memory names are replaced by their offsets.
+  '''
+  if isinstance(file, str):
+    file = io.StringIO(file)
+  reg_map = {}
+  reg_alloc = {}
+  param_dict = {'name_list' : [], 'size_list' : []}
+  shared_dict = {'name_list' : [], 'size_list' : [], 'offset_list' : []}
+  instructions = []
+  labels = {}
+  Phase = profiler.Phase if profiler != None else lambda name: nullcontext()
+  with Phase('Tokenize'):
+    for kind, item, file_line_num in Tokenize(file, reg_map, param_dict, reg_alloc, shared_dict):
+      if kind == 'instr':
+        instructions.append(item)
+      else:
+        if item in labels:
+          raise Exception(f'Label {item} already defined, at line {file_line_num}.\n')
+        labels[item] = len(instructions)
+
+  # <REGS>/<PARAMS> may come after their first use. Resolve at the end.
+  # Unrolled code repeats the same operands a lot. Resolve each once.
+  with Phase('ReplaceRegParam'):
+    replace = RegParamReplacer(reg_map, param_dict, reg_alloc, shared_dict)
+    resolved = {}
+    for instr in instructions:
+      rest = instr['rest']
+      if rest not in resolved:
+        resolved[rest] = replace(rest)
+      instr['rest'] = resolved[rest]
+
+  program = {
+    'instructions' : instructions,
+    'labels'       : labels,
+    'regs'         : reg_map,
+    'alloc'        : reg_alloc,
+    'regalloc'     : None,
+    'params'       : param_dict,
+    'shared'       : shared_dict
+  }
+  if reg_alloc:
+    with Phase('AllocateRegisters'):
+      program['regalloc'] = AllocateRegisters(program)
+  return program
+
+reg_alloc_re = re.compile(r'([a-zA-Z_]\w*)(?:\[(\d)\])?$')
+def ParseRegLine(line, reg_map, line_num, reg_alloc=None):
+  '''
+  0, 1, 2 : a, b, c
+  Without indices, the registers are allocated (see AllocateRegisters).
+  name[2]/name[4] is a 64/128-bit vector, name[k] its k-th register:
+  a, b, ptr[2], v[4]
+  reg_alloc: {name : width} of those, they get virtual registers here.
+  '''
+  # Replace commands and space
+  line = re.sub(r'#.*', '', line)
+  line = re.sub(r'\s*', '', line)
+  # Skip empty line
+  if line == '':
+    return
+  if ':' not in line:
+    if reg_alloc == None:
+      raise Exception(f'Register names without indices are only supported by Parse, at line {line_num}.\n')
+    for item in line.split(','):
+      result = reg_alloc_re.match(item)
+      if result == None:
+        raise Exception(f'Invalid register name {item}, at line {line_num}.\n')
+      name, width = result.group(1), int(result.group(2) or 1)
+      if name in reg_map:
+        raise Exception(f'Register name {name} already defined at line {line_num}.\n')
+      if width not in vector_widths:
+        raise Exception(f'Register {name} of {width} registers, only 1, 2 or 4 supported, at line {line_num}.\n')
+      reg_map[name] = VIRTUAL_BASE + sum(reg_alloc.values())
+      reg_alloc[name] = width
+    return
+
+  # reg_idx and reg_names
+  reg_idx, reg_names = line.split(':')
+  reg_idx = reg_idx.split(',')
+  reg_names = reg_names.split(',')
+  if len(reg_idx) != len(reg_names):
+    raise Exception(f'Number of registers != number of register names, at line {line_num}.\n')
+  for i, name in enumerate(reg_names):
+    if name in reg_map:
+      raise Exception(f'Register name {name} already defined at line {line_num}.\n')
+    if not re.match(r'\w+', name):
+      raise Exception(f'Invalid register name {name}, at line {line_num}.\n')
+    reg_map[name] = int(reg_idx[i])
+
+def ParseParamLine(line, param_dict, line_num):
+  '''
+  input, 8
+  '''
+  name_list = param_dict['name_list']
+  size_list = param_dict['size_list']
+  # Replace commands and space
+  line = re.sub(r'#.*', '', line)
+  line = re.sub(r'\s*', '', line)
+  if line == '':
+    return
+  name, size = line.split(',')
+  if name in name_list:
+    raise Exception(f'Parameter name {name} already defined.\n')
+  if not re.match(r'\w+', name):
+    raise Exception(f'Invalid parameter name {name}, at line {line_num}.\n')
+  size = int(size)
+  if size % 4 != 0:
+    raise Exception(f'Size of parameter {name} is not a multiplication of 4. Not supported.\n')
+  name_list.append(name)
+  size_list.append(size)
+
+def ParseSharedLine(line, shared_dict, line_num):
+  '''
+  name, size in bytes [, alignment (default 16)]
+  tile, 4096
+  '''
+  line = re.sub(r'#.*', '', line)
+  line = re.sub(r'\s*', '', line)
+  if line == '':
+    return
+  items = line.split(',')
+  if len(items) not in (2, 3):
+    raise Exception(f'Expected name, size[, alignment] of shared memory, at line {line_num}.\n')
+  name = items[0]
+  if name in shared_dict['name_list']:
+    raise Exception(f'Shared memory name {name} already defined, at line {line_num}.\n')
+  if not re.match(r'[a-zA-Z_]\w*$', name):
+    raise Exception(f'Invalid shared memory name {name}, at line {line_num}.\n')
+  size = int(items[1], 0)
+  align = int(items[2], 0) if len(items) == 3 else 16
+  if size <= 0 or align <= 0 or align & (align - 1) != 0:
+    raise Exception(f'Invalid size or alignment of shared memory {name}, at line {line_num}.\n')
+  offset = -(-SharedSize(shared_dict) // align) * align
+  shared_dict['name_list'].append(name)
+  shared_dict['size_list'].append(size)
+  shared_dict['offset_list'].append(offset)
+
+def SharedSize(shared_dict):
+  # Bytes of shared memory, up to the end of the last declaration.
+  if not shared_dict['name_list']:
+    return 0
+  return shared_dict['offset_list'][-1] + shared_dict['size_list'][-1]
+
+# Text level versions of the <REGS>/<PARAMS> handling in Tokenize.
 register_map_re = re.compile(r'^[\t ]*<REGS>(.*?)\s*</REGS>\n?', re.S | re.M)
 parameter_map_re = re.compile(r'^[\t ]*<PARAMS>(.*?)^\s*</PARAMS>\n?', re.S | re.M)
 def SetRegisterMap(file):
@@ -150,26 +435,7 @@ def SetRegisterMap(file):
   regmap_result = register_map_re.findall(file)
   for match_item in regmap_result:
     for line_num, line in enumerate(match_item.split('\n')):
-      # Replace commands
-      line = re.sub(r'#.*', '', line)
-      # Replace  space
-      line = re.sub(r'\s*', '', line)
-      # Skip empty line
-      if line == '':
-        continue
-      
-      # reg_idx and reg_names
-      reg_idx, reg_names = line.split(':')
-      reg_idx = reg_idx.split(',')
-      reg_names = reg_names.split(',')
-      if len(reg_idx) != len(reg_names):
-        raise Exception('Number of registers != number of register names.\n') # TODO: track line number.
-      for i, name in enumerate(reg_names):
-        if name in reg_map:
-          raise Exception(f'Register name {name} already defined at line {line_num+1}.\n')
-        if not re.match(r'\w+', name):
-          raise Exception(f'Invalid register name {name}, at line {line_num+1}.\n')
-        reg_map[name] = reg_idx[i]
+      ParseRegLine(line, reg_map, line_num+1)
 
   # Replace <REGISTER_MAPPING> with ''
   file = register_map_re.sub('', file)
@@ -183,95 +449,137 @@ def SetParameterMap(file):
   output, 8
   </PARAMS>
   '''
-  name_list = []
-  size_list = []
   # Cannot use dict. Order information is needed.
-  param_dict = {'name_list' : name_list, 'size_list' : size_list}
+  param_dict = {'name_list' : [], 'size_list' : []}
   parammap_result = parameter_map_re.findall(file)
   for match_item in parammap_result:
     for line_num, line in enumerate(match_item.split('\n')):
-      # Replace commands and space
-      line = re.sub(r'#.*', '', line)
-      line = re.sub(r'\s*', '', line)
-      if line == '':
-        continue
-      name, size = line.split(',')
-      if name in name_list:
-        raise Exception(f'Parameter name {name} already defined.\n')
-      if not re.match(r'\w+', name):
-        raise Exception(f'Invalid parameter name {name}, at line {line_num+1}.\n')
-      size = int(size)
-      if size % 4 != 0:
-        raise Exception(f'Size of parameter {name} is not a multiplication of 4. Not supported.\n')
-      name_list.append(name)
-      size_list.append(size)
+      ParseParamLine(line, param_dict, line_num+1)
   
   # Delete parameter text.
   file = parameter_map_re.sub('', file)
 
   return file, param_dict
 
+param_base = 0x160 # TODO: Better to be a global variable. (Cubin also needs this.)
+def ConstantText(offset):
+  return 'c[0x0][' + '0x%0.3X' % (param_base+offset) + ']'
+
 def GetParameterConstant(param_name, params, para_offset=0):
-  base = 0x160 # TODO: Better to be a global variable. (Cubin also needs this.)
   index = params['name_list'].index(param_name) # Use .index() is safe here. Elements are unique.
   prefix_sum = list(accumulate(params['size_list']))
   size = params['size_list'][index]
   offset = prefix_sum[index] - size + para_offset * 4# :)
   if size - para_offset*4 < 0:
     raise Exception(f'Parameter {param_name} is of size {size}. Cannot have offset {para_offset}.')
-  return 'c[0x0][' + '0x%0.3X' % (base+offset) + ']'
+  return ConstantText(offset)
 
-# Replace register and parameter.
-def ReplaceRegParamMap(file, reg_map, param_dict):
+def SymbolTable(reg_map, param_dict, reg_alloc=None, shared_dict=None):
+  '''
+  Resolve all names once.
+  reg_alloc: widths of the allocated registers (see ParseRegLine).
+  shared_dict: shared memory declarations (see ParseSharedLine).
+  Return:
+    {name : text}, for registers (R{idx}), vector registers name[k],
+    parameters and parameter words name[0] ... name[9] (c[0x0][offset]),
+    and shared memory (its offset, 0x...).
+  '''
   for key in reg_map.keys():
     if key in param_dict['name_list']:
       raise Exception(f'Name {key} defined both in register and parameters.\n')
-  var_re = re.compile(fr'(?<!(?:\.))\b([a-zA-Z_]\w*)(?:\[(\d)\]|\b)(?!\[0x)')
-  def RepalceVar(match, regs, params):
+  table = {}
+  if shared_dict != None:
+    for name, offset in zip(shared_dict['name_list'], shared_dict['offset_list']):
+      if name in reg_map or name in param_dict['name_list']:
+        raise Exception(f'Name {name} defined both in shared memory and registers or parameters.\n')
+      if name not in grammar:
+        table[name] = hex(offset)
+  offset = 0
+  for name, size in zip(param_dict['name_list'], param_dict['size_list']):
+    if name not in grammar:
+      table[name] = ConstantText(offset)
+      # var_re captures a single digit offset.
+      for para_offset in range(min(size // 4, 9) + 1):
+        table[f'{name}[{para_offset}]'] = ConstantText(offset + para_offset * 4)
+    offset += size
+  for name, reg_idx in reg_map.items():
+    if name not in grammar:
+      table[name] = 'R' + str(reg_idx)
+  for name, width in (reg_alloc or {}).items():
+    if name not in grammar:
+      for part in range(width):
+        table[f'{name}[{part}]'] = 'R' + str(reg_map[name] + part)
+  return table
+
+# Replace register and parameter.
+var_re = re.compile(fr'(?<!(?:\.))\b([a-zA-Z_]\w*)(?:\[(\d)\]|\b)(?!\[0x)')
+def RegParamReplacer(reg_map, param_dict, reg_alloc=None, shared_dict=None):
+  '''
+  Return:
+    function text => text with register, parameter and shared memory names replaced.
+  '''
+  table = SymbolTable(reg_map, param_dict, reg_alloc, shared_dict)
+  def RepalceVar(match):
+    if match.group(2) == None:
+      return table.get(match.group(1), match.group(1))
+    var = table.get(match.group(0))
+    if var != None:
+      return var
+    # Not a valid parameter word.
     var = match.group(1)
-    offset = match.group(2)
     if var in grammar:
       return var
+    if var in (reg_alloc or {}):
+      raise Exception(f'Register {match.group(0)} out of range, {var} has {reg_alloc[var]} registers.\n')
     if var in reg_map:
-      return 'R' + str(reg_map[var])
-    if var in params['name_list']:
-      if offset == None:
-        return GetParameterConstant(var, params)
-      else:
-        offset = int(offset)
-        return GetParameterConstant(var, params, offset)
+      return table[var]
+    if var in param_dict['name_list']:
+      return GetParameterConstant(var, param_dict, int(match.group(2)))
     else:
       # TODO: Or not to allow use RX in the code and raise exeception here.
       return var # In case of R0-R255, RZ, PR
-  # Match rest first.
-  file = var_re.sub(lambda match : RepalceVar(match, reg_map, param_dict), file)
+  return lambda text : var_re.sub(RepalceVar, text)
 
-  return file
+def ReplaceRegParamMap(file, reg_map, param_dict):
+  return RegParamReplacer(reg_map, param_dict)(file)
     
-code_re = re.compile(r"^[\t ]*<CODE>(.*?)^\s*<\/CODE>\n?", re.MULTILINE|re.DOTALL)
-def ExpandCode(file, include=None): # TODO: Better way to do this.
-  # Execute include files.
+def ReadIncludes(include=None, include_src=None):
+  '''
+  include: list of include file paths.
+  include_src: list of include sources, already in memory.
+  Return:
+    list of include sources.
+  '''
+  sources = []
   if include != None:
     for include_file in include:
       with open(include_file, 'r') as f:
-        source = f.read()
-        exec(source, globals())
+        sources.append(f.read())
+  if include_src != None:
+    sources.extend(include_src)
+  return sources
+
+# Context used by ExpandCode/ExpandInline when none is given. Shared by all
+# such calls in this process, so not reentrant. BuildContext uses its own.
+default_context = PreprocessContext()
+
+code_re = re.compile(r"^[\t ]*<CODE>(.*?)^\s*<\/CODE>\n?", re.MULTILINE|re.DOTALL)
+def ExpandCode(file, include=None, include_src=None, ctx=None):
+  ctx = default_context if ctx == None else ctx
+  # Execute include files.
+  ctx.Include(ReadIncludes(include, include_src))
   # Execute <CODE> block.
   def ReplaceCode(matchobj):
-    exec(matchobj.group(1), globals())
-    return out_
+    return ctx.Exec(matchobj.group(1))
   return code_re.sub(ReplaceCode, file)
 
 inline_re = re.compile(r'{(.*)?}', re.M)
-def ExpandInline(file, include=None):
-    # Execute include files.
-  if include != None:
-    for include_file in include:
-      with open(include_file, 'r') as f:
-        source = f.read()
-        exec(source, globals())
+def ExpandInline(file, include=None, include_src=None, ctx=None):
+  ctx = default_context if ctx == None else ctx
+  # Execute include files.
+  ctx.Include(ReadIncludes(include, include_src))
   def ReplaceCode(matchobj):
-    return str(eval(matchobj.group(1), globals()))
+    return str(ctx.Eval(matchobj.group(1)))
   return inline_re.sub(ReplaceCode, file)
 
 
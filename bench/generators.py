@@ -0,0 +1,149 @@
+'''
+Synthetic kernel sources for the benchmarks, about n instructions each.
+Every generator is deterministic in n.
+'''
+import random
+
+def Ctrl(stall=1, wait='--', read='-', write='-'):
+  return f'{wait}:{read}:{write}:-:{stall:x}'
+
+def Lines(header, body):
+  return '\n'.join(header + body + [f'{Ctrl(5)}    EXIT;']) + '\n'
+
+def FFMATile(n):
+  '''
+  Unrolled 8x8 register tile: LDS.128 of A and B columns, 64 FFMAs per k step.
+  '''
+  header = ['<PARAMS>', 'A, 8', 'B, 8', 'C, 8', '</PARAMS>',
+            '<REGS>', '0 : tid', '1, 2 : addr_a, addr_b', '</REGS>',
+            f'{Ctrl(7, write="1")}    S2R tid, SR_TID.X;',
+            f'{Ctrl(4, wait="02")}    SHF.L.U32 addr_a, tid, 0x4, RZ;',
+            f'{Ctrl(4)}    IADD3 addr_b, addr_a, 0x1000, RZ;']
+  body = []
+  k = 0
+  while len(body) < n:
+    offset = (k % 64) * 0x100
+    for i in range(2):
+      body.append(f'{Ctrl(1, write="2")}    LDS.U.128 R{4 + 4*i}, [addr_a+{hex(offset + 16*i)}];')
+      body.append(f'{Ctrl(1, write="3")}    LDS.U.128 R{12 + 4*i}, [addr_b+{hex(offset + 16*i)}];')
+    for i in range(8):
+      for j in range(8):
+        wait = '12' if i == 0 and j == 0 else '--'
+        reuse = '.reuse' if j < 7 else ''
+        body.append(f'{Ctrl(1, wait=wait)}    FFMA R{32 + 8*i + j}, R{4 + i}{reuse}, R{12 + j}, R{32 + 8*i + j};')
+    k += 1
+  return Lines(header, body[:n])
+
+def TransformStage(n):
+  '''
+  Shared memory transform stages: LDS.128, FADD/FMUL butterflies, STS.128, BAR.SYNC.
+  '''
+  header = ['<PARAMS>', 'input, 8', '</PARAMS>',
+            '<REGS>', '0, 1, 2 : tid, src, dst', '</REGS>',
+            f'{Ctrl(7, write="1")}    S2R tid, SR_TID.X;',
+            f'{Ctrl(4, wait="02")}    IMAD src, tid, 0x10, RZ;',
+            f'{Ctrl(4)}    IMAD dst, tid, 0x84, RZ;']
+  body = []
+  stage = 0
+  while len(body) < n:
+    base = (stage % 16) * 0x800
+    for i in range(4):
+      body.append(f'{Ctrl(1, write="2")}    LDS.U.128 R{8 + 4*i}, [src+{hex(base + 0x200*i)}];')
+    for i in range(4):
+      a, b = 8 + i, 12 + i
+      body.append(f'{Ctrl(4, wait="04" if i == 0 else "--")}    FADD R{24 + i}, R{a}, R{b};')
+      body.append(f'{Ctrl(4)}    FADD R{28 + i}, R{a}, -R{b};')
+      body.append(f'{Ctrl(4)}    FMUL R{32 + i}, R{24 + i}, 0.5;')
+      body.append(f'{Ctrl(4)}    FFMA R{36 + i}, R{28 + i}, R{16 + i}, R{32 + i};')
+    for i in range(4):
+      body.append(f'{Ctrl(1, read="3")}    STS.128 [dst+{hex(base + 0x210*i)}], R{24 + 4*i};')
+    body.append(f'{Ctrl(5, wait="08")}    BAR.SYNC 0x0;')
+    stage += 1
+  return Lines(header, body[:n])
+
+def CodeTemplate(n):
+  '''
+  <CODE> blocks generating unrolled loops, and an inline {} expression on every other line.
+  '''
+  header = ['<PARAMS>', 'input, 8', '</PARAMS>',
+            '<CODE>',
+            'def Tile(k):',
+            '  out = ""',
+            '  for i in range(8):',
+            '    for j in range(8):',
+            "      out += f'--:-:-:-:1    FFMA R{32+8*i+j}, R{i}, R{8+j}, R{32+8*i+j};\\n'",
+            '  return out',
+            "out_ = ''",
+            '</CODE>']
+  body = []
+  k = 0
+  while len(body) < n:
+    body += ['<CODE>', f'out_ = Tile({k})', '</CODE>']
+    for i in range(32):
+      body.append(f'{Ctrl(4)}    IADD3 R{16 + i % 8}, R{16 + i % 8}, {{{k % 97}*4+{i}}}, RZ;')
+      # Float exponents stay part of the literal shape.
+      body.append(f'{Ctrl(4)}    IMAD R{24 + i % 8}, R{16 + i % 8}, {{round({40 * (i + 1)}*1e-1)}}, RZ;')
+    k += 1
+  # 64 instructions per block of CODE, 64 inline ones.
+  count = 0
+  lines = []
+  for line in body:
+    if count >= n:
+      break
+    lines.append(line)
+    if line.startswith('</CODE>'):
+      count += 64
+    elif not line.startswith('<CODE>') and not line.startswith('out_'):
+      count += 1
+  return Lines(header, lines)
+
+def Branches(n):
+  '''
+  Thousands of labels: short loops closed by ISETP + @P0 BRA, forward skips with @!P1 BRA.
+  '''
+  header = ['<PARAMS>', 'n, 4', '</PARAMS>', '<REGS>', '0, 1, 2 : cnt, a, b', '</REGS>',
+            f'{Ctrl(2)}    MOV cnt, n;']
+  body = []
+  block = 0
+  # 7 instructions and 2 labels per block.
+  while block * 7 < n:
+    body.append(f'L{block}:')
+    body.append(f'{Ctrl(4)}    IADD3 cnt, cnt, -1, RZ;')
+    body.append(f'{Ctrl(4)}    IADD3 a, a, cnt, RZ;')
+    body.append(f'{Ctrl(4)}    ISETP.NE.AND P0, PT, cnt, RZ, PT;')
+    body.append(f'{Ctrl(4)}    ISETP.GT.AND P1, PT, a, b, PT;')
+    body.append(f'{Ctrl(7)}    @P0 BRA L{block};')
+    body.append(f'{Ctrl(7)}    @!P1 BRA S{block};')
+    body.append(f'{Ctrl(4)}    IMAD b, a, 0x3, b;')
+    body.append(f'S{block}:')
+    block += 1
+  return Lines(header, body)
+
+def BigMaps(n):
+  '''
+  250 register names and 200 parameters, used all over the code.
+  '''
+  regs = [f'r_{i}' for i in range(250)]
+  params = [f'p_{i}' for i in range(200)]
+  header = ['<PARAMS>'] + [f'{name}, 4' for name in params] + ['</PARAMS>']
+  header += ['<REGS>'] + [f'{i} : {name}' for i, name in enumerate(regs)] + ['</REGS>']
+  rng = random.Random(n)
+  body = []
+  while len(body) < n:
+    d, a, b = rng.sample(regs, 3)
+    choice = rng.randrange(3)
+    if choice == 0:
+      body.append(f'{Ctrl(4)}    IADD3 {d}, {a}, {rng.choice(params)}, RZ;')
+    elif choice == 1:
+      body.append(f'{Ctrl(4)}    FFMA {d}, {a}, {b}, {d};')
+    else:
+      body.append(f'{Ctrl(2)}    MOV {d}, {rng.choice(params)};')
+  return Lines(header, body)
+
+generators = {
+  'ffma'      : FFMATile,
+  'transform' : TransformStage,
+  'code'      : CodeTemplate,
+  'branches'  : Branches,
+  'maps'      : BigMaps
+}
@@ -0,0 +1,164 @@
+'''
+Assembler benchmarks on synthetic kernels (see generators.py).
+For each case and size: instructions per second of every build phase (best
+of -repeat runs) and the allocation peak of one more run under tracemalloc.
+Results are compared with a baseline; a phase slower than the baseline by
+more than -threshold is a regression (exit status 1).
+  python bench/run.py                       # 1k, 10k, 100k of every case
+  python bench/run.py -sizes 1M -cases ffma
+  python bench/run.py -save                 # store the results as the new baseline
+'''
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'assembler'))
+
+from api import AssembleToBytes
+from profiler import Profiler
+from generators import generators
+
+default_baseline = os.path.join(bench_dir, 'baseline.json')
+# Phases compared with the baseline. Parts of Assemble (match, GenCode) are reported too.
+phases = ('ExpandCode', 'ExpandInline', 'Tokenize', 'ReplaceRegParam', 'Assemble', 'Cubin.Serialize')
+
+def ParseSize(text):
+  # 1000, 10k, 1M
+  scale = {'k' : 1000, 'K' : 1000, 'm' : 1000000, 'M' : 1000000}
+  if text[-1] in scale:
+    return int(float(text[:-1]) * scale[text[-1]])
+  return int(text)
+
+def SizeText(size):
+  if size >= 1000000 and size % 1000000 == 0:
+    return f'{size // 1000000}M'
+  if size >= 1000 and size % 1000 == 0:
+    return f'{size // 1000}k'
+  return str(size)
+
+def RunCase(source, arch, repeat, memory):
+  '''
+  Return {
+    instructions, seconds : {phase : best seconds}, rate : {phase : instructions/s},
+    total_rate, peak_bytes (None without memory)
+  }
+  '''
+  best = {}
+  instructions = 0
+  for _ in range(repeat):
+    profiler = Profiler(memory=False)
+    cubin, info = AssembleToBytes(source, arch=arch, profiler=profiler)
+    instructions = info['CodeSize'] // 16
+    for name, entry in profiler.Report()['phases'].items():
+      best[name] = min(best.get(name, entry['seconds']), entry['seconds'])
+  peak = None
+  if memory:
+    started = not tracemalloc.is_tracing()
+    if started:
+      tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_bytes = tracemalloc.get_traced_memory()[0]
+    AssembleToBytes(source, arch=arch)
+    peak = tracemalloc.get_traced_memory()[1] - start_bytes
+    if started:
+      tracemalloc.stop()
+  total = sum(best.get(name, 0) for name in phases)
+  return {
+    'instructions' : instructions,
+    'seconds'      : best,
+    'rate'         : {name : instructions / seconds if seconds > 0 else None for name, seconds in best.items()},
+    'total_rate'   : instructions / total if total > 0 else None,
+    'peak_bytes'   : peak
+  }
+
+def Compare(results, baseline, threshold):
+  '''
+  Return:
+    [(case, phase, baseline rate, rate)] of the phases slower than the
+    baseline by more than threshold (0.2 = 20%).
+  '''
+  regressions = []
+  for case, result in results.items():
+    old = baseline.get(case)
+    if old == None:
+      continue
+    rates = dict(result['rate'], total=result['total_rate'])
+    old_rates = dict(old['rate'], total=old['total_rate'])
+    for phase in phases + ('total',):
+      rate, old_rate = rates.get(phase), old_rates.get(phase)
+      if rate != None and old_rate != None and rate < old_rate * (1 - threshold):
+        regressions.append((case, phase, old_rate, rate))
+  return regressions
+
+def ResultText(case, result):
+  rates = ' '.join(f'{result["rate"].get(name) or 0:>10.0f}' for name in phases)
+  peak = f'{result["peak_bytes"] / (1 << 20):8.1f}' if result['peak_bytes'] != None else f'{"-":>8}'
+  return f'{case:<16} {result["instructions"]:>8} {rates} {result["total_rate"] or 0:>10.0f} {peak}'
+
+def main():
+  parser = argparse.ArgumentParser(description='Assembler benchmarks on synthetic kernels.')
+  parser.add_argument('-cases', nargs='+', choices=list(generators), default=list(generators))
+  parser.add_argument('-sizes', nargs='+', default=['1k', '10k', '100k'], help='instructions per kernel, e.g. 1k 10k 1M')
+  parser.add_argument('-arch', type=int, default=75)
+  parser.add_argument('-repeat', type=int, default=3, help='timed runs per case, the best one counts')
+  parser.add_argument('-no-memory', dest='memory', action='store_false', help='skip the allocation peak run')
+  parser.add_argument('-baseline', default=default_baseline, metavar='FILE')
+  parser.add_argument('-save', action='store_true', help='write the results to the baseline file')
+  parser.add_argument('-threshold', type=float, default=0.2, help='slowdown flagged as a regression (0.2 = 20%%)')
+  parser.add_argument('-o', dest='output', metavar='FILE', help='also write the results here')
+  args = parser.parse_args()
+
+  print(f'{"Case":<16} {"Instrs":>8} ' + ' '.join(f'{name[:10]:>10}' for name in phases) +
+        f' {"Total":>10} {"Peak MiB":>8}   (instructions/s)')
+  results = {}
+  for name in args.cases:
+    for size in [ParseSize(size) for size in args.sizes]:
+      case = f'{name}/{SizeText(size)}'
+      source = generators[name](size)
+      results[case] = RunCase(source, args.arch, args.repeat, args.memory)
+      print(ResultText(case, results[case]), flush=True)
+
+  report = {
+    'meta' : {
+      'date'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+      'python'   : platform.python_version(),
+      'machine'  : platform.machine(),
+      'platform' : platform.platform(),
+      'arch'     : args.arch,
+      'repeat'   : args.repeat
+    },
+    'results' : results
+  }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=1)
+
+  status = 0
+  if os.path.exists(args.baseline) and not args.save:
+    with open(args.baseline, 'r') as f:
+      baseline = json.load(f)
+    regressions = Compare(results, baseline['results'], args.threshold)
+    for case, phase, old_rate, rate in regressions:
+      print(f'REGRESSION {case} {phase}: {old_rate:.0f} -> {rate:.0f} instructions/s '
+            f'({rate / old_rate - 1:+.0%})')
+    print(f'{len(regressions)} regressions past {args.threshold:.0%} against {args.baseline} '
+          f'({baseline["meta"]["date"]}).')
+    status = 1 if regressions else 0
+  if args.save:
+    # Keep the cases of the old baseline that were not run this time.
+    if os.path.exists(args.baseline):
+      with open(args.baseline, 'r') as f:
+        old = json.load(f)
+      report['results'] = dict(old['results'], **results)
+    with open(args.baseline, 'w') as f:
+      json.dump(report, f, indent=1)
+    print(f'Baseline written to {args.baseline}.')
+  sys.exit(status)
+
+if __name__ == '__main__':
+  main()